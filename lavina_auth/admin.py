@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import PlaceType, Place
+from .models import PlaceType, Place, Job
 
 admin.site.register(PlaceType)
 admin.site.register(Place)
+admin.site.register(Job)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class LavinaAuthConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'lavina_auth'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,43 @@
+import uuid
+from django.core.cache import caches
+from lavina_server.settings import AUTH_CACHE, AUTH_CACHE_TIMEOUT
+
+# права и группы пользователей в отдельном кеше Django (AUTH_CACHE).
+# DjangoModelPermissions на каждый запрос на запись и whoami на каждый вызов
+# читают таблицы auth_*, хотя права меняются очень редко.
+# записи сбрасываются сигналами (см. signals.py): для одного пользователя - при изменении
+# его групп, прав или самого пользователя (в т.ч. деактивации в manage.py expireuser),
+# для всех сразу (сменой версии) - при изменении прав группы или удалении группы/права.
+# версия - случайная метка, а не счетчик: если кеш вытеснит ее, новая метка не совпадет
+# ни с одним старым ключом, и отозванные права не вернутся из старых записей
+
+VERSION_KEY = "auth:version"
+KEY = "auth:{}:{}"
+
+def cache():
+    return caches[AUTH_CACHE]
+
+def new_version():
+    return uuid.uuid4().hex[:16]
+
+def version():
+    return cache().get_or_set(VERSION_KEY, new_version, None)
+
+def get_user_auth(user, load):
+    """Возвращает {'permissions': множество "app.codename", 'groups': имена групп по id}
+    для пользователя user, при отсутствии в кеше - вызывает load(user) и сохраняет результат
+    """
+    key = KEY.format(version(), user.pk)
+    entry = cache().get(key)
+    if entry is None:
+        entry = load(user)
+        cache().set(key, entry, AUTH_CACHE_TIMEOUT)
+    return entry
+
+def invalidate_user(*user_ids):
+    current = version()
+    cache().delete_many([KEY.format(current, user_id) for user_id in user_ids])
+
+def invalidate_all():
+    # старые записи не удаляем - они вытеснятся по таймауту
+    cache().set(VERSION_KEY, new_version(), None)
@@ -0,0 +1,23 @@
+from django.contrib.auth.backends import ModelBackend
+from .auth_cache import get_user_auth
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend, который берет права пользователя из общего кеша (см. auth_cache.py),
+    а не из таблиц auth_* на каждый запрос
+    """
+
+    def load_user_auth(self, user_obj):
+        return {'permissions': super().get_all_permissions(user_obj),
+                'groups': list(user_obj.groups.order_by('id').values_list('name', flat=True))}
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = get_user_auth(user_obj, self.load_user_auth)['permissions']
+        return user_obj._perm_cache
+
+def user_groups(user):
+    """Имена групп пользователя по возрастанию id (из кеша)"""
+    return get_user_auth(user, CachedModelBackend().load_user_auth)['groups']
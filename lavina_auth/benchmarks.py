@@ -0,0 +1,139 @@
+import gc
+import time
+import tracemalloc
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import Client
+from lavina_server.settings import PLACES_CACHE
+from . import elevation, elevation_basic, derivatives, synthetic
+from .elevation_basic import TileCatalog
+from .models import Place, PlaceType, SIMPLIFIED_GEOMETRIES, simplify_geometry
+from .tasks import place_elevation
+
+# замеры производительности основных путей: чтение карты высот, трассировка,
+# сохранение мест и список /places. запускаются через manage.py benchmark
+# на синтетических данных (synthetic.py) и тестовой БД
+
+def measure(func, inputs, warmup=3, before=None):
+    """Вызывает func(*args) для каждого args из inputs и собирает статистику.
+
+    Args:
+        func (callable): замеряемая функция
+        inputs (list): списки аргументов, по одному на вызов
+        warmup (int): количество вызовов перед замером (прогрев кешей)
+        before (callable): вызывается перед каждым вызовом func, в замер не входит
+
+    Returns:
+        dict: {'calls', 'throughput' (вызовов/с), 'mean_ms', 'p50_ms', 'p99_ms',
+               'peak_memory_bytes' (пик выделений Python/numpy за один вызов)}
+    """
+    before = before or (lambda: None)
+    for args in inputs[:warmup]:
+        before()
+        func(*args)
+
+    before()
+    gc.collect()
+    tracemalloc.start()
+    func(*inputs[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = []
+    for args in inputs:
+        before()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {'calls': len(times),
+            'throughput': float(len(times) / (times.sum() / 1000)),
+            'mean_ms': float(times.mean()),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p99_ms': float(np.percentile(times, 99)),
+            'peak_memory_bytes': int(peak)}
+
+
+class SyntheticDem:
+    """Подменяет карту высот на синтетическую (HGT в root, GeoTiff root/height_map.tif)
+    на время блока with, затем возвращает настоящую
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.tif = root + "/height_map.tif"
+
+    def create(self):
+        synthetic.write_hgt_mosaic(self.root)
+        synthetic.write_geotiff(self.tif)
+        return self
+
+    def __enter__(self):
+        self._saved = (elevation_basic._catalog, elevation.FILE)
+        elevation_basic._catalog = TileCatalog(self.root)
+        elevation.FILE = self.tif
+        # get_derivatives не считает растры сам, а синтетический растр маленький
+        derivatives._derivatives[self.tif] = (derivatives.source_signature(self.tif),
+                                              derivatives.compute_in_memory(self.tif))
+        return self
+
+    def __exit__(self, *exc):
+        elevation_basic._catalog, elevation.FILE = self._saved
+        derivatives._derivatives.pop(self.tif, None)
+
+
+def terrain_benchmarks(calls, seed=0):
+    """Замеры функций карты высот, не зависящих от БД: {имя: статистика}"""
+    points = synthetic.points(calls, seed=seed)
+    small = [[(lat - 0.01, lng - 0.02, lat + 0.01, lng + 0.02)] for lat, lng in points]
+    large = [[(lat - 0.05, lng - 0.1, lat + 0.05, lng + 0.1)] for lat, lng in points]
+    return {
+        'elevation_basic.get_relief[0.02x0.04]': measure(elevation_basic.get_relief, small),
+        'elevation_basic.get_relief[0.1x0.2]': measure(elevation_basic.get_relief, large),
+        'elevation_basic.get_elevation_around': measure(elevation_basic.get_elevation_around, points),
+        'elevation.coord_from_geo': measure(elevation.coord_from_geo, points),
+        'elevation.coord_from_geo[vector 10k]': measure(
+            elevation.coord_from_geo,
+            [np.array(synthetic.points(10000, seed=seed + i)).T for i in range(max(calls // 10, 5))]),
+        'elevation.trace_path': measure(elevation.trace_path,
+                                        [(point, 0, 0.02) for point in points]),
+    }
+
+def create_places(count, owner, place_type, seed=0):
+    """Вставляет count синтетических мест без расчета высот (как importplaces)"""
+    places = []
+    for polygon in synthetic.polygons(count, seed=seed):
+        place = Place(name="synthetic", owner=owner, place_type=place_type, geometry=polygon)
+        for _, field, tolerance in SIMPLIFIED_GEOMETRIES:
+            setattr(place, field, simplify_geometry(polygon, tolerance))
+        places.append(place)
+    Place.objects.bulk_create(places, batch_size=1000)
+
+def places_benchmarks(sizes, calls, seed=0):
+    """Замеры Place.save и /places для наборов из sizes мест: {имя: статистика}"""
+    owner = User.objects.get_or_create(username="benchmark")[0]
+    place_type = PlaceType.objects.get_or_create(type="benchmark")[0]
+    # полный цикл запроса анонимного посетителя карты, с middleware
+    client = Client()
+
+    def list_places(zoom):
+        response = client.get('/places', {'type_id': place_type.pk, 'zoom': zoom})
+        assert response.status_code == 200, response.status_code
+
+    results = {}
+    for size in sizes:
+        Place.objects.all().delete()
+        create_places(size, owner, place_type, seed)
+        new_polygons = synthetic.polygons(calls, seed=seed + 1)
+
+        def save(polygon):
+            Place(name="benchmark", owner=owner, place_type=place_type, geometry=polygon).save()
+        results[f'Place.save[{size}]'] = measure(save, [(polygon,) for polygon in new_polygons])
+        ids = list(Place.objects.order_by('-id').values_list('id', flat=True)[:calls])
+        results[f'tasks.place_elevation[{size}]'] = measure(place_elevation, [(pk,) for pk in ids])
+        for zoom in (8, 16):
+            results[f'/places cold zoom={zoom}[{size}]'] = measure(
+                list_places, [(zoom,)] * min(calls, 20), warmup=1, before=caches[PLACES_CACHE].clear)
+            results[f'/places cached zoom={zoom}[{size}]'] = measure(list_places, [(zoom,)] * calls)
+    return results
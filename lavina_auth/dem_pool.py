@@ -0,0 +1,16 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from lavina_server.settings import DEM_THREAD_POOL_SIZE
+
+# пул потоков для блокирующих операций с картой высот (чтение GDAL/HGT, трассировка)
+# из async представлений. он отдельный и ограничен по размеру: медленные трассировки
+# не занимают потоки, в которых sync_to_async выполняет запросы к БД,
+# и не могут запустить больше DEM_THREAD_POOL_SIZE одновременных чтений
+
+executor = ThreadPoolExecutor(max_workers=DEM_THREAD_POOL_SIZE, thread_name_prefix='dem')
+
+async def run_in_dem_pool(func, *args, **kwargs):
+    """Выполняет func(*args, **kwargs) в пуле DEM и ждет результат, не блокируя цикл событий"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
@@ -0,0 +1,170 @@
+import os
+import json
+import threading
+import numpy as np
+from lavina_server.settings import TERRAIN_DERIVATIVES_ROOT
+from .terrain import cell_size_meters, slope_degrees, aspect_degrees, d8_direction, d8_distances
+from .raster import AffineTransform, get_raster
+
+# производные растры для карты высот в GeoTiff (см. elevation.py):
+# уклон, экспозиция и направление наибольшего спуска D8.
+# считаются один раз для всего растра (manage.py buildterrain) и сохраняются
+# в TERRAIN_DERIVATIVES_ROOT как .npy файлы, которые затем отображаются в память.
+# в meta.json хранится геотрансформация и размер/время изменения исходного растра:
+# если растр поменялся, сохраненные файлы считаются устаревшими.
+# файлы пишутся под временными именами и подменяются через os.replace:
+# воркеры, уже отобразившие старые файлы в память, продолжают читать старые (их inode
+# остается до закрытия), а не перезаписываемые на ходу
+
+LAYERS = ('elevation', 'slope', 'aspect', 'd8')
+LAYER_DTYPES = {'elevation': np.float32, 'slope': np.float32, 'aspect': np.float32, 'd8': np.uint8}
+META_FILE = "meta.json"
+# количество строк, обрабатываемых за раз
+BLOCK_ROWS = 512
+
+
+class DerivativesUnavailable(Exception):
+    """Производные растры не посчитаны или устарели (нужно запустить manage.py buildterrain)"""
+
+
+class TerrainDerivatives:
+    """Высоты и производные растры с общей геотрансформацией.
+
+    Атрибуты:
+        geotransform (list): геотрансформация GDAL исходного растра
+        transform (AffineTransform): преобразование индексы <-> координаты
+        elevation, slope, aspect (numpy.ndarray): float32 (строки, столбцы), NaN - нет данных
+        d8 (numpy.ndarray): uint8 - индекс в terrain.D8_OFFSETS или terrain.D8_NONE
+        distances (numpy.ndarray): (8, строки) - расстояния в метрах до соседей D8
+    """
+
+    def __init__(self, geotransform, elevation, slope, aspect, d8):
+        self.geotransform = list(geotransform)
+        self.transform = AffineTransform(geotransform)
+        self.elevation = elevation
+        self.slope = slope
+        self.aspect = aspect
+        self.d8 = d8
+        dy, dx = row_cell_sizes(self.geotransform, elevation.shape[0])
+        self.distances = d8_distances(dy, dx)
+
+    @property
+    def shape(self):
+        return self.elevation.shape
+
+    def index(self, lat, lng):
+        """Индекс (строка, столбец) ячейки с координатами (lat, lng), как elevation.coord_from_geo"""
+        return self.transform.to_index(lat, lng)
+
+    def coords(self, row, col):
+        """Координаты (lat, lng) ячейки, как elevation.geo_from_coords"""
+        return self.transform.to_geo(row, col)
+
+
+def row_cell_sizes(geotransform, height):
+    """Размеры ячеек в метрах: (по широте, по долготе для каждой строки)"""
+    # широты центров строк (см. raster.AffineTransform)
+    lats = geotransform[3] + (np.arange(height) + 0.5) * geotransform[5]
+    return cell_size_meters(lats, abs(geotransform[5]), geotransform[1])
+
+def source_signature(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_elevation(filename):
+    """Читает растр высот целиком: (геотрансформация, float32 массив с NaN вместо nodata)"""
+    rst = get_raster(filename)
+    elevation = np.asarray(rst.read(), dtype=np.float32)
+    if rst.nodata is not None:
+        elevation[elevation == rst.nodata] = np.nan
+    return list(rst.transform.geotransform), elevation
+
+def compute(geotransform, elevation, out):
+    """Заполняет out['slope'], out['aspect'], out['d8'] (массивы формы elevation) блоками по строкам"""
+    height = elevation.shape[0]
+    dy, dx = row_cell_sizes(geotransform, height)
+    # рамка из NaN: у краевых ячеек нет соседей за пределами растра
+    padded = np.pad(elevation, 1, constant_values=np.nan)
+    for top in range(0, height, BLOCK_ROWS):
+        bottom = min(top + BLOCK_ROWS, height)
+        z = padded[top:bottom + 2].astype(np.float64)
+        out['slope'][top:bottom] = slope_degrees(z, dy, dx[top:bottom])
+        out['aspect'][top:bottom] = aspect_degrees(z, dy, dx[top:bottom])
+        out['d8'][top:bottom] = d8_direction(z, dy, dx[top:bottom])
+
+def build(source, root=TERRAIN_DERIVATIVES_ROOT):
+    """Считает производные растры для source и сохраняет их в root"""
+    geotransform, elevation = read_elevation(source)
+    os.makedirs(root, exist_ok=True)
+    # временные файлы в том же каталоге, чтобы os.replace был атомарным
+    out = {layer: np.lib.format.open_memmap(os.path.join(root, f"{layer}.tmp.npy"), mode='w+',
+                                            dtype=LAYER_DTYPES[layer], shape=elevation.shape)
+           for layer in LAYERS}
+    out['elevation'][:] = elevation
+    compute(geotransform, elevation, out)
+    for array in out.values():
+        array.flush()
+    del out
+    meta = {'geotransform': geotransform, 'shape': list(elevation.shape),
+            'source': source_signature(source)}
+    with open(os.path.join(root, META_FILE + ".tmp"), "w") as f:
+        json.dump(meta, f)
+    # пока слои подменяются по одному, метаданных нет - load вернет None, а не смесь версий
+    if os.path.exists(os.path.join(root, META_FILE)):
+        os.remove(os.path.join(root, META_FILE))
+    for layer in LAYERS:
+        os.replace(os.path.join(root, f"{layer}.tmp.npy"), os.path.join(root, f"{layer}.npy"))
+    os.replace(os.path.join(root, META_FILE + ".tmp"), os.path.join(root, META_FILE))
+    return meta
+
+def load(source, root=TERRAIN_DERIVATIVES_ROOT):
+    """Загружает сохраненные растры (отображая их в память) или None,
+    если их нет или они посчитаны для другой версии source
+    """
+    meta_file = os.path.join(root, META_FILE)
+    try:
+        meta_stat = os.stat(meta_file)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['source'] != source_signature(source):
+            return None
+        layers = [np.load(os.path.join(root, f"{layer}.npy"), mmap_mode='r') for layer in LAYERS]
+        # build мог подменить слои, пока они открывались
+        current = os.stat(meta_file)
+        if (current.st_ino, current.st_mtime_ns) != (meta_stat.st_ino, meta_stat.st_mtime_ns):
+            return None
+    except FileNotFoundError:
+        return None
+    if any(list(layer.shape) != meta['shape'] for layer in layers):
+        return None
+    return TerrainDerivatives(meta['geotransform'], *layers)
+
+def compute_in_memory(source):
+    # для тестов и замеров: для полного растра это долго и занимает много памяти
+    geotransform, elevation = read_elevation(source)
+    out = {layer: np.empty(elevation.shape, dtype=LAYER_DTYPES[layer]) for layer in LAYERS[1:]}
+    compute(geotransform, elevation, out)
+    return TerrainDerivatives(geotransform, elevation, out['slope'], out['aspect'], out['d8'])
+
+
+_derivatives = {}
+_derivatives_lock = threading.Lock()
+
+def get_derivatives(source):
+    """Возвращает общие для процесса производные растры для source.
+
+    Raises:
+        DerivativesUnavailable: сохраненных растров нет или они посчитаны для другой версии source.
+            в памяти они не считаются - внутри запроса это слишком долго
+    """
+    signature = source_signature(source)
+    with _derivatives_lock:
+        cached = _derivatives.get(source)
+        if cached is None or cached[0] != signature:
+            terrain = load(source)
+            if terrain is None:
+                raise DerivativesUnavailable(f"terrain derivatives for {source} are missing or outdated, "
+                                             f"run manage.py buildterrain")
+            cached = (signature, terrain)
+            _derivatives[source] = cached
+        return cached[1]
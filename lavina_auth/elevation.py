@@ -1,76 +1,61 @@
-from lavina_server.settings import DATA_ROOT
-from django.contrib.gis.gdal import GDALRaster
-from math import sqrt, sin as sinus, degrees
+from django.core.cache import caches
+from lavina_server.settings import DATA_ROOT, TRACE_CACHE
+from math import sqrt, degrees, atan2
+import numpy as np
+from .grid import GeoGrid
+from .raster import get_raster
+from .derivatives import get_derivatives
+from .terrain import D8_OFFSETS, D8_NONE
+from .zonal import polygon_mask, rings_extent
+from .metrics import record_trace
+from .heightmap import overview_levels
 
 # модуль для работы с картой высот, хранящейся в формате GeoTiff
-# для чтения используется класс GDALRaster
+# для чтения используется класс GDALRaster (открытый один раз на процесс, см. raster.py)
 # документация: https://docs.djangoproject.com/en/4.1/ref/contrib/gis/gdal/#gdalraster
 # data/height_map.tif
 FILE = DATA_ROOT + "height_map.tif"
 
-# угловые секунды в одном градусе
-SEC_PER_DEGREE = 60 * 60
-
 # NOTE: в leaflet.js используется гео порядок координат: широта, долгота (lat, lng)
 # в GDAL - "компьютерный", широта = Y (ось вниз), долгота = X: (lng, lat)
 # для работы с координами я использую формат leaflet
 # поэтому в функциях часто можно встретить перевернутые индексы
 
 # assuming file crs is 4326 (WGS84), otherwise will not work
-def coord_from_geo(lat, lng, rst):
+def coord_from_geo(lat, lng, rst=None):
     """По заданным координатам возвращает индекс ячейки
     с данными о высоте в этих координатах.
     ЗАМЕЧАНИЕ 1: функция работает только с растрами в координатной проекции 4326 (WGS84)
     ЗАМЕЧАНИЕ 2: lat и lng должны быть внутри области
+    lat и lng могут быть numpy массивами - тогда возвращаются массивы индексов
 
     Параметры:
         lat (float): широта
         lng (float): долгота
-        rst (GDALRaster): растр
+        rst (RasterHandle): растр, по умолчанию FILE
 
     Возвращает:
         кортеж: (индекс_строки(j, y), индекс_cтолбца(i, x))
     """
-    # узнаем координаты верхнего левого края области,
-    # которая хранится в растре, а также размеры матрицы с данными о высоте
-    # NOTE: extent возвращает координаты ограничивающего прямоугольника
-    # в довольно странном формате - (xmin, ymin, xmax, ymax)
-    # поэтому левый верхний угол = (ymax, xmin) (порядок lat lng)
-    top_left = (rst.extent[3], rst.extent[0])
-    array_dim = (rst.bands[0].width, rst.bands[0].height)
-    # вычисляем разрешение растра в угловых секундах по широте и высоте
-    # для этого считаем протяженность области в градусах по широте и долготе,
-    # домножаем на SEC_PER_DEGREE
-    # и делим на соответсвующую размерность матрицы данных
-    sec_per_width = (rst.extent[2] - rst.extent[0]) * SEC_PER_DEGREE / array_dim[0]
-    sec_per_height = (rst.extent[3] - rst.extent[1]) * SEC_PER_DEGREE / array_dim[1]
-    # вычисляем координаты относительно верхнего левого края области (в угловых секундах)
-    # NOTE: так как левый верхний угол: (ymax, xmin), то lat <= ymax, но lng >= xmin
-    # поэтому top_left[0] - lat, но lng - top_left[1]
-    sec_rel_coords = (top_left[0] - lat) * SEC_PER_DEGREE, (lng - top_left[1]) * SEC_PER_DEGREE
-    # наконец, вычисляем индекс:
-    # делим относительные координаты на разрешение
-    return (int(round(sec_rel_coords[0] / sec_per_height, 0)), 
-          int(round(sec_rel_coords[1] / sec_per_width, 0)))
-
-
-def geo_from_coords(x, y, rst):
+    # NOTE: раньше индекс считался через extent и размеры растра при каждом вызове,
+    # теперь используется заранее посчитанное обратное преобразование геотрансформации
+    return (rst or get_raster(FILE)).transform.to_index(lat, lng)
+
+
+def geo_from_coords(x, y, rst=None):
     """По заданным индексам ячейки с данными возвращает
-    координаты этой ячейки (долгота, широта).
+    координаты этой ячейки (широта, долгота).
 
     Args:
-        x (int): индекс столбца 
-        y (int): индекс строки
-        rst (GDALRaster): растр
+        x (int): индекс строки
+        y (int): индекс столбца
+        rst (RasterHandle): растр, по умолчанию FILE
 
     Returns:
-        кортеж: (долгота, широта)
+        кортеж: (широта, долгота)
     """
     # для преобразования используем матрицу геотрансформации растра
-    gt = rst.geotransform
-    x_geo = gt[0] + y*gt[1] + x*gt[2]
-    y_geo = gt[3] + y*gt[4] + x*gt[5]
-    return y_geo, x_geo
+    return (rst or get_raster(FILE)).transform.to_geo(x, y)
 
 def get_allowed_region():
     """Возвращает координаты нижнего левого и верхнего правого края
@@ -81,7 +66,7 @@ def get_allowed_region():
     """
     # NOTE: насколько помню, leaflet принимает именно такой формат
     # для создания прямоугольника
-    a_r = GDALRaster(FILE, write=False).extent
+    a_r = get_raster(FILE).extent
     return ((a_r[1], a_r[0]),(a_r[3], a_r[2]))
 
 def get_el(i, j, band):
@@ -98,41 +83,48 @@ def get_el(i, j, band):
     """
     return band.data(offset=(j, i), size=(1, 1))[0]
 
-def get_relief(bounds):
+def choose_overview(bounds, size):
+    """Самый грубый уровень пирамиды FILE (см. heightmap.py), в котором область bounds
+    занимает не меньше size = (строк, столбцов) ячеек. Если такого нет - сам FILE
+    """
+    cell_size = get_raster(FILE).transform.cell_size
+    rows = (bounds[2] - bounds[0]) / cell_size[0]
+    cols = (bounds[3] - bounds[1]) / cell_size[1]
+    chosen = FILE
+    for factor, path in overview_levels(FILE):
+        if rows / factor >= size[0] and cols / factor >= size[1]:
+            chosen = path
+    return chosen
+
+def relief_shape(bounds, size=None):
+    """Примерный размер (строк, столбцов) ответа get_relief(bounds, size) - до чтения данных"""
+    cell_size = get_raster(FILE if size is None else choose_overview(bounds, size)).transform.cell_size
+    return (int((bounds[2] - bounds[0]) / cell_size[0]) + 1,
+            int((bounds[3] - bounds[1]) / cell_size[1]) + 1)
+
+def get_relief(bounds, size=None):
     """По заданному ограничивающему прямоугольнику bounds
-    возвращает информацию о точке с наибольшей высотой и
-    массив с информацией о высоте в пределах этого прямоугольника
+    возвращает высоты в пределах этого прямоугольника
 
     Args:
-        bounds (tuple): (широта_вл, долгота_вл, широта_нп, долгота_нп)
+        bounds (tuple): (широта_мин, долгота_мин, широта_макс, долгота_макс)
+        size (tuple): нужный размер ответа (строк, столбцов) или None - полное разрешение.
+                      высоты читаются из самого грубого обзора, в котором ячеек не меньше
 
     Returns:
-        tuple: (инфа_о_точке_с_наибольшей_высотой, двумерный_массив_инфы_о_точках)
-               инфа_о_точке = {'elevation': высота(int), 'coords': [lat, lng]}
+        GeoGrid: сетка высот, информация о точке с наибольшей высотой - GeoGrid.heighest()
     """
-    rst = GDALRaster(FILE, write=False)
-    # находим индексы верхней левой и правой нижней ячейки
-    topLeft = coord_from_geo(bounds[0], bounds[1], rst)
-    bottomRight = coord_from_geo(bounds[2], bounds[3], rst)
-    result = []
-    heighest_point = None 
-    band = rst.bands[0]
-    # TODO: устаревший способ чтения, 
-    # можно сразу получить из растра нужную область
-    # c помощью band.data(offset=(topLeft[1], topLeft[0]), size=размеры_области)[0]
-    # NOTE: из-за путаницы индексом в get_el,
-    # i это j, то есть индекс строки
-    # а j это i - индекс столбца
-    for i in range(bottomRight[0], topLeft[0]+1):
-        result.append([])
-        for j in range(topLeft[1], bottomRight[1] + 1):
-            val = get_el(i, j, band)
-            result[-1].append({'elevation': val,
-                                'coords': geo_from_coords(i, j, rst)})
-            if heighest_point is None or \
-                result[-1][-1]['elevation'] > heighest_point['elevation']:
-                    heighest_point = result[-1][-1]
-    return (heighest_point, result)
+    rst = get_raster(FILE if size is None else choose_overview(bounds, size))
+    # находим индексы верхней левой (широта_макс, долгота_мин)
+    # и правой нижней (широта_мин, долгота_макс) ячейки
+    top, left = coord_from_geo(bounds[2], bounds[1], rst)
+    bottom, right = coord_from_geo(bounds[0], bounds[3], rst)
+    top, bottom = constrain(top, 0, rst.height - 1), constrain(bottom, 0, rst.height - 1)
+    left, right = constrain(left, 0, rst.width - 1), constrain(right, 0, rst.width - 1)
+    # читаем сразу всю область, band.data возвращает numpy массив (строки, столбцы)
+    data = rst.read(offset=(left, top), size=(right - left + 1, bottom - top + 1))
+    return GeoGrid(geo_from_coords(top, left, rst), rst.transform.cell_size, data,
+                   nodata=rst.nodata)
 
 def constrain(val, min_val, max_val):    
     return min(max_val, max(min_val, val))
@@ -193,70 +185,206 @@ def get_sin_cos_angle(distance, elevation):
     Returns:
         tuple: (sin, cos, angle)
     """
-    sin = elevation / distance
-    cos = sqrt(1 - sin**2)
-    angle = degrees(sinus(sin))
+    hypot = sqrt(distance**2 + elevation**2)
+    sin = elevation / hypot
+    cos = distance / hypot
+    angle = degrees(atan2(elevation, distance))
     return sin, cos, angle
 
 def trace_path(start_point, mass, fraction):
-    rst = GDALRaster(FILE, write=False)
-    band = rst.bands[0]
-    current_point = start_point
-    coords = coord_from_geo(current_point[0], current_point[1], rst)
-    current_point = (coords, get_el(coords[0], coords[1], band))
+    # NOTE: шаги делаются по заранее посчитанным растрам (см. derivatives.py):
+    # направление наибольшего спуска D8 и расстояния до соседей в метрах,
+    # поэтому на каждом шаге только обращения к массивам, без чтения из GDAL
+    terrain = get_derivatives(FILE)
+    elevation = terrain.elevation
+    current = terrain.index(start_point[0], start_point[1])
+    # отрицательные индексы numpy молча взял бы с другого края растра
+    if not (0 <= current[0] < terrain.shape[0] and 0 <= current[1] < terrain.shape[1]):
+        raise ValueError("start point is outside of the height map")
     count_same = 0
-    next_point = None
     velocity = 0
     traced_path = []
     info = []
     while len(traced_path) < 1000:
-
-        for point in get_around(current_point[0][0], current_point[0][1], band):
-            if next_point is None or point[1] < next_point[1]:
-                next_point = point
-
-        delta_elevation = abs(next_point[1] - current_point[1])
-        traced_path.append(geo_from_coords(current_point[0][0], current_point[0][1], rst))
+        traced_path.append(terrain.coords(current[0], current[1]))
+        direction = terrain.d8[current]
+        if direction == D8_NONE:
+            record_trace(len(traced_path), "stuck")
+            return traced_path, info, "stuck"
+        next_cell = (current[0] + D8_OFFSETS[direction][0], current[1] + D8_OFFSETS[direction][1])
+        current_elevation, next_elevation = float(elevation[current]), float(elevation[next_cell])
+
+        delta_elevation = abs(next_elevation - current_elevation)
         if delta_elevation < 2:
             count_same += 1
             if count_same > 5:
+                record_trace(len(traced_path), "stuck")
                 return traced_path, info, "stuck"
         else:
             count_same = 0
 
-        # print(current_point)
-        # print(next_point)
-        distance = get_distance(current_point[0], next_point[0])
-        # print(distance)
+        distance = float(terrain.distances[direction, current[0]])
         sin, cos, angle = get_sin_cos_angle(distance, delta_elevation)
-        # print(sin, cos)
         a = 9.8 * (sin - fraction*cos)
         if a < 0:
-            return traced_path, info, (current_point, next_point)
-        # print(a)
+            record_trace(len(traced_path), "friction")
+            return traced_path, info, ((current, current_elevation), (next_cell, next_elevation))
         d = velocity**2 + 4 * distance * (a / 2)
         t = (sqrt(d) - velocity) / 2
-        
-        if current_point[1] < next_point[1]:
-            a = -a 
+
+        if current_elevation < next_elevation:
+            a = -a
         velocity = a*t + velocity
 
         if velocity <= 0:
+            record_trace(len(traced_path), "stopped")
             return traced_path, info
 
-        info.append({'time': t, 'velocity_at_end': velocity, 'delta_elevation': delta_elevation, 'angle': angle})
-        current_point = next_point
+        info.append({'time': t, 'velocity_at_end': velocity, 'delta_elevation': delta_elevation,
+                     'angle': angle, 'slope': float(terrain.slope[current])})
+        current = next_cell
 
+    record_trace(len(traced_path), "exceed")
     return traced_path, info, "exceed"
 
-    
+
+# знаков после запятой в коэффициенте трения для ключа кеша путей
+FRACTION_DIGITS = 3
+
+def cached_trace_path(start_point, mass, fraction):
+    """trace_path с кешем результатов (кеш Django TRACE_CACHE).
+    Путь зависит только от начальной ячейки, коэффициента трения и версии карты высот,
+    поэтому ключ - (контрольная сумма FILE, строка, столбец, округленный fraction).
+    Путь всегда считается от центра ячейки с округленным fraction,
+    чтобы результат не зависел от того, какой запрос первым попал в кеш
+    """
+    rst = get_raster(FILE)
+    row, col = rst.transform.to_index(start_point[0], start_point[1])
+    fraction = round(float(fraction), FRACTION_DIGITS)
+    key = f"trace:{rst.checksum}:{row}:{col}:{fraction}"
+    result = caches[TRACE_CACHE].get(key)
+    if result is None:
+        result = trace_path(rst.transform.to_geo(row, col), mass, fraction)
+        caches[TRACE_CACHE].set(key, result)
+    return result
+
+def trace_paths(start_points, fraction, max_steps=1000):
+    """Пакетный вариант trace_path: все частицы двигаются одновременно,
+    каждый шаг - операции над массивами для всех еще движущихся частиц.
+    Физика та же, что в trace_path.
+
+    Args:
+        start_points (list): начальные точки [(lat, lng), ...]
+        fraction (float): коэффициент трения
+        max_steps (int): максимальное количество шагов
+
+    Returns:
+        tuple: (пути, след)
+               пути - [{'path': [(lat, lng), ...], 'status': причина_остановки}, ...]
+               в порядке start_points, причины: "stuck" (равнина или нет данных),
+               "friction" (трение больше скатывающей силы), "stopped" (скорость упала до нуля),
+               "exceed" (превышено max_steps)
+               след - GeoGrid: сколько путей прошло через каждую ячейку
+
+    Raises:
+        ValueError: начальная точка вне карты высот
+    """
+    terrain = get_derivatives(FILE)
+    elevation = terrain.elevation
+    offsets = np.array(D8_OFFSETS + ((0, 0),))
+    height, width = terrain.shape
+
+    count = len(start_points)
+    points = np.asarray(start_points, dtype=np.float64).reshape(count, 2)
+    rows, cols = terrain.transform.to_index(points[:, 0], points[:, 1])
+    outside = np.flatnonzero((rows < 0) | (rows >= height) | (cols < 0) | (cols >= width))
+    if outside.size:
+        raise ValueError(f"start points {outside[:10].tolist()} are outside of the height map")
+    velocity = np.zeros(count)
+    count_same = np.zeros(count, dtype=np.int64)
+    lengths = np.zeros(count, dtype=np.int64)
+    status = np.full(count, "exceed", dtype=object)
+    history = []
+    active = np.arange(count)
+    while active.size and len(history) < max_steps:
+        history.append((active, rows[active], cols[active]))
+        lengths[active] += 1
+        r, c = rows[active], cols[active]
+        direction = np.asarray(terrain.d8[r, c])
+        no_direction = direction == D8_NONE
+        direction = np.where(no_direction, len(D8_OFFSETS), direction)
+        next_r, next_c = r + offsets[direction, 0], c + offsets[direction, 1]
+        current_elevation = np.asarray(elevation[r, c], dtype=np.float64)
+        next_elevation = np.asarray(elevation[next_r, next_c], dtype=np.float64)
+
+        delta_elevation = np.abs(next_elevation - current_elevation)
+        count_same[active] = np.where(delta_elevation < 2, count_same[active] + 1, 0)
+        stuck = no_direction | (count_same[active] > 5)
+
+        distance = terrain.distances[np.minimum(direction, len(D8_OFFSETS) - 1), r]
+        hypot = np.hypot(distance, delta_elevation)
+        a = 9.8 * (delta_elevation - fraction * distance) / hypot
+        friction = ~stuck & (a < 0)
+        v = velocity[active]
+        t = (np.sqrt(np.maximum(v**2 + 2 * distance * a, 0)) - v) / 2
+        a = np.where(current_elevation < next_elevation, -a, a)
+        v = a * t + v
+        stopped = ~stuck & ~friction & (v <= 0)
+
+        status[active[stuck]] = "stuck"
+        status[active[friction]] = "friction"
+        status[active[stopped]] = "stopped"
+        moving = ~(stuck | friction | stopped)
+        velocity[active] = v
+        rows[active[moving]], cols[active[moving]] = next_r[moving], next_c[moving]
+        active = active[moving]
+
+    # восстанавливаем пути из истории шагов
+    path_rows = np.zeros((count, max(lengths.max(initial=0), 1)), dtype=np.int64)
+    path_cols = np.zeros_like(path_rows)
+    for step, (stepped, r, c) in enumerate(history):
+        path_rows[stepped, step], path_cols[stepped, step] = r, c
+    lats, lngs = terrain.transform.to_geo(path_rows, path_cols)
+    paths = [{'path': list(zip(lats[i, :lengths[i]].tolist(), lngs[i, :lengths[i]].tolist())),
+              'status': status[i]} for i in range(count)]
+    for i in range(count):
+        record_trace(int(lengths[i]), status[i])
+
+    # след: количество путей через каждую ячейку в пределах охватывающего прямоугольника
+    visited = np.arange(path_rows.shape[1]) < lengths[:, np.newaxis]
+    if not visited.any():
+        return paths, None
+    visited_rows, visited_cols = path_rows[visited], path_cols[visited]
+    top, left = visited_rows.min(), visited_cols.min()
+    footprint = np.zeros((visited_rows.max() - top + 1, visited_cols.max() - left + 1), dtype=np.int32)
+    # каждый путь учитывается в ячейке один раз, даже если проходит ее несколько раз
+    owners = np.nonzero(visited)[0]
+    cells = np.unique(np.stack((owners, visited_rows - top, visited_cols - left), axis=-1), axis=0)
+    np.add.at(footprint, (cells[:, 1], cells[:, 2]), 1)
+    return paths, GeoGrid(terrain.coords(top, left), terrain.transform.cell_size, footprint)
+
+def start_points_in_polygon(rings):
+    """Центры ячеек карты высот внутри полигона - начальные точки для trace_paths"""
+    terrain = get_derivatives(FILE)
+    extent = rings_extent(rings)
+    top, left = terrain.index(extent[2], extent[1])
+    bottom, right = terrain.index(extent[0], extent[3])
+    top, bottom = max(top, 0), min(bottom, terrain.shape[0] - 1)
+    left, right = max(left, 0), min(right, terrain.shape[1] - 1)
+    if bottom < top or right < left:
+        raise ValueError("polygon is outside of the height map")
+    lats = terrain.transform.to_geo(np.arange(top, bottom + 1), left)[0]
+    lngs = terrain.transform.to_geo(top, np.arange(left, right + 1))[1]
+    inside_rows, inside_cols = np.nonzero(polygon_mask(rings, lats, lngs))
+    return list(zip(lats[inside_rows].tolist(), lngs[inside_cols].tolist()))
+
 def test():
-    rst = GDALRaster(FILE, write=False)
+    rst = get_raster(FILE)
     test_data = ((67.60166666666667, 33.69583333333333, 510),
                  (67.58916666666667, 33.68666666666667, 514),
                  (67.66333333333333, 33.6925, 721),
                  (67.59666666666666, 33.69083333333333, 498))
-    data = rst.bands[0].data()
+    data = rst.read()
     for row in test_data:
         coords = coord_from_geo(row[0], row[1], rst)
         print(coords)
@@ -264,6 +392,6 @@ def test():
         print((row[0], row[1], row[2], data[coords[0]][coords[1]]))
 
 def test_2():
-    rst = GDALRaster(FILE, write=False)
+    rst = get_raster(FILE)
     coords = coord_from_geo(67.59027777777779, 33.68666666664018, rst)
-    return get_around(coords[0], coords[1], rst.bands[0].data())
+    return get_around(coords[0], coords[1], rst.raster.bands[0])
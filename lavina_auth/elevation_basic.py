@@ -1,89 +1,340 @@
-from string import hexdigits
-import struct
-from lavina_server.settings import DATA_ROOT
+import os
+import re
+import hashlib
+import mmap
+import threading
+from collections import OrderedDict
+import numpy as np
+from .grid import GeoGrid
+from .metrics import record_dem_read
+from lavina_server.settings import DATA_ROOT, DEM_TILE_CACHE_SIZE, \
+    DEM_SAMPLES_PER_DEGREE, DEM_ALLOWED_REGION
+
+# модуль для работы с картой высот в формате HGT (SRTM)
+# файл - это квадратная матрица big-endian int16 без заголовка,
+# строки идут с севера на юг, столбцы - с запада на восток
+# формат: https://www.usgs.gov/centers/eros/science/usgs-eros-archive-digital-elevation-shuttle-radar-topography-mission-srtm-1
+#
+# все тайлы *.hgt из DATA_ROOT собираются в одну мозаику (TileCatalog).
+# у мозаики единая глобальная сетка индексов:
+#   строка = (90 - широта) * отсчетов_на_градус
+#   столбец = (долгота + 180) * отсчетов_на_градус
+# соседние тайлы HGT перекрываются на одну строку/столбец (общий край)
 
-CORE_LAT = 67
-CORE_LONG = 33
-FILENAME = DATA_ROOT + "N67E033.hgt"
 VOID_DATA = -32768
 
-ALLOWED_REGION = (67.546, 33.28, 68, 34)
+# имя тайла - координаты его нижнего левого (юго-западного) угла, например N67E033.hgt
+HGT_NAME = re.compile(r'^([NS])(\d{2})([EW])(\d{3})\.hgt$', re.IGNORECASE)
+# размер файла -> количество отсчетов в строке: SRTM3 (3") и SRTM1 (1")
+SAMPLES_BY_SIZE = {1201 * 1201 * 2: 1201, 3601 * 3601 * 2: 3601}
+
+
+class HgtTile:
+    """Тайл HGT, отображенный в память (mmap).
+    Файл открывается один раз, данные не копируются в память процесса:
+    data - это numpy-представление (view) поверх отображенного файла,
+    срезы data тоже не копируют данные.
+    Страницы файла кешируются ОС и общие для всех воркеров.
+
+    Атрибуты:
+        filename (str): путь к файлу
+        samples (int): количество отсчетов в строке (и строк)
+        data (numpy.ndarray): матрица высот (samples, samples), dtype '>i2'
+    """
+
+    def __init__(self, filename, samples):
+        self.filename = filename
+        self.samples = samples
+        with open(filename, "rb") as f:
+            # NOTE: mmap держит собственную копию дескриптора,
+            # поэтому файл можно сразу закрыть
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self._mmap, dtype='>i2').reshape(samples, samples)
+
+    def region(self, rows, cols, per_degree):
+        """Возвращает область тайла в разрешении мозаики.
+
+        Args:
+            rows (tuple): (первая, последняя) строка в разрешении per_degree, включительно
+            cols (tuple): (первый, последний) столбец в разрешении per_degree, включительно
+            per_degree (int): отсчетов на градус в мозаике
+
+        Returns:
+            numpy.ndarray: view, если разрешение тайла кратно per_degree,
+                           иначе копия (ближайший отсчет)
+        """
+        tile_per_degree = self.samples - 1
+        if tile_per_degree % per_degree == 0:
+            step = tile_per_degree // per_degree
+            return self.data[rows[0] * step:rows[1] * step + 1:step,
+                             cols[0] * step:cols[1] * step + 1:step]
+        scale = tile_per_degree / per_degree
+        row_index = np.rint(np.arange(rows[0], rows[1] + 1) * scale).astype(int)
+        col_index = np.rint(np.arange(cols[0], cols[1] + 1) * scale).astype(int)
+        return self.data[np.ix_(row_index, col_index)]
+
+
+class TileCatalog:
+    """Мозаика из всех тайлов *.hgt в каталоге root.
+    Тайлы индексируются по имени файла при создании, а открываются лениво.
+    Открытые тайлы хранятся в LRU не больше cache_size штук,
+    так что память и количество открытых файлов на процесс ограничены.
+
+    Атрибуты:
+        root (str): каталог с тайлами
+        tiles (dict): (широта, долгота) юго-западного угла -> (путь, отсчетов_в_строке)
+        per_degree (int): разрешение мозаики, отсчетов на градус
+        version (str): отпечаток набора тайлов (имена, размеры, время изменения),
+                       меняется при замене любого тайла
+    """
+
+    def __init__(self, root, cache_size=DEM_TILE_CACHE_SIZE, per_degree=DEM_SAMPLES_PER_DEGREE):
+        self.root = root
+        self.cache_size = cache_size
+        self.tiles = {}
+        fingerprint = hashlib.sha1()
+        for name in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            match = HGT_NAME.match(name)
+            path = os.path.join(root, name)
+            if match is None or os.path.getsize(path) not in SAMPLES_BY_SIZE:
+                continue
+            lat = int(match[2]) * (1 if match[1].upper() == 'N' else -1)
+            lng = int(match[4]) * (1 if match[3].upper() == 'E' else -1)
+            stat = os.stat(path)
+            self.tiles[(lat, lng)] = (path, SAMPLES_BY_SIZE[stat.st_size])
+            fingerprint.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        self.version = fingerprint.hexdigest()[:16]
+        if per_degree is None:
+            per_degree = min((samples - 1 for _, samples in self.tiles.values()), default=1200)
+        self.per_degree = per_degree
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+        self._checksums = {}
+
+    @property
+    def bounds(self):
+        """Ограничивающий прямоугольник всех тайлов:
+        (широта_мин, долгота_мин, широта_макс, долгота_макс) или None, если тайлов нет
+        """
+        if not self.tiles:
+            return None
+        lats = [lat for lat, _ in self.tiles]
+        lngs = [lng for _, lng in self.tiles]
+        return (min(lats), min(lngs), max(lats) + 1, max(lngs) + 1)
+
+    def tiles_in(self, bounds):
+        """Ключи (широта, долгота) тайлов, пересекающихся с bounds, по возрастанию"""
+        return sorted(key for key in self.tiles
+                      if key[0] <= bounds[2] and key[0] + 1 >= bounds[0] and
+                      key[1] <= bounds[3] and key[1] + 1 >= bounds[1])
+
+    def checksum(self, key):
+        """sha1 содержимого тайла key, пересчитывается только при изменении файла"""
+        path = self.tiles[key][0]
+        stat = os.stat(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._checksums.get(path)
+        if cached is None or cached[0] != signature:
+            digest = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            cached = (signature, digest.hexdigest())
+            self._checksums[path] = cached
+        return cached[1]
+
+    def fingerprint(self, bounds):
+        """Отпечаток содержимого тайлов под bounds (и разрешения мозаики):
+        меняется, только если заменили тайл, на который попадает эта область
+        """
+        digest = hashlib.sha1(f"{self.per_degree};".encode())
+        for key in self.tiles_in(bounds):
+            digest.update(f"{key}:{self.checksum(key)};".encode())
+        return digest.hexdigest()
+
+    def get_tile(self, lat, lng):
+        """Возвращает открытый тайл с юго-западным углом (lat, lng) или None"""
+        key = (lat, lng)
+        if key not in self.tiles:
+            return None
+        with self._lock:
+            tile = self._open.get(key)
+            if tile is not None:
+                self._open.move_to_end(key)
+                return tile
+            tile = HgtTile(*self.tiles[key])
+            self._open[key] = tile
+            # NOTE: вытесненный тайл явно не закрываем - на него могут ссылаться
+            # срезы в других потоках, mmap освободится вместе с последним из них
+            while len(self._open) > self.cache_size:
+                self._open.popitem(last=False)
+            return tile
+
+    def index(self, lat, lng):
+        """Возвращает глобальные индексы (строка, столбец) ячейки, ближайшей к (lat, lng)"""
+        return (int(round((90 - lat) * self.per_degree)),
+                int(round((lng + 180) * self.per_degree)))
+
+    def coords(self, i, j):
+        """Возвращает координаты (широта, долгота) ячейки с глобальными индексами (i, j)"""
+        return (90 - i / self.per_degree,
+                j / self.per_degree - 180)
 
-def get_sample(f, i, j):
-    # TODO: неоптимизированное чтение файла, все время перемещаемся с начала, а не
-    # c текущей позиции
-    f.seek(((i - 1) * 1201 + (j - 1)) * 2)  # go to the right spot,
-    buf = f.read(2)  # read two bytes and convert them:
-    val = struct.unpack('>h', buf)  # ">h" is a signed two byte integer
-    if not val == -32768:  # the not-a-valid-sample value
-        return val
-    else:
-        return None
+    def window(self, top, left, bottom, right):
+        """Возвращает область мозаики по глобальным индексам (границы включительно).
+        Если область целиком внутри одного тайла - возвращается view без копирования,
+        иначе области соседних тайлов склеиваются в новый массив.
+        Ячейки без данных (нет тайла) заполняются VOID_DATA.
+
+        Returns:
+            numpy.ndarray: массив размером (bottom - top + 1, right - left + 1)
+        """
+        pd = self.per_degree
+        parts = []
+        # тайл с юго-западным углом (lat, lng) покрывает
+        # строки [(89 - lat) * pd, (90 - lat) * pd] и столбцы [(lng + 180) * pd, (lng + 181) * pd]
+        for lat in range(89 - bottom // pd, 90 - (-(-top // pd)) + 1):
+            for lng in range(-(-left // pd) - 181, right // pd - 180 + 1):
+                tile = self.get_tile(lat, lng)
+                if tile is None:
+                    continue
+                tile_top, tile_left = (89 - lat) * pd, (lng + 180) * pd
+                rows = (max(top, tile_top), min(bottom, tile_top + pd))
+                cols = (max(left, tile_left), min(right, tile_left + pd))
+                region = tile.region((rows[0] - tile_top, rows[1] - tile_top),
+                                     (cols[0] - tile_left, cols[1] - tile_left), pd)
+                if rows == (top, bottom) and cols == (left, right):
+                    return record_dem_read('hgt', region)
+                parts.append((rows, cols, region))
+        result = np.full((bottom - top + 1, right - left + 1), VOID_DATA, dtype=np.int16)
+        for rows, cols, region in parts:
+            result[rows[0] - top:rows[1] - top + 1, cols[0] - left:cols[1] - left + 1] = region
+        return record_dem_read('hgt', result)
+
+    def sample(self, rows, cols):
+        """Возвращает высоты в ячейках с глобальными индексами rows, cols
+        (массивы одинаковой формы), без чтения охватывающего окна целиком.
+
+        Returns:
+            numpy.ndarray: int16 массив той же формы, VOID_DATA там, где нет данных
+        """
+        pd = self.per_degree
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        result = np.full(rows.shape, VOID_DATA, dtype=np.int16)
+        missing = np.ones(rows.shape, dtype=bool)
+        # ячейка на общем крае есть в обоих соседних тайлах, поэтому, если тайла
+        # под ней нет, пробуем взять ее с нижнего/правого края тайла сверху/слева
+        for d_row, d_col in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            tile_rows = (rows - d_row) // pd
+            tile_cols = (cols - d_col) // pd
+            keys = np.unique(np.stack((tile_rows[missing], tile_cols[missing]), axis=-1), axis=0)
+            for tile_row, tile_col in keys.tolist():
+                tile = self.get_tile(89 - tile_row, tile_col - 180)
+                if tile is None:
+                    continue
+                selected = missing & (tile_rows == tile_row) & (tile_cols == tile_col)
+                scale = (tile.samples - 1) / pd
+                local_rows = np.rint((rows[selected] - tile_row * pd) * scale).astype(int)
+                local_cols = np.rint((cols[selected] - tile_col * pd) * scale).astype(int)
+                result[selected] = tile.data[local_rows, local_cols]
+                missing &= ~selected
+            if not missing.any():
+                break
+        return record_dem_read('hgt', result)
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+def get_catalog():
+    """Возвращает общую для процесса мозаику тайлов из DATA_ROOT"""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = TileCatalog(DATA_ROOT)
+    return _catalog
+
+def get_allowed_region():
+    """Возвращает область, в пределах которой можно добавлять места:
+    (широта_мин, долгота_мин, широта_макс, долгота_макс)
+    """
+    # NOTE: мозаика собирается (сканируется DATA_ROOT) только при первом обращении, а не при импорте
+    return DEM_ALLOWED_REGION or get_catalog().bounds
+
+def to_elevation(val):
+    """Переводит отсчет HGT в высоту: None для отсутствующих данных"""
+    val = int(val)
+    return val if val != VOID_DATA else None
+
+def get_sample(i, j):
+    return to_elevation(get_catalog().window(i, j, i, j)[0, 0])
 
 def coord_to_hgt_tile_indexes(lat, lng):
-    arclat = (lat - CORE_LAT) * 3600
-    arclng = (lng - CORE_LONG) * 3600
-    return (1201 - int(round(arclat / 3, 0)),
-            (int(round(arclng / 3, 0))))
+    """Возвращает глобальные индексы (строка, столбец) ячейки, ближайшей к (lat, lng)"""
+    return get_catalog().index(lat, lng)
 
 def hgt_tile_indexes_to_coords(i, j):
-    return ((1201 - i) * 3 / 3600 + CORE_LAT,
-            j*3 / 3600 + CORE_LONG)
+    return get_catalog().coords(i, j)
 
 def get_elevation_around(lat, lng):
-    indexes = coord_to_hgt_tile_indexes(lat, lng)
-    j = indexes[1] - 1
+    i, j = coord_to_hgt_tile_indexes(lat, lng)
+    window = get_catalog().window(i - 1, j - 1, i + 1, j + 1)
+    # NOTE: исторический формат ответа - data[столбец][строка]
     data = []
-    with open(FILENAME, "rb") as f:
-        while j < (indexes[1] + 2):
-            i = indexes[0] - 1
-            data.append([])
-            while i < (indexes[0] + 2):
-                elevation = get_sample(f, i, j)[0]
-                data[-1].append({'elevation': elevation, 
-                                'coords': hgt_tile_indexes_to_coords(i, j)})
-                i += 1
-            j += 1
+    for col, row_values in enumerate(window.T.tolist()):
+        data.append([{'elevation': val if val != VOID_DATA else None,
+                      'coords': hgt_tile_indexes_to_coords(i - 1 + row, j - 1 + col)}
+                     for row, val in enumerate(row_values)])
 
     coord_error = (data[1][1]["coords"][0] - lat,
                    data[1][1]["coords"][1] - lng)
-                   
-    return {'data': data, 'error': coord_error}
 
+    return {'data': data, 'error': coord_error}
 
 def get_relief(bounds):
-    topLeft = coord_to_hgt_tile_indexes(bounds[0], bounds[1])
-    bottomRight = coord_to_hgt_tile_indexes(bounds[2], bounds[3])
-    result = []
-    heighest_point = None 
-    with open(FILENAME, "rb") as f:
-        f.seek(((bottomRight[0] - 1) * 1201 + (topLeft[1] - 1)) * 2)
-        for i in range(bottomRight[0], topLeft[0]+1):
-            result.append([])
-            for j in range(topLeft[1], bottomRight[1] + 1):
-                val = struct.unpack('>h', f.read(2))
-                result[-1].append({'elevation': val[0] if val[0] != VOID_DATA else None,
-                                   'coords': hgt_tile_indexes_to_coords(i, j)})
-                if heighest_point is None or \
-                   result[-1][-1]['elevation'] > heighest_point['elevation']:
-                     heighest_point = result[-1][-1]
-            f.seek((topLeft[1] + (1200 - bottomRight[1]))*2, 1)
-    return (heighest_point, result)
-
-def constrain(val, min_val, max_val):    
+    """Возвращает высоты в пределах ограничивающего прямоугольника bounds
+
+    Args:
+        bounds (tuple): (широта_мин, долгота_мин, широта_макс, долгота_макс)
+
+    Returns:
+        GeoGrid: сетка высот, data - view на мозаику (без копирования, если это возможно)
+    """
+    catalog = get_catalog()
+    # верхний левый угол окна - (широта_макс, долгота_мин)
+    bottom, left = catalog.index(bounds[0], bounds[1])
+    top, right = catalog.index(bounds[2], bounds[3])
+    return GeoGrid(catalog.coords(top, left),
+                   (1 / catalog.per_degree, 1 / catalog.per_degree),
+                   catalog.window(top, left, bottom, right),
+                   nodata=VOID_DATA)
+
+def get_heighest_point(bounds):
+    """Возвращает информацию о точке с наибольшей высотой
+    в пределах ограничивающего прямоугольника bounds
+
+    Args:
+        bounds (tuple): (широта_мин, долгота_мин, широта_макс, долгота_макс)
+
+    Returns:
+        dict: {'elevation': высота(int), 'coords': (lat, lng)}
+    """
+    return get_relief(bounds).heighest()
+
+def constrain(val, min_val, max_val):
     return min(max_val, max(min_val, val))
 
 def get_around(x, y, relief_map):
     rows = relief_map[constrain(x - 1, 0, len(relief_map)) :
                       constrain(x + 1, 0, len(relief_map))]
     height = len(relief_map[0])
-    rows = [row[constrain(y - 1, 0, height) : 
+    rows = [row[constrain(y - 1, 0, height) :
                 constrain(y + 1, 0, height)]  for row in rows]
     return rows
-            
-  
+
+
 if __name__ == "__main__":
     lat, lng = 67.61916666666667, 33.75
     print(get_elevation_around(lat, lng))
     # lat, lng = 67.618511, 33.750900
-   
\ No newline at end of file
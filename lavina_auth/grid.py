@@ -0,0 +1,89 @@
+import base64
+import numpy as np
+
+# компактное представление регулярной сетки значений (например, высот)
+# вместо списка списков словарей {'elevation': ..., 'coords': ...}:
+# координаты ячеек не хранятся, а вычисляются по origin и cell_size
+
+
+class GeoGrid:
+    """Регулярная сетка значений в координатах WGS84.
+    Строки идут с севера на юг, столбцы - с запада на восток.
+    Координаты ячейки (i, j): (origin[0] - i * cell_size[0], origin[1] + j * cell_size[1])
+
+    Атрибуты:
+        origin (tuple): (широта, долгота) верхней левой ячейки
+        cell_size (tuple): (шаг по широте, шаг по долготе) в градусах
+        data (numpy.ndarray): двумерный массив значений
+        nodata (number): значение для ячеек без данных или None
+    """
+
+    def __init__(self, origin, cell_size, data, nodata=None):
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.cell_size = (float(cell_size[0]), float(cell_size[1]))
+        self.data = data
+        self.nodata = nodata
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def coords(self, i, j):
+        """Возвращает координаты (широта, долгота) ячейки (i, j)"""
+        return (self.origin[0] - i * self.cell_size[0],
+                self.origin[1] + j * self.cell_size[1])
+
+    def masked(self):
+        """Возвращает данные как numpy.ma.MaskedArray, где замаскированы ячейки без данных"""
+        if self.nodata is None:
+            return np.ma.masked_array(self.data)
+        return np.ma.masked_equal(self.data, self.nodata)
+
+    def stats(self):
+        """Возвращает статистику по ячейкам с данными:
+        {'min': ..., 'max': ..., 'argmax': [i, j]} или None, если данных нет
+        """
+        values = self.masked()
+        if values.count() == 0:
+            return None
+        i, j = np.unravel_index(values.argmax(), values.shape)
+        return {'min': values.min().item(), 'max': values.max().item(),
+                'argmax': [int(i), int(j)]}
+
+    def heighest(self):
+        """Возвращает информацию о ячейке с наибольшим значением:
+        {'elevation': значение, 'coords': (lat, lng)} или None, если данных нет
+        """
+        stats = self.stats()
+        if stats is None:
+            return None
+        return {'elevation': stats['max'], 'coords': self.coords(*stats['argmax'])}
+
+    def to_bytes(self):
+        """Возвращает значения построчно в little-endian (порядок байт типизированных массивов JS)"""
+        return np.ascontiguousarray(self.data, dtype=self.data.dtype.newbyteorder('<')).tobytes()
+
+    def header(self):
+        return {'origin': list(self.origin),
+                'cell_size': list(self.cell_size),
+                'shape': list(self.shape),
+                'dtype': self.data.dtype.name,
+                'nodata': self.nodata}
+
+    def to_json(self, encoding='base64'):
+        """Возвращает сетку в виде словаря для JSON.
+
+        Args:
+            encoding (str): 'base64' - data это base64 от to_bytes(),
+                            'array' - data это плоский список значений по строкам
+
+        Returns:
+            dict: header() + {'encoding', 'data', 'stats'}
+        """
+        if encoding == 'base64':
+            data = base64.b64encode(self.to_bytes()).decode('ascii')
+        elif encoding == 'array':
+            data = self.data.ravel().tolist()
+        else:
+            raise ValueError(f"unknown encoding: {encoding}")
+        return dict(self.header(), encoding=encoding, data=data, stats=self.stats())
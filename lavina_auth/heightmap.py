@@ -0,0 +1,152 @@
+import os
+import re
+import numpy as np
+from django.contrib.gis.gdal import GDALRaster
+from .elevation_basic import TileCatalog, VOID_DATA
+from .raster import file_signature
+
+# сборка карты высот GeoTiff (elevation.FILE) из тайлов HGT (manage.py buildheightmap).
+# растр пишется тайлами 256x256 со сжатием, поэтому чтение небольшой области
+# распаковывает только нужные блоки.
+# к нему строится пирамида обзоров - отдельные GeoTiff с шагом в 2, 4, 8... раз крупнее:
+#   height_map.tif, height_map.ovr2.tif, height_map.ovr4.tif, ...
+# (GDALRaster в Django не умеет строить внутренние обзоры, поэтому файлы отдельные).
+# elevation.get_relief выбирает самый грубый уровень, которого хватает для нужного размера ответа.
+# все уровни читаются и пишутся полосами по строкам, поэтому память не зависит от размера мозаики.
+# новые уровни сначала целиком пишутся во временные файлы и только потом подменяют старые
+
+BLOCK_SIZE = 256
+# обзоры строятся, пока меньшая сторона больше блока
+MIN_OVERVIEW_SIZE = BLOCK_SIZE
+CREATE_OPTIONS = {'tiled': 'yes', 'blockxsize': str(BLOCK_SIZE), 'blockysize': str(BLOCK_SIZE),
+                  'compress': 'deflate', 'predictor': '2'}
+OVERVIEW_NAME = re.compile(r'\.ovr(\d+)$')
+
+def overview_filename(filename, factor):
+    base, ext = os.path.splitext(filename)
+    return f"{base}.ovr{factor}{ext}"
+
+def find_overview_levels(filename):
+    """Уровни пирамиды для filename: [(коэффициент, путь), ...] по возрастанию, начиная с (1, filename)"""
+    base, ext = os.path.splitext(filename)
+    directory = os.path.dirname(filename) or '.'
+    levels = [(1, filename)]
+    for name in os.listdir(directory):
+        stem, name_ext = os.path.splitext(name)
+        match = OVERVIEW_NAME.search(stem)
+        if match and name_ext == ext and os.path.join(directory, stem[:match.start()]) == base:
+            levels.append((int(match[1]), os.path.join(directory, name)))
+    return sorted(levels)
+
+# filename -> (размер и время изменения filename, уровни)
+_levels = {}
+
+def overview_levels(filename):
+    """find_overview_levels без чтения каталога на каждый запрос: список перечитывается,
+    только когда меняется основной файл (build_height_map подменяет его последним)
+    """
+    signature = file_signature(filename)
+    cached = _levels.get(filename)
+    if cached is None or cached[0] != signature:
+        cached = (signature, find_overview_levels(filename))
+        _levels[filename] = cached
+    return cached[1]
+
+def create_geotiff(filename, origin, cell_size, width, height):
+    """Создает пустой тайлированный GeoTiff int16 (EPSG:4326).
+    origin - (долгота, широта) верхнего левого угла, cell_size - шаг в градусах
+    """
+    return GDALRaster({'driver': 'GTiff', 'name': filename, 'srid': 4326,
+                       'width': width, 'height': height, 'datatype': 3,
+                       'origin': origin, 'scale': (cell_size, -cell_size),
+                       'bands': [{'nodata_value': VOID_DATA}],
+                       'papsz_options': CREATE_OPTIONS})
+
+def downsample(data):
+    """Уменьшает массив высот в 2 раза средним по блокам 2x2 без учета VOID_DATA"""
+    rows, cols = -(-data.shape[0] // 2) * 2, -(-data.shape[1] // 2) * 2
+    padded = np.full((rows, cols), np.nan)
+    padded[:data.shape[0], :data.shape[1]] = np.where(data == VOID_DATA, np.nan, data)
+    blocks = padded.reshape(rows // 2, 2, cols // 2, 2)
+    valid = (~np.isnan(blocks)).sum(axis=(1, 3))
+    total = np.nansum(blocks, axis=(1, 3))
+    return np.where(valid > 0, np.rint(total / np.maximum(valid, 1)), VOID_DATA).astype(np.int16)
+
+def write_base(filename, catalog, top, left, bottom, right, origin):
+    """Пишет область мозаики (глобальные индексы, включительно) полосами по BLOCK_SIZE строк.
+    Returns: (высота, ширина)
+    """
+    height, width = bottom - top + 1, right - left + 1
+    raster = create_geotiff(filename, origin, 1 / catalog.per_degree, width, height)
+    band = raster.bands[0]
+    for row in range(0, height, BLOCK_SIZE):
+        block = catalog.window(top + row, left, min(top + row + BLOCK_SIZE - 1, bottom), right)
+        band.data(np.ascontiguousarray(block, dtype=np.int16), offset=(0, row),
+                  size=(width, block.shape[0]))
+    # GDAL дописывает файл при освобождении набора данных
+    del band, raster
+    return height, width
+
+def write_overview(source, filename, origin, cell_size):
+    """Пишет обзор в 2 раза грубее растра source, читая его полосами по 2 * BLOCK_SIZE строк.
+    Returns: (высота, ширина)
+    """
+    source_band = GDALRaster(source, write=False).bands[0]
+    height, width = -(-source_band.height // 2), -(-source_band.width // 2)
+    raster = create_geotiff(filename, origin, cell_size, width, height)
+    band = raster.bands[0]
+    for row in range(0, height, BLOCK_SIZE):
+        rows = min(2 * BLOCK_SIZE, source_band.height - 2 * row)
+        block = downsample(source_band.data(offset=(0, 2 * row), size=(source_band.width, rows)))
+        band.data(np.ascontiguousarray(block), offset=(0, row), size=(width, block.shape[0]))
+    del band, raster, source_band
+    return height, width
+
+def build_height_map(filename, root, bounds=None, per_degree=None):
+    """Собирает GeoTiff и пирамиду обзоров из тайлов HGT в root.
+
+    Args:
+        filename (str): путь к результату (elevation.FILE)
+        root (str): каталог с тайлами HGT
+        bounds (tuple): (широта_мин, долгота_мин, широта_макс, долгота_макс), по умолчанию - все тайлы
+        per_degree (int): разрешение, по умолчанию - разрешение мозаики
+
+    Returns:
+        list: [(коэффициент, путь, (высота, ширина)), ...] - записанные уровни
+    """
+    catalog = TileCatalog(root, per_degree=per_degree)
+    bounds = bounds or catalog.bounds
+    if bounds is None:
+        raise ValueError(f"no HGT tiles in {root}")
+    top, left = catalog.index(bounds[2], bounds[1])
+    bottom, right = catalog.index(bounds[0], bounds[3])
+    cell_size = 1 / catalog.per_degree
+    # центры ячеек совпадают с отсчетами HGT, поэтому угол - на полшага левее и выше
+    # (см. raster.AffineTransform). угол обзоров тот же, меняется только шаг
+    lat, lng = catalog.coords(top, left)
+    origin = (lng - cell_size / 2, lat + cell_size / 2)
+
+    levels = [(1, filename, filename + ".tmp",
+               write_base(filename + ".tmp", catalog, top, left, bottom, right, origin))]
+    try:
+        while min(levels[-1][3]) // 2 >= MIN_OVERVIEW_SIZE:
+            factor = levels[-1][0] * 2
+            path = overview_filename(filename, factor)
+            levels.append((factor, path, path + ".tmp",
+                           write_overview(levels[-1][2], path + ".tmp", origin, cell_size * factor)))
+    except BaseException:
+        for _, _, tmp, _ in levels:
+            os.remove(tmp)
+        raise
+
+    # все уровни готовы: подменяем обзоры, удаляем лишние старые обзоры и последним - основной файл.
+    # открытые растры (raster.get_raster) и список уровней (overview_levels)
+    # заметят новый основной файл по размеру/времени изменения
+    factors = {factor for factor, _, _, _ in levels}
+    for factor, path, tmp, _ in levels[1:]:
+        os.replace(tmp, path)
+    for factor, path in find_overview_levels(filename)[1:]:
+        if factor not in factors:
+            os.remove(path)
+    os.replace(filename + ".tmp", filename)
+    return [(factor, path, shape) for factor, path, _, shape in levels]
@@ -0,0 +1,91 @@
+import time
+import logging
+import traceback
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from lavina_server.settings import JOB_MAX_ATTEMPTS, JOB_TIMEOUT
+from .models import Job
+
+# простая очередь задач на базе БД: задачи - строки модели Job,
+# воркер (manage.py runjobs) забирает их по одной через SELECT ... FOR UPDATE SKIP LOCKED,
+# поэтому несколько воркеров могут работать параллельно, не забирая одну задачу дважды.
+# обработчики задач регистрируются декоратором task (см. tasks.py)
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+def task(name):
+    """Регистрирует функцию как обработчик задач name. Аргументы задачи передаются как kwargs,
+    возвращаемое значение (JSON) сохраняется в Job.result
+    """
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+def claim_job():
+    """Забирает самую старую задачу из очереди (помечает ее выполняемой) или возвращает None"""
+    with transaction.atomic():
+        job = Job.objects.select_for_update(skip_locked=True) \
+            .filter(status=Job.PENDING).order_by('id').first()
+        if job is None:
+            return None
+        job.status = Job.RUNNING
+        job.started = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=['status', 'started', 'attempts'])
+    return job
+
+def run_job(job):
+    """Выполняет задачу и сохраняет результат. Упавшая задача возвращается в очередь,
+    пока не исчерпано JOB_MAX_ATTEMPTS попыток
+    """
+    try:
+        handler = TASKS[job.task]
+        with transaction.atomic():
+            job.result = handler(**job.args)
+        job.status = Job.DONE
+        job.error = ''
+    except Exception:
+        logger.exception("job %s failed", job)
+        job.error = traceback.format_exc()
+        job.status = Job.PENDING if job.attempts < JOB_MAX_ATTEMPTS else Job.FAILED
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished'])
+    return job
+
+def requeue_stale_jobs():
+    """Возвращает в очередь задачи, которые выполняются дольше JOB_TIMEOUT секунд
+    (воркер, забравший их, скорее всего упал). Попытка засчитывается при claim_job,
+    поэтому задача, которая каждый раз роняет воркер, после JOB_MAX_ATTEMPTS попыток
+    помечается неудачной, а не возвращается в очередь бесконечно.
+
+    Returns:
+        tuple: (возвращено в очередь, помечено неудачными)
+    """
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.RUNNING, started__lt=now - timedelta(seconds=JOB_TIMEOUT))
+    failed = stale.filter(attempts__gte=JOB_MAX_ATTEMPTS).update(
+        status=Job.FAILED, finished=now,
+        error=f"worker did not finish the job in {JOB_TIMEOUT} seconds, {JOB_MAX_ATTEMPTS} attempts")
+    requeued = stale.filter(attempts__lt=JOB_MAX_ATTEMPTS).update(status=Job.PENDING)
+    return requeued, failed
+
+def work(poll_interval, once=False):
+    """Цикл воркера: выполняет задачи, пока они есть, затем ждет poll_interval секунд.
+    При once=True завершается, когда очередь опустела. Возвращает число выполненных задач
+    """
+    count = 0
+    requeue_stale_jobs()
+    while True:
+        job = claim_job()
+        if job is None:
+            if once:
+                return count
+            time.sleep(poll_interval)
+            requeue_stale_jobs()
+            continue
+        run_job(job)
+        count += 1
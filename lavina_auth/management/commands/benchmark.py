@@ -0,0 +1,85 @@
+import json
+import platform
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+from lavina_auth.benchmarks import SyntheticDem, terrain_benchmarks, places_benchmarks
+
+# кеши на время замеров: не трогаем общий файловый кеш с настоящими ответами /places
+BENCHMARK_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'},
+    'traces': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-traces'},
+    'tiles': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-tiles'},
+    'auth': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark-auth'},
+}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Benchmarks terrain and places hot paths on synthetic data and saves the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--compare', help="previous results file to compare p50/p99 with")
+        parser.add_argument('--sizes', default='10,1000,10000',
+                            help="comma separated numbers of places in the synthetic datasets")
+        parser.add_argument('--calls', type=int, default=100, help="calls per benchmark")
+        parser.add_argument('--skip-places', action='store_true',
+                            help="only terrain benchmarks, without the test database")
+        parser.add_argument('--keepdb', action='store_true', help="reuse the test database")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("--sizes should be comma separated integers")
+
+        results = {}
+        with tempfile.TemporaryDirectory() as root, override_settings(CACHES=BENCHMARK_CACHES):
+            self.stdout.write(f"generating synthetic DEM in {root}")
+            with SyntheticDem(root).create():
+                results.update(terrain_benchmarks(options['calls']))
+                if not options['skip_places']:
+                    results.update(self.run_places(sizes, options))
+
+        report = {'commit': git_commit(),
+                  'date': datetime.now(timezone.utc).isoformat(),
+                  'python': platform.python_version(),
+                  'numpy': np.__version__,
+                  'calls': options['calls'],
+                  'results': results}
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['results']
+        for name, stats in results.items():
+            line = (f"{name:45} {stats['throughput']:10.1f}/s  p50 {stats['p50_ms']:9.3f} ms  "
+                    f"p99 {stats['p99_ms']:9.3f} ms  peak {stats['peak_memory_bytes'] / 1024:9.0f} KiB")
+            if previous and name in previous:
+                line += f"  p50 x{stats['p50_ms'] / previous[name]['p50_ms']:.2f}" \
+                        f"  p99 x{stats['p99_ms'] / previous[name]['p99_ms']:.2f}"
+            self.stdout.write(line)
+        self.stdout.write(f"saved to {options['output']}")
+
+    def run_places(self, sizes, options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                                      keepdb=options['keepdb'])
+        try:
+            return places_benchmarks(sizes, options['calls'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
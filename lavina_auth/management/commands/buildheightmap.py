@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from lavina_auth.elevation import FILE
+from lavina_auth.heightmap import build_height_map
+from lavina_server.settings import DATA_ROOT
+
+class Command(BaseCommand):
+    help = "Builds the tiled GeoTIFF height map and its overview pyramid from the HGT tiles"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bounds', help="lat_min,lng_min,lat_max,lng_max (default - all tiles)")
+        parser.add_argument('--per-degree', type=int, default=None,
+                            help="samples per degree (default - the mosaic resolution)")
+
+    def handle(self, *args, **options):
+        bounds = None
+        if options['bounds']:
+            try:
+                bounds = tuple(float(val) for val in options['bounds'].split(','))
+            except ValueError:
+                bounds = ()
+            if len(bounds) != 4:
+                raise CommandError("--bounds should be lat_min,lng_min,lat_max,lng_max")
+        try:
+            levels = build_height_map(FILE, DATA_ROOT, bounds, options['per_degree'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        for factor, path, shape in levels:
+            self.stdout.write(f"1/{factor}: {path} {shape[0]}x{shape[1]}")
+        self.stdout.write("run manage.py buildterrain to update the terrain derivatives")
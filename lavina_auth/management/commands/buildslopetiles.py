@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from lavina_auth.elevation_basic import get_allowed_region
+from lavina_auth.slope_tiles import build
+from lavina_server.settings import SLOPE_TILES_ROOT, SLOPE_TILES_MIN_ZOOM, SLOPE_TILES_MAX_ZOOM
+
+class Command(BaseCommand):
+    help = "Renders the avalanche slope class overlay as an XYZ PNG tile pyramid"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bounds', help="lat_min,lng_min,lat_max,lng_max (default - allowed region)")
+        parser.add_argument('--min-zoom', type=int, default=SLOPE_TILES_MIN_ZOOM)
+        parser.add_argument('--max-zoom', type=int, default=SLOPE_TILES_MAX_ZOOM)
+        parser.add_argument('--workers', type=int, default=None,
+                            help="rendering processes (default - number of CPUs)")
+        parser.add_argument('--keep', type=int, default=2, help="number of versions to keep")
+        parser.add_argument('--force', action='store_true', help="rebuild even if the version exists")
+
+    def handle(self, *args, **options):
+        bounds = get_allowed_region()
+        if options['bounds']:
+            try:
+                bounds = tuple(float(val) for val in options['bounds'].split(','))
+            except ValueError:
+                bounds = ()
+            if len(bounds) != 4:
+                raise CommandError("--bounds should be lat_min,lng_min,lat_max,lng_max")
+        if bounds is None:
+            raise CommandError("no DEM tiles, nothing to render")
+        name, total, written = build(SLOPE_TILES_ROOT, tuple(bounds), options['min_zoom'],
+                                     options['max_zoom'], options['workers'], options['keep'],
+                                     options['force'])
+        if not total:
+            self.stdout.write(f"version {name} is already built")
+        else:
+            self.stdout.write(f"version {name}: rendered {written} of {total} tiles")
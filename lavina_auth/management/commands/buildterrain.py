@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from lavina_auth.elevation import FILE
+from lavina_auth.derivatives import build
+from lavina_server.settings import TERRAIN_DERIVATIVES_ROOT
+
+class Command(BaseCommand):
+    help = "Computes slope, aspect and D8 flow direction rasters for the height map"
+
+    def handle(self, *args, **options):
+        meta = build(FILE, TERRAIN_DERIVATIVES_ROOT)
+        self.stdout.write(f"built terrain derivatives {meta['shape'][0]}x{meta['shape'][1]} "
+                          f"in {TERRAIN_DERIVATIVES_ROOT}")
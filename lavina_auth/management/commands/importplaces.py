@@ -0,0 +1,127 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.contrib.auth.models import User
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import Point, Polygon, MultiPolygon
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from lavina_auth.elevation_basic import get_allowed_region
+from lavina_auth.models import Place, PlaceType, SIMPLIFIED_GEOMETRIES, simplify_geometry, heighest_point_in, \
+    dem_fingerprint, geometry_hash
+from lavina_auth.places_cache import invalidate_places
+from lavina_auth.places_tiles import invalidate_tiles
+
+# массовый импорт мест (например, исторического кадастра лавинных очагов) из GeoJSON/Shapefile.
+# в отличие от POST /places, места не сохраняются по одному через Place.save:
+# наивысшие точки считаются параллельно в пуле процессов, строки вставляются bulk_create
+
+def flip(polygon):
+    """Меняет местами координаты: (долгота, широта) файла -> (широта, долгота), как хранятся места"""
+    return Polygon(*[[(y, x) for x, y, *_ in ring] for ring in polygon.coords], srid=polygon.srid)
+
+def inside_allowed_region(extent):
+    region = get_allowed_region()
+    return extent[0] >= region[0] and extent[1] >= region[1] and \
+           extent[2] <= region[2] and extent[3] <= region[3]
+
+def read_polygons(filename, layer, name_field, swap):
+    """Читает полигоны слоя: список (имя, Polygon в порядке (lat, lng), srid 4326).
+    Мультиполигоны разбиваются на отдельные места
+    """
+    try:
+        source = DataSource(filename)
+    except Exception as e:
+        raise CommandError(f"cannot open {filename}: {e}")
+    polygons = []
+    for feature in source[layer]:
+        geom = feature.geom
+        if geom.srs is not None and geom.srid != 4326:
+            geom.transform(4326)
+        geos = geom.geos
+        geos.srid = 4326
+        name = str(feature.get(name_field)) if name_field in feature.fields else f"#{feature.fid}"
+        if isinstance(geos, MultiPolygon):
+            parts = [(f"{name} ({i + 1})" if len(geos) > 1 else name, part)
+                     for i, part in enumerate(geos)]
+        elif isinstance(geos, Polygon):
+            parts = [(name, geos)]
+        else:
+            raise CommandError(f"feature {feature.fid} is {geos.geom_type}, expected polygons")
+        for name, polygon in parts:
+            polygons.append((name[:Place._meta.get_field('name').max_length],
+                             flip(polygon) if swap else polygon))
+    return polygons
+
+def validate(polygons):
+    """Делит полигоны на подходящие и ошибки (список строк)"""
+    valid, errors = [], []
+    for name, polygon in polygons:
+        if not polygon.valid:
+            errors.append(f"{name}: {polygon.valid_reason}")
+        elif not inside_allowed_region(polygon.extent):
+            errors.append(f"{name}: extent of geometry should be inside allowed region")
+        else:
+            valid.append((name, polygon))
+    return valid, errors
+
+
+class Command(BaseCommand):
+    help = "Imports places from a GeoJSON file or Shapefile (any OGR vector format)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename')
+        parser.add_argument('--type', required=True, help="place type id or name")
+        parser.add_argument('--owner', required=True, help="username of the owner")
+        parser.add_argument('--layer', type=int, default=0)
+        parser.add_argument('--name-field', default='name')
+        parser.add_argument('--no-swap', action='store_true',
+                            help="coordinates in the file are already (lat, lng)")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="processes computing elevation (default - number of CPUs)")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--skip-invalid', action='store_true',
+                            help="import valid places even if some are invalid")
+
+    def handle(self, *args, **options):
+        place_type = PlaceType.objects.filter(pk=options['type']).first() \
+            if options['type'].isdigit() else PlaceType.objects.filter(type=options['type']).first()
+        if place_type is None:
+            raise CommandError(f"place type {options['type']} does not exist")
+        owner = User.objects.filter(username=options['owner']).first()
+        if owner is None:
+            raise CommandError(f"user {options['owner']} does not exist")
+
+        polygons, errors = validate(read_polygons(options['filename'], options['layer'],
+                                                  options['name_field'], not options['no_swap']))
+        for error in errors:
+            self.stderr.write(error)
+        if errors and not options['skip_invalid']:
+            raise CommandError(f"{len(errors)} invalid geometries, nothing imported "
+                               f"(use --skip-invalid to import the rest)")
+
+        # дочерним процессам не нужны соединения с БД родителя
+        connections.close_all()
+        rings = [[ring.coords for ring in polygon] for _, polygon in polygons]
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            heighest = list(executor.map(heighest_point_in, rings,
+                                         chunksize=max(1, len(rings) // 64)))
+
+        places, uncovered = [], 0
+        for (name, polygon), point in zip(polygons, heighest):
+            if point is None:
+                # место импортируется без высот: под ним нет тайлов DEM
+                self.stderr.write(f"{name}: no elevation data, imported without heighest point")
+                uncovered += 1
+            place = Place(name=name, owner=owner, place_type=place_type, geometry=polygon,
+                          heighest_elevation=point['elevation'] if point else None,
+                          heighest_point=Point(point['coords'][0], point['coords'][1]) if point else None,
+                          dem_version=dem_fingerprint(polygon), geometry_hash=geometry_hash(polygon))
+            for _, field, tolerance in SIMPLIFIED_GEOMETRIES:
+                setattr(place, field, simplify_geometry(polygon, tolerance))
+            places.append(place)
+        with transaction.atomic():
+            Place.objects.bulk_create(places, batch_size=options['batch_size'])
+        # bulk_create не вызывает post_save, поэтому кеш /places и тайлы обновляем сами
+        invalidate_places(place_type.pk)
+        invalidate_tiles(*(polygon.extent for _, polygon in polygons))
+        self.stdout.write(f"imported {len(places)} places ({uncovered} without elevation data), "
+                          f"skipped {len(errors)}")
@@ -0,0 +1,99 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.contrib.gis.geos import Point
+from lavina_auth.elevation_basic import get_catalog
+from lavina_auth.models import Place, heighest_point_in, dem_fingerprint, geometry_hash
+from lavina_auth.places_cache import invalidate_places
+from lavina_auth.places_tiles import invalidate_tiles
+from lavina_server.settings import PLACES_CACHE
+
+# пересчет высот мест после замены тайлов DEM: обрабатываются только места,
+# у которых сохраненный отпечаток DEM или геометрии не совпадает с текущим.
+# места перебираются пачками по возрастанию id, после каждой пачки id запоминается в кеше,
+# поэтому прерванный запуск продолжается с того же места (--restart - начать сначала).
+# высоты считаются без блокировок в пуле процессов, строки пачки блокируются
+# только на время записи
+
+CHECKPOINT_KEY = "recomputeplaces:{}"
+
+def stale_places(places):
+    """Места, высоты которых посчитаны не по текущим DEM/геометрии: [(место, отпечаток DEM), ...]"""
+    stale = []
+    for place in places:
+        fingerprint = dem_fingerprint(place.geometry)
+        if place.dem_version != fingerprint or place.geometry_hash != geometry_hash(place.geometry):
+            stale.append((place, fingerprint))
+    return stale
+
+def save_chunk(results):
+    """Записывает посчитанные высоты. Место пропускается, если его геометрию
+    успели изменить - тогда высоты пересчитает задача, поставленная Place.save
+    """
+    with transaction.atomic():
+        current = {place.pk: place for place in Place.objects.select_for_update()
+                   .filter(pk__in=[place.pk for place, _, _ in results]).only('geometry', 'place_type')}
+        updated = []
+        for place, fingerprint, heighest in results:
+            locked = current.get(place.pk)
+            if locked is None or geometry_hash(locked.geometry) != geometry_hash(place.geometry):
+                continue
+            # под местом нет данных DEM - высоты остаются пустыми до смены тайлов
+            locked.heighest_elevation = heighest['elevation'] if heighest else None
+            locked.heighest_point = Point(heighest['coords'][0], heighest['coords'][1]) if heighest else None
+            locked.dem_version = fingerprint
+            locked.geometry_hash = geometry_hash(place.geometry)
+            updated.append(locked)
+        Place.objects.bulk_update(updated, ['heighest_elevation', 'heighest_point',
+                                            'dem_version', 'geometry_hash'])
+    return updated
+
+
+class Command(BaseCommand):
+    help = "Recomputes elevation of places whose DEM fingerprint or geometry hash is outdated"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=None,
+                            help="processes computing elevation (default - number of CPUs)")
+        parser.add_argument('--restart', action='store_true', help="ignore the saved progress")
+
+    def handle(self, *args, **options):
+        cache = caches[PLACES_CACHE]
+        # прогресс относится к конкретному набору тайлов DEM
+        checkpoint = CHECKPOINT_KEY.format(get_catalog().version)
+        last_pk = 0 if options['restart'] else cache.get(checkpoint, 0)
+        if last_pk:
+            self.stdout.write(f"resuming after place {last_pk}")
+
+        checked, recomputed = 0, 0
+        type_ids = set()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                places = list(Place.objects.filter(pk__gt=last_pk).order_by('pk')
+                              .only('geometry', 'place_type', 'dem_version', 'geometry_hash')
+                              [:options['chunk_size']])
+                if not places:
+                    break
+                stale = stale_places(places)
+                rings = [[ring.coords for ring in place.geometry] for place, _ in stale]
+                heighest = list(executor.map(heighest_point_in, rings))
+                for (place, _), point in zip(stale, heighest):
+                    if point is None:
+                        self.stderr.write(f"place {place.pk}: no elevation data, heighest point cleared")
+                updated = save_chunk([(place, fingerprint, point)
+                                      for (place, fingerprint), point in zip(stale, heighest)])
+                type_ids.update(place.place_type_id for place in updated)
+                invalidate_tiles(*(place.geometry.extent for place in updated))
+
+                checked += len(places)
+                recomputed += len(updated)
+                last_pk = places[-1].pk
+                cache.set(checkpoint, last_pk, None)
+                self.stdout.write(f"checked {checked}, recomputed {recomputed}")
+
+        # bulk_update не вызывает post_save, поэтому кеш /places (и тайлы выше) обновляем сами
+        invalidate_places(*type_ids)
+        cache.delete(checkpoint)
+        self.stdout.write(f"done: checked {checked}, recomputed {recomputed}")
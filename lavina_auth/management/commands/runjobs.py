@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from lavina_auth.jobs import work
+from lavina_auth import tasks  # noqa: регистрирует обработчики задач
+from lavina_server.settings import JOB_POLL_INTERVAL
+
+class Command(BaseCommand):
+    help = "Runs background jobs from the database queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="exit when the queue is empty instead of polling")
+        parser.add_argument('--poll-interval', type=float, default=JOB_POLL_INTERVAL,
+                            help="seconds to wait before checking an empty queue again")
+
+    def handle(self, *args, **options):
+        count = work(options['poll_interval'], once=options['once'])
+        self.stdout.write(f"completed {count} jobs")
@@ -0,0 +1,175 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import ExitStack
+from django.db import connections
+
+# метрики процесса в текстовом формате Prometheus (отдаются на /metrics):
+# время ответа по маршрутам, запросы к БД, чтение карты высот, шаги трассировки.
+# значения хранятся в памяти воркера: при нескольких воркерах gunicorn
+# каждый запрос /metrics отдает счетчики того воркера, который его обработал
+# формат: https://prometheus.io/docs/instrumenting/exposition_formats/
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TRACE_STEP_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 999, 1000)
+
+
+def escape_label_value(value):
+    # экранирование значения метки в текстовом формате Prometheus: \\, \" и \n
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"'
+                          for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # значения меток -> [счетчики по корзинам + корзина +Inf, сумма]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    labels = format_labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REGISTRY = []
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+def render():
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+request_duration = register(Histogram(
+    'lavina_http_request_duration_seconds', 'Request latency by route.',
+    ('route', 'method', 'status')))
+db_queries = register(Counter(
+    'lavina_db_queries_total', 'Database queries executed by route.', ('route',)))
+db_query_duration = register(Counter(
+    'lavina_db_query_duration_seconds_total', 'Time spent in database queries by route.', ('route',)))
+dem_read_calls = register(Counter(
+    'lavina_dem_read_calls_total', 'Height map reads by source (hgt, geotiff).', ('source',)))
+dem_read_bytes = register(Counter(
+    'lavina_dem_read_bytes_total', 'Height map bytes read by source (hgt, geotiff).', ('source',)))
+trace_steps = register(Histogram(
+    'lavina_trace_steps', 'Steps per traced avalanche path.', ('status',), TRACE_STEP_BUCKETS))
+
+def record_dem_read(source, data):
+    """Учитывает чтение массива data из карты высот source ('hgt' или 'geotiff')"""
+    dem_read_calls.inc(1, source)
+    dem_read_bytes.inc(data.nbytes, source)
+    return data
+
+def record_trace(steps, status):
+    trace_steps.observe(steps, str(status))
+
+
+class QueryStats:
+    """execute_wrapper: считает запросы к БД и время их выполнения"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def count_streamed_queries(content, route):
+    """Оборачивает содержимое потокового ответа: запросы к БД, выполняемые
+    при его отправке (уже после MetricsMiddleware), учитываются для route
+    """
+    queries = QueryStats()
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            yield from content
+    finally:
+        db_queries.inc(queries.count, route)
+        db_query_duration.inc(queries.duration, route)
+
+
+class MetricsMiddleware:
+    """Замеряет время ответа и запросы к БД для каждого запроса.
+    Маршрут берется из шаблона URL (например places/<pk>), а не из пути,
+    чтобы количество рядов метрик не росло с количеством объектов.
+    Для потоковых ответов учитываются и запросы во время отправки (count_streamed_queries)
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryStats()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(queries))
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+        request_duration.observe(time.perf_counter() - start,
+                                 route, request.method, response.status_code)
+        db_queries.inc(queries.count, route)
+        db_query_duration.inc(queries.duration, route)
+        if response.streaming:
+            response.streaming_content = count_streamed_queries(response.streaming_content, route)
+        return response
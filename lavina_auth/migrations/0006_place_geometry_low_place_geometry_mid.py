@@ -0,0 +1,37 @@
+# Generated by Django 4.0.2 on 2026-10-18 12:00
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+# копия models.SIMPLIFIED_GEOMETRIES на момент миграции: (поле, допуск упрощения)
+SIMPLIFIED_GEOMETRIES = (('geometry_low', 0.0014),
+                         ('geometry_mid', 0.00017))
+
+
+def fill_simplified_geometries(apps, schema_editor):
+    Place = apps.get_model('lavina_auth', 'Place')
+    for place in Place.objects.all().iterator():
+        for field, tolerance in SIMPLIFIED_GEOMETRIES:
+            setattr(place, field, place.geometry.simplify(tolerance, preserve_topology=True))
+        place.save(update_fields=[field for field, _ in SIMPLIFIED_GEOMETRIES])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lavina_auth', '0005_remove_place_relief_map'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='geometry_low',
+            field=django.contrib.gis.db.models.fields.GeometryField(blank=True, null=True, srid=4326),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='geometry_mid',
+            field=django.contrib.gis.db.models.fields.GeometryField(blank=True, null=True, srid=4326),
+        ),
+        migrations.RunPython(fill_simplified_geometries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lavina_auth', '0007_job_place_elevation_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='place',
+            name='dem_version',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='place',
+            name='geometry_hash',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
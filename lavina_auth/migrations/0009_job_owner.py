@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 20:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('lavina_auth', '0008_place_dem_version_place_geometry_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,15 +1,82 @@
 from django.contrib.gis.db import models as gis_models
 from django.contrib.auth.models import User
-from django.db import models
-from .elevation_basic import get_relief
+from django.db import models, transaction
+from lavina_server.settings import PLACE_ELEVATION_ASYNC
+import hashlib
+from .elevation_basic import get_heighest_point, get_catalog
+from .zonal import zonal_stats, rings_extent
 from django.contrib.gis.geos import Point
 
+# упрощенные геометрии мест для мелких масштабов карты:
+# (максимальный zoom, поле, допуск упрощения в градусах)
+# допуск - примерно размер пикселя тайла 256px на максимальном zoom полосы
+SIMPLIFIED_GEOMETRIES = ((10, 'geometry_low', 0.0014),
+                         (13, 'geometry_mid', 0.00017))
+
+def geometry_field_for_zoom(zoom):
+    """Возвращает имя поля с геометрией, подходящей для масштаба zoom"""
+    for max_zoom, field, _ in SIMPLIFIED_GEOMETRIES:
+        if zoom is not None and zoom <= max_zoom:
+            return field
+    return 'geometry'
+
+def simplify_geometry(geometry, tolerance):
+    return geometry.simplify(tolerance, preserve_topology=True)
+
+def heighest_point_in(rings):
+    """Наивысшая точка полигона: {'elevation': ..., 'coords': (lat, lng)}
+    или None, если под полигоном нет данных DEM.
+    Принимает кольца (последовательности (lat, lng)), а не GEOS геометрию,
+    чтобы ее можно было вызывать в дочерних процессах (см. manage.py importplaces)
+    """
+    # наивысшая точка ищется только среди отсчетов внутри полигона,
+    # для полигонов меньше ячейки DEM - в ограничивающем прямоугольнике
+    return zonal_stats(rings)['heighest'] or get_heighest_point(rings_extent(rings))
+
+def geometry_key(geometry):
+    return None if geometry is None else bytes(geometry.ewkb)
+
+def geometry_hash(geometry):
+    return hashlib.sha1(geometry_key(geometry)).hexdigest()
+
+def dem_fingerprint(geometry):
+    """Отпечаток данных DEM, по которым считаются высоты места (см. TileCatalog.fingerprint)"""
+    return get_catalog().fingerprint(geometry.extent)
+
 class PlaceType(models.Model):
     type = models.CharField(max_length=20)
 
     def __str__(self) -> str:
         return self.type
 
+class Job(models.Model):
+    """Фоновая задача в очереди на базе БД (выполняется manage.py runjobs, см. jobs.py)"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, 'pending'), (RUNNING, 'running'), (DONE, 'done'), (FAILED, 'failed'))
+
+    task = models.CharField(max_length=50)
+    args = models.JSONField(default=dict)
+    # пользователь, которому виден статус задачи в /jobs/<pk> (кроме персонала)
+    owner = models.ForeignKey(User, blank=True, null=True, on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+    result = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def enqueue(cls, task, owner=None, **args):
+        """Ставит задачу в очередь. Внутри транзакции воркер увидит задачу только после коммита"""
+        return cls.objects.create(task=task, owner=owner, args=args)
+
+    def __str__(self) -> str:
+        return f"{self.task} #{self.pk} {self.status}"
+
 class Place(models.Model):
     name = models.CharField(max_length=50)
     owner = models.ForeignKey(User, on_delete=models.RESTRICT)
@@ -17,13 +84,66 @@ class Place(models.Model):
     geometry = gis_models.PolygonField()
     heighest_point = gis_models.PointField(blank=True, null=True)
     heighest_elevation = models.IntegerField(blank=True, null=True)
+    geometry_low = gis_models.GeometryField(blank=True, null=True)
+    geometry_mid = gis_models.GeometryField(blank=True, null=True)
+    # отпечатки DEM и геометрии, по которым посчитаны высоты (см. manage.py recomputeplaces)
+    dem_version = models.CharField(max_length=40, blank=True, default='')
+    geometry_hash = models.CharField(max_length=40, blank=True, default='')
+    # последняя задача расчета наивысшей точки (см. tasks.place_elevation)
+    elevation_job = models.ForeignKey('Job', blank=True, null=True,
+                                      on_delete=models.SET_NULL, related_name='+')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # запоминаем загруженную геометрию, чтобы не пересчитывать высоты,
+        # если при сохранении она не поменялась
+        if 'geometry' in field_names:
+            instance._loaded_geometry = geometry_key(values[field_names.index('geometry')])
+        return instance
+
+    def geometry_changed(self):
+        return self.pk is None or \
+               getattr(self, '_loaded_geometry', None) != geometry_key(self.geometry)
+
+    def refresh_simplified_geometries(self):
+        for _, field, tolerance in SIMPLIFIED_GEOMETRIES:
+            setattr(self, field, simplify_geometry(self.geometry, tolerance))
 
+    def refresh_elevation(self):
+        heighest = heighest_point_in([ring.coords for ring in self.geometry])
+        # под местом может не быть данных DEM - тогда высоты неизвестны
+        self.heighest_elevation = heighest["elevation"] if heighest else None
+        self.heighest_point = Point(heighest["coords"][0], heighest["coords"][1]) if heighest else None
+        self.dem_version = dem_fingerprint(self.geometry)
+        self.geometry_hash = geometry_hash(self.geometry)
 
     def save(self, *args, **kwargs):
-        relief = get_relief(self.geometry.extent)
-        self.heighest_elevation = relief[0]["elevation"]
-        self.heighest_point = Point(relief[0]["coords"][0], relief[0]["coords"][1])
-        super(Place, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        changed = (update_fields is None or 'geometry' in update_fields) and self.geometry_changed()
+        if changed:
+            self.refresh_simplified_geometries()
+            if PLACE_ELEVATION_ASYNC:
+                # высоты посчитает воркер (manage.py runjobs), до этого они неизвестны
+                self.heighest_elevation = None
+                self.heighest_point = None
+                self.dem_version = ''
+                self.geometry_hash = ''
+            else:
+                self.refresh_elevation()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | \
+                    {field for _, field, _ in SIMPLIFIED_GEOMETRIES} | \
+                    {'heighest_elevation', 'heighest_point', 'dem_version', 'geometry_hash'}
+        # место и задача расчета его высот сохраняются в одной транзакции:
+        # иначе при сбое между ними осталось бы место без высот и без задачи
+        with transaction.atomic():
+            super(Place, self).save(*args, **kwargs)
+            if changed and PLACE_ELEVATION_ASYNC:
+                self.elevation_job = Job.enqueue('place_elevation', owner=self.owner, place_id=self.pk)
+                Place.objects.filter(pk=self.pk).update(elevation_job=self.elevation_job)
+        if changed:
+            self._loaded_geometry = geometry_key(self.geometry)
 
 
     def __str__(self) -> str:
@@ -0,0 +1,51 @@
+from math import cos, radians, pi
+from django.contrib.gis.db.models.functions import GeoFunc, Distance, GeometryDistance
+from django.contrib.gis.geos import Point
+from .terrain import EARTH_RADIUS
+
+# поиск мест, содержащих точку, и ближайших к ней мест через индекс GiST по Place.geometry.
+# NOTE: геометрии хранятся в порядке leaflet (x = широта, y = долгота), поэтому:
+#   - для contains и <-> точка задается в том же порядке (широта, долгота);
+#   - расстояние в метрах считается по ST_FlipCoordinates(geometry) - в нормальном порядке.
+# <-> (KNN) сортирует по расстоянию в градусах, где градус долготы на широте φ в 1/cos φ раз
+# "длиннее" настоящего, поэтому кандидаты берутся с запасом, пока не станет ясно,
+# что непрочитанные места заведомо дальше найденных
+
+METERS_PER_DEGREE = EARTH_RADIUS * pi / 180
+# во сколько раз больше кандидатов, чем нужно мест, запрашивается за раз
+CANDIDATE_FACTOR = 4
+
+
+class FlipCoordinates(GeoFunc):
+    function = 'ST_FlipCoordinates'
+
+
+def containing(queryset, lat, lng):
+    """Места из queryset, внутри которых находится точка (lat, lng)"""
+    return queryset.filter(geometry__contains=Point(lat, lng, srid=4326))
+
+def nearest(queryset, lat, lng, k, radius):
+    """k ближайших к точке мест из queryset не дальше radius метров.
+
+    Returns:
+        list: места по возрастанию расстояния, у каждого атрибут distance (Distance, м)
+    """
+    queryset = queryset.annotate(
+        planar=GeometryDistance('geometry', Point(lat, lng, srid=4326)),
+        distance=Distance(FlipCoordinates('geometry'), Point(lng, lat, srid=4326))).order_by('planar')
+    # нижняя граница метров в "градусе" расстояния <-> для мест не дальше radius:
+    # они лежат не дальше |lat| + radius по широте, а там градус долготы самый короткий
+    max_lat = min(abs(lat) + radius / METERS_PER_DEGREE, 90)
+    meters_per_degree = cos(radians(max_lat)) * METERS_PER_DEGREE
+    limit = k * CANDIDATE_FACTOR
+    while True:
+        candidates = list(queryset[:limit])
+        found = sorted((place for place in candidates if place.distance.m <= radius),
+                       key=lambda place: place.distance.m)[:k]
+        if len(candidates) < limit:
+            return found
+        # любое непрочитанное место не ближе bound метров
+        bound = candidates[-1].planar * meters_per_degree
+        if bound > radius or (len(found) == k and found[-1].distance.m <= bound):
+            return found
+        limit *= CANDIDATE_FACTOR
@@ -0,0 +1,63 @@
+import time
+import uuid
+import hashlib
+from django.core.cache import caches
+from rest_framework.renderers import JSONRenderer
+from lavina_server.settings import PLACES_CACHE
+from .models import Place, SIMPLIFIED_GEOMETRIES
+from .serializers import PlaceSerializer
+
+# готовые ответы /places?type_id=... в кеше Django.
+# места меняются редко (только администраторами), а читаются каждым посетителем карты,
+# поэтому ответ для каждого type_id рендерится один раз и хранится до сохранения/удаления
+# места или типа места (см. signals.py). у каждого type_id есть поколение (случайная метка
+# в кеше), входящее в ключ ответа; изменение мест меняет поколение, а новый ответ строится
+# при первом запросе. поколение читается до запроса к БД, поэтому ответ, построенный
+# по данным до коммита, попадает под старый ключ и больше не читается (как в places_tiles.py)
+
+GENERATION_KEY = "places:generation:{}"
+KEY = "places:{}:{}:{}"
+# для каждого type_id хранится по ответу на каждую полосу масштабов
+GEOMETRY_FIELDS = ('geometry',) + tuple(field for _, field, _ in SIMPLIFIED_GEOMETRIES)
+
+def render_places(type_id, geometry_field='geometry'):
+    """Рендерит список мест типа type_id так же, как ListCreatePlacesView
+
+    Args:
+        type_id (int): тип места
+        geometry_field (str): поле с геометрией (полная или упрощенная)
+
+    Returns:
+        dict: {'content': JSON (bytes), 'etag': ETag, 'last_modified': время (unix)}
+    """
+    places = Place.objects.filter(place_type=type_id) \
+        .defer(*(field for field in GEOMETRY_FIELDS if field != geometry_field))
+    content = JSONRenderer().render(
+        PlaceSerializer(places, many=True, context={'geometry_field': geometry_field}).data)
+    return {'content': content,
+            'etag': '"%s"' % hashlib.sha1(content).hexdigest(),
+            'last_modified': int(time.time())}
+
+def new_generation():
+    return uuid.uuid4().hex[:16]
+
+def generation(type_id):
+    # если метки нет (еще не было или вытеснена) - новая, которой нет ни в одном ключе
+    return caches[PLACES_CACHE].get_or_set(GENERATION_KEY.format(type_id), new_generation, None)
+
+def invalidate_places(*type_ids):
+    """Сбрасывает ответы для type_ids (все полосы масштабов) сменой поколения.
+    Старые ответы остаются в кеше, пока не будут вытеснены
+    """
+    caches[PLACES_CACHE].set_many({GENERATION_KEY.format(type_id): new_generation()
+                                   for type_id in set(type_ids)}, None)
+
+def get_places(type_id, geometry_field='geometry'):
+    """Возвращает ответ для type_id из кеша, при отсутствии - строит его"""
+    # поколение - до запроса к БД (см. комментарий в начале модуля)
+    key = KEY.format(type_id, generation(type_id), geometry_field)
+    entry = caches[PLACES_CACHE].get(key)
+    if entry is None:
+        entry = render_places(type_id, geometry_field)
+        caches[PLACES_CACHE].set(key, entry, None)
+    return entry
@@ -0,0 +1,80 @@
+from django.db import connection
+from .models import Place
+
+# быстрая выгрузка мест в GeoJSON FeatureCollection:
+# JSON каждого объекта строит PostGIS (json_build_object + ST_AsGeoJSON),
+# строки читаются серверным курсором пачками и сразу отправляются клиенту (stream_features),
+# поэтому память не зависит от количества и детальности полигонов.
+# NOTE: под ASGI Django 4.0 перебирает StreamingHttpResponse в цикле событий,
+# где обращения к БД запрещены (SynchronousOnlyOperation). поэтому там выгрузка
+# целиком пишется в файл внутри представления (write_features), и отправляется уже готовый файл
+
+# пачка строк, читаемая из курсора за раз
+CHUNK_SIZE = 500
+# знаков после запятой в координатах (6 знаков - около 10 см)
+COORDINATE_DIGITS = 6
+
+def column(field):
+    return connection.ops.quote_name(Place._meta.get_field(field).column)
+
+def features_query(type_id, bbox=None, geometry_field='geometry'):
+    """SQL запрос, возвращающий по одному Feature (текст JSON) на место
+
+    Args:
+        type_id (int): тип места
+        bbox (Polygon): видимая область или None
+        geometry_field (str): поле с геометрией (полная или упрощенная)
+
+    Returns:
+        tuple: (sql, параметры)
+    """
+    geometry = column('geometry')
+    if geometry_field != 'geometry':
+        geometry = f"COALESCE({column(geometry_field)}, {geometry})"
+    sql = f"""
+        SELECT json_build_object(
+            'type', 'Feature',
+            'id', {column('id')},
+            'geometry', ST_AsGeoJSON({geometry}, %s)::json,
+            'properties', json_build_object(
+                'name', {column('name')},
+                'owner', {column('owner')},
+                'place_type', {column('place_type')},
+                'heighest_elevation', {column('heighest_elevation')},
+                'heighest_point', ST_AsGeoJSON({column('heighest_point')}, %s)::json
+            )
+        )::text
+        FROM {connection.ops.quote_name(Place._meta.db_table)}
+        WHERE {column('place_type')} = %s
+    """
+    params = [COORDINATE_DIGITS, COORDINATE_DIGITS, type_id]
+    if bbox is not None:
+        # ST_Intersects использует пространственный индекс по geometry
+        sql += f" AND ST_Intersects({column('geometry')}, ST_GeomFromEWKT(%s))"
+        params.append(bbox.ewkt)
+    sql += f" ORDER BY {column('id')}"
+    return sql, params
+
+def stream_features(type_id, bbox=None, geometry_field='geometry'):
+    """Генератор частей ответа FeatureCollection для StreamingHttpResponse"""
+    sql, params = features_query(type_id, bbox, geometry_field)
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    # chunked_cursor - серверный (именованный) курсор PostgreSQL
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(CHUNK_SIZE)
+            if not rows:
+                break
+            yield separator + ','.join(row[0] for row in rows)
+            separator = ','
+    yield ']}'
+
+def write_features(file, type_id, bbox=None, geometry_field='geometry'):
+    """Пишет FeatureCollection в двоичный файл file (UTF-8).
+
+    Returns:
+        int: количество записанных байт
+    """
+    return sum(file.write(part.encode()) for part in stream_features(type_id, bbox, geometry_field))
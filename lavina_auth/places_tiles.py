@@ -0,0 +1,137 @@
+import uuid
+import hashlib
+from django.core.cache import caches
+from django.db import connection
+from django.contrib.gis.geos import Polygon
+from lavina_server.settings import PLACES_TILE_CACHE, PLACES_TILE_MAX_ZOOM, PLACES_TILE_INVALIDATE_LIMIT
+from .models import Place, geometry_field_for_zoom
+from .places_export import column
+from .slope_tiles import tile_range
+from .terrain_tiles import tile_bounds
+
+# векторные тайлы мест (Mapbox Vector Tile) для /places/tiles/<z>/<x>/<y>.pbf.
+# тайл целиком строит PostGIS (ST_AsMVTGeom + ST_AsMVT): геометрия переводится
+# в web mercator, обрезается по тайлу и квантуется в сетку EXTENT x EXTENT,
+# для мелких масштабов берутся упрощенные геометрии (см. models.geometry_field_for_zoom).
+# NOTE: геометрии хранятся в порядке leaflet (x = широта), поэтому перед ST_Transform - ST_FlipCoordinates.
+# готовые тайлы хранятся в кеше Django. у каждого тайла есть поколение (случайная метка в кеше),
+# входящее в ключ тайла; при сохранении/удалении места (см. signals.py) поколение меняется
+# у всех тайлов, которые пересекает старая или новая геометрия (с запасом BUFFER).
+# просто удалять тайлы нельзя: запрос, прочитавший места до коммита, мог бы положить
+# устаревший тайл уже после удаления. поколение читается до построения тайла, поэтому
+# такой тайл попадает под старый ключ, который больше не читается.
+# если тайлов слишком много (большой полигон, импорт), сбрасываются сразу все тайлы сменой версии.
+# версия, как и поколение, - случайная метка, а не счетчик: если ее вытеснит кеш,
+# новая метка не совпадет ни с одним старым ключом, и устаревшие тайлы не оживут
+
+LAYER = "places"
+# размер сетки тайла и запас вокруг тайла в ее единицах (чтобы не было швов на границах)
+EXTENT = 4096
+BUFFER = 64
+VERSION_KEY = "place_tiles:version"
+GENERATION_KEY = "place_tiles:generation:{}:{}:{}"
+KEY = "place_tiles:{}:{}:{}:{}:{}"
+# широта края карты в web mercator
+MAX_LATITUDE = 85.0511287798
+
+def cache():
+    return caches[PLACES_TILE_CACHE]
+
+def new_token():
+    return uuid.uuid4().hex[:16]
+
+def version():
+    return cache().get_or_set(VERSION_KEY, new_token, None)
+
+def generation(z, x, y):
+    # если метки нет (еще не было или вытеснена) - новая, которой нет ни в одном ключе
+    return cache().get_or_set(GENERATION_KEY.format(z, x, y), new_token, None)
+
+def search_bbox(z, x, y):
+    """Область тайла с запасом BUFFER для поиска по индексу, в порядке хранения геометрий"""
+    lat_min, lng_min, lat_max, lng_max = tile_bounds(z, x, y)
+    d_lat = (lat_max - lat_min) * BUFFER / EXTENT
+    d_lng = (lng_max - lng_min) * BUFFER / EXTENT
+    polygon = Polygon.from_bbox((lat_min - d_lat, lng_min - d_lng, lat_max + d_lat, lng_max + d_lng))
+    polygon.srid = 4326
+    return polygon
+
+def tile_query(z, x, y):
+    """SQL запрос, возвращающий тайл MVT (bytea) с атрибутами name, place_type, heighest_elevation
+
+    Returns:
+        tuple: (sql, параметры)
+    """
+    geometry = column('geometry')
+    geometry_field = geometry_field_for_zoom(z)
+    source = geometry if geometry_field == 'geometry' else f"COALESCE({column(geometry_field)}, {geometry})"
+    sql = f"""
+        SELECT ST_AsMVT(tile, %s, %s, 'geom', 'id') FROM (
+            SELECT {column('id')} AS id,
+                   {column('name')} AS name,
+                   {column('place_type')} AS place_type,
+                   {column('heighest_elevation')} AS heighest_elevation,
+                   ST_AsMVTGeom(ST_Transform(ST_FlipCoordinates({source}), 3857),
+                                ST_TileEnvelope(%s, %s, %s), %s, %s) AS geom
+            FROM {connection.ops.quote_name(Place._meta.db_table)}
+            WHERE {geometry} && ST_GeomFromEWKT(%s)
+        ) AS tile
+        WHERE geom IS NOT NULL
+    """
+    return sql, [LAYER, EXTENT, z, x, y, EXTENT, BUFFER, search_bbox(z, x, y).ewkt]
+
+def render_tile(z, x, y):
+    """Строит тайл. Returns: dict {'content': MVT (bytes), 'etag': ETag}"""
+    with connection.cursor() as cursor:
+        cursor.execute(*tile_query(z, x, y))
+        content = bytes(cursor.fetchone()[0] or b'')
+    return {'content': content, 'etag': '"%s"' % hashlib.sha1(content).hexdigest()}
+
+def get_tile(z, x, y):
+    """Возвращает тайл из кеша, при отсутствии - строит его"""
+    # поколение - до запроса к БД (см. комментарий в начале модуля)
+    key = KEY.format(version(), z, x, y, generation(z, x, y))
+    entry = cache().get(key)
+    if entry is None:
+        entry = render_tile(z, x, y)
+        cache().set(key, entry, None)
+    return entry
+
+def buffered_range(extent, z):
+    """Диапазоны x и y тайлов уровня z, в которые попадает extent с учетом запаса BUFFER:
+    место рядом с границей тайла есть и в соседнем тайле (см. search_bbox)
+    """
+    # высота тайла в градусах широты не больше ширины, поэтому запас по ширине тайла берется с избытком
+    margin = 360 / 2 ** z * BUFFER / EXTENT
+    lat_min, lng_min, lat_max, lng_max = extent
+    return tile_range((max(lat_min - margin, -MAX_LATITUDE), max(lng_min - margin, -180),
+                       min(lat_max + margin, MAX_LATITUDE), min(lng_max + margin, 180)), z)
+
+def tiles_for(extent):
+    """Тайлы всех масштабов, пересекающие extent (широта_мин, долгота_мин, широта_макс, долгота_макс)"""
+    for z in range(PLACES_TILE_MAX_ZOOM + 1):
+        (x_min, x_max), (y_min, y_max) = buffered_range(extent, z)
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                yield z, x, y
+
+def tile_count(extent):
+    count = 0
+    for z in range(PLACES_TILE_MAX_ZOOM + 1):
+        (x_min, x_max), (y_min, y_max) = buffered_range(extent, z)
+        count += (x_max - x_min + 1) * (y_max - y_min + 1)
+    return count
+
+def invalidate_tiles(*extents):
+    """Сбрасывает тайлы, пересекающие extents (геометрии мест до и после изменения),
+    сменой их поколения. старые тайлы остаются в кеше, пока не будут вытеснены
+    """
+    if sum(tile_count(extent) for extent in extents) > PLACES_TILE_INVALIDATE_LIMIT:
+        invalidate_all()
+        return
+    tiles = {tile for extent in extents for tile in tiles_for(extent)}
+    cache().set_many({GENERATION_KEY.format(*tile): new_token() for tile in tiles}, None)
+
+def invalidate_all():
+    # старые тайлы не удаляем - к ним больше не обращаются, и они вытесняются кешем
+    cache().set(VERSION_KEY, new_token(), None)
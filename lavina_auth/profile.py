@@ -0,0 +1,99 @@
+import numpy as np
+from .elevation_basic import get_catalog, VOID_DATA
+from .terrain import EARTH_RADIUS
+
+# высоты в произвольных точках и профиль высот вдоль линии (маршрута).
+# все точки обрабатываются за один проход по мозаике HGT (TileCatalog.sample),
+# высота между отсчетами - билинейная интерполяция по 4 соседним отсчетам
+
+def bilinear(lats, lngs, catalog=None):
+    """Интерполированные высоты в точках (lats, lngs).
+
+    Args:
+        lats, lngs (numpy.ndarray): координаты точек (1D)
+        catalog (TileCatalog): мозаика, по умолчанию get_catalog()
+
+    Returns:
+        numpy.ndarray: float64 высоты, NaN - нет данных.
+                       если у точки не хватает части соседних отсчетов,
+                       берется ближайший из имеющихся
+    """
+    catalog = catalog or get_catalog()
+    pd = catalog.per_degree
+    rows = (90 - np.asarray(lats, dtype=np.float64)) * pd
+    cols = (np.asarray(lngs, dtype=np.float64) + 180) * pd
+    top, left = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+    dr, dc = rows - top, cols - left
+    # отсчеты (верх-лево, верх-право, низ-лево, низ-право) одним вызовом
+    corners = catalog.sample(np.stack((top, top, top + 1, top + 1)),
+                             np.stack((left, left + 1, left, left + 1))).astype(np.float64)
+    corners[corners == VOID_DATA] = np.nan
+    weights = np.stack(((1 - dr) * (1 - dc), (1 - dr) * dc, dr * (1 - dc), dr * dc))
+    result = (corners * weights).sum(axis=0)
+
+    partial = np.isnan(result) & ~np.isnan(corners).all(axis=0)
+    if partial.any():
+        # ближайший отсчет с данными: с наибольшим весом
+        masked = np.where(np.isnan(corners[:, partial]), -1, weights[:, partial])
+        nearest = np.argmax(masked, axis=0)
+        result[partial] = corners[:, partial][nearest, np.arange(nearest.size)]
+    return result
+
+def distances_meters(lats, lngs):
+    """Расстояния (м, по большому кругу) между соседними точками: массив длины n - 1"""
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = np.sin(np.diff(lats) / 2) ** 2 + \
+        np.cos(lats[:-1]) * np.cos(lats[1:]) * np.sin(np.diff(lngs) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+def densify(lats, lngs, step):
+    """Точки вдоль ломаной через каждые step метров (вершины ломаной тоже входят).
+
+    Returns:
+        tuple: (широты, долготы, расстояния от начала в метрах)
+    """
+    vertex_distances = np.concatenate(([0], np.cumsum(distances_meters(lats, lngs))))
+    distances = np.union1d(np.arange(0, vertex_distances[-1], step), vertex_distances)
+    # в пределах отрезка координаты меняются линейно (отрезки короткие)
+    return (np.interp(distances, vertex_distances, lats),
+            np.interp(distances, vertex_distances, lngs),
+            distances)
+
+def sample_count(points, step):
+    """Сколько точек вернет profile(points, step) - для проверки размера запроса"""
+    if step is None:
+        return len(points)
+    points = np.asarray(points, dtype=np.float64)
+    length = distances_meters(points[:, 0], points[:, 1]).sum()
+    return int(length // step) + len(points)
+
+def profile(points, step=None):
+    """Высоты в точках или профиль вдоль ломаной.
+
+    Args:
+        points (list): [(lat, lng), ...] - точки или вершины ломаной
+        step (float): шаг по линии в метрах. None - только сами точки
+
+    Returns:
+        dict: {'lats', 'lngs': координаты точек, 'distances': расстояние от начала (м),
+               'elevations': высоты (None - нет данных),
+               'length': длина (м), 'ascent', 'descent': суммарный набор и сброс высоты (м),
+               'min', 'max': крайние высоты}
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    lats, lngs = points[:, 0], points[:, 1]
+    if step is None:
+        distances = np.concatenate(([0], np.cumsum(distances_meters(lats, lngs))))
+    else:
+        lats, lngs, distances = densify(lats, lngs, step)
+    elevations = bilinear(lats, lngs)
+
+    valid = elevations[~np.isnan(elevations)]
+    deltas = np.diff(valid)
+    return {'lats': lats.tolist(), 'lngs': lngs.tolist(), 'distances': distances.tolist(),
+            'elevations': [None if np.isnan(val) else float(val) for val in elevations],
+            'length': float(distances[-1]),
+            'ascent': float(deltas[deltas > 0].sum()),
+            'descent': float(-deltas[deltas < 0].sum()),
+            'min': float(valid.min()) if valid.size else None,
+            'max': float(valid.max()) if valid.size else None}
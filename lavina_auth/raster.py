@@ -0,0 +1,148 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+from django.contrib.gis.gdal import GDALRaster
+from lavina_server.settings import DEM_CHECKSUM_INTERVAL
+from .metrics import record_dem_read
+
+# общие для процесса открытые растры GDAL:
+# открыть GeoTiff и разобрать его метаданные - заметная фиксированная стоимость,
+# поэтому растр открывается один раз и переоткрывается, только если файл изменился
+
+
+class AffineTransform:
+    """Преобразование индексов ячеек в координаты и обратно по геотрансформации GDAL.
+    Работает как с числами, так и с numpy массивами (все точки за один вызов).
+    NOTE: координаты в порядке leaflet - (широта, долгота), индексы - (строка, столбец)
+    NOTE: как принято в GDAL (pixel-is-area), геотрансформация задает угол ячейки,
+    а координаты ячейки - это ее центр, на полшага правее и ниже. так же, как в HGT,
+    координаты ячейки - точка отсчета, поэтому GeoTiff из buildheightmap и мозаика HGT
+    дают одни и те же точки
+    """
+
+    def __init__(self, geotransform):
+        self.geotransform = tuple(geotransform)
+        gt = self.geotransform
+        # долгота = gt[0] + столбец * gt[1] + строка * gt[2]
+        # широта  = gt[3] + столбец * gt[4] + строка * gt[5]
+        det = gt[1] * gt[5] - gt[2] * gt[4]
+        self._inverse = (gt[5] / det, -gt[2] / det, -gt[4] / det, gt[1] / det)
+
+    @property
+    def cell_size(self):
+        """(шаг по широте, шаг по долготе) в градусах для растров без поворота"""
+        return -self.geotransform[5], self.geotransform[1]
+
+    def to_geo(self, rows, cols):
+        """Индексы -> (широты, долготы) центров ячеек"""
+        gt = self.geotransform
+        rows, cols = np.add(rows, 0.5), np.add(cols, 0.5)
+        return gt[3] + cols * gt[4] + rows * gt[5], gt[0] + cols * gt[1] + rows * gt[2]
+
+    def to_index(self, lats, lngs):
+        """(широты, долготы) -> индексы ячеек, в которые попадают точки (строки, столбцы)"""
+        gt, inv = self.geotransform, self._inverse
+        d_lng, d_lat = np.subtract(lngs, gt[0]), np.subtract(lats, gt[3])
+        cols = np.floor(inv[0] * d_lng + inv[1] * d_lat).astype(np.int64)
+        rows = np.floor(inv[2] * d_lng + inv[3] * d_lat).astype(np.int64)
+        if rows.ndim == 0:
+            return int(rows), int(cols)
+        return rows, cols
+
+
+def file_signature(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+def file_checksum(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RasterHandle:
+    """Открытый растр с заранее посчитанными метаданными.
+    Чтение через read() сериализуется блокировкой:
+    один набор данных GDAL нельзя читать из нескольких потоков одновременно.
+
+    Атрибуты:
+        filename (str): путь к файлу
+        raster (GDALRaster): растр
+        transform (AffineTransform): преобразование индексы <-> координаты
+        extent (tuple): (xmin, ymin, xmax, ymax) как GDALRaster.extent
+        width, height (int): размеры первого канала
+        nodata: значение nodata первого канала
+        checksum (str): sha1 содержимого файла (считается при первом обращении)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.signature = file_signature(filename)
+        self.checked_at = time.monotonic()
+        self._checksum = None
+        self._checksum_lock = threading.Lock()
+        self.raster = GDALRaster(filename, write=False)
+        band = self.raster.bands[0]
+        self.transform = AffineTransform(self.raster.geotransform)
+        self.extent = tuple(self.raster.extent)
+        self.width, self.height = band.width, band.height
+        self.nodata = band.nodata_value
+        self._lock = threading.Lock()
+
+    def read(self, offset=None, size=None):
+        """Читает область первого канала (как GDALBand.data), возвращает numpy массив (строки, столбцы)"""
+        with self._lock:
+            band = self.raster.bands[0]
+            if offset is None:
+                return record_dem_read('geotiff', band.data())
+            return record_dem_read('geotiff', band.data(offset=offset, size=size))
+
+    @property
+    def checksum(self):
+        # чтение всего файла - только для тех, кому нужна сумма (ключи кеша путей),
+        # и под собственной блокировкой, а не общей _handles_lock
+        if self._checksum is None:
+            with self._checksum_lock:
+                if self._checksum is None:
+                    self._checksum = file_checksum(self.filename)
+        return self._checksum
+
+    def is_stale(self):
+        """Изменился ли файл по размеру/времени изменения (дешевая проверка при каждом обращении)"""
+        return file_signature(self.filename) != self.signature
+
+    def checksum_due(self):
+        """Пора ли сверить контрольную сумму (не чаще раза в DEM_CHECKSUM_INTERVAL секунд).
+        Вызывается под _handles_lock, поэтому сверку начинает только один поток
+        """
+        if self._checksum is None or time.monotonic() - self.checked_at < DEM_CHECKSUM_INTERVAL:
+            return False
+        self.checked_at = time.monotonic()
+        return True
+
+
+_handles = {}
+_handles_lock = threading.Lock()
+
+def get_raster(filename):
+    """Возвращает общий для процесса RasterHandle для filename,
+    переоткрывая растр, если файл изменился
+    """
+    with _handles_lock:
+        handle = _handles.get(filename)
+        if handle is None or handle.is_stale():
+            handle = RasterHandle(filename)
+            _handles[filename] = handle
+            return handle
+        verify = handle.checksum_due()
+    # сумма всего файла считается без общей блокировки - остальные читатели ее не ждут
+    if verify and file_checksum(filename) != handle.checksum:
+        with _handles_lock:
+            if _handles.get(filename) is handle:
+                _handles[filename] = RasterHandle(filename)
+            return _handles[filename]
+    return handle
@@ -0,0 +1,236 @@
+import heapq
+from time import monotonic
+from collections import deque
+import numpy as np
+from .grid import GeoGrid
+from .terrain import D8_OFFSETS, cell_size_meters, d8_distances
+from .zonal import polygon_mask, rings_extent
+
+# моделирование выноса лавины из зоны зарождения на сетке DEM.
+# в отличие от trace_path (одна частица по направлению наибольшего спуска),
+# масса распределяется по ячейкам и переносится между соседями целиком массивами на каждом шаге:
+#   - рельеф предварительно "заливается" (priority-flood), чтобы в мелких ямах DEM
+#     поток не застревал, а проходил их по слабому уклону epsilon;
+#   - ускорение по модели Воеллми: a = g (sin θ - μ cos θ) - g v² / (ξ h),
+#     μ - сухое трение, ξ - турбулентное трение (м/с²), h - толщина потока;
+#   - вытекающая за шаг доля массы (v dt / L) делится между соседями ниже по склону
+#     пропорционально уклону (multiple flow direction), скорость переносится вместе с массой.
+# это упрощенная модель для оценки зоны выноса, а не замена RAMMS и т.п.
+# расчет долгий, поэтому выполняется фоновой задачей (tasks.runout_job), а не внутри запроса
+
+G = 9.81
+# показатель степени в весах multiple flow direction (Holmgren): больше - поток уже
+FLOW_EXPONENT = 1.1
+# толщина, ниже которой масса считается остановившейся "пленкой", м
+MIN_HEIGHT = 1e-3
+# толщина, начиная с которой ячейка входит в зону выноса, м
+EXTENT_HEIGHT = 0.05
+# скорость, ниже которой поток считается остановившимся, м/с
+STOP_VELOCITY = 0.1
+# шаг по времени: не больше MAX_DT и такой, чтобы за шаг масса проходила не больше CFL ячейки
+MAX_DT = 1.0
+CFL = 0.5
+# ограничение размера области расчета, ячеек
+MAX_CELLS = 250_000
+# ограничение реального времени расчета, с (меньше JOB_TIMEOUT)
+MAX_SECONDS = 120
+
+def fill_depressions(z, epsilon=1e-3):
+    """Заливка понижений рельефа (Priority-Flood + epsilon, Barnes et al., 2014).
+    Ячейки обходятся от краев (и соседей ячеек без данных) по возрастанию высоты;
+    ячейка ниже уже обработанного соседа поднимается до его высоты + epsilon,
+    поэтому из любой ячейки есть путь с уменьшением высоты к краю.
+    Поднятые ячейки идут в обычную очередь вместо кучи - в больших ямах это заметно быстрее.
+
+    Args:
+        z (numpy.ndarray): высоты (строки, столбцы), NaN - нет данных
+        epsilon (float): минимальный перепад на залитых участках, м
+
+    Returns:
+        numpy.ndarray: float64 залитые высоты (NaN там же, где в z)
+    """
+    filled = np.array(z, dtype=np.float64)
+    height, width = filled.shape
+    nodata = np.isnan(filled)
+    closed = nodata.copy()
+    # затравки: край области и ячейки рядом с отсутствующими данными
+    seeds = np.zeros_like(nodata)
+    seeds[0, :] = seeds[-1, :] = seeds[:, 0] = seeds[:, -1] = True
+    padded = np.pad(nodata, 1)
+    for d_row, d_col in D8_OFFSETS:
+        seeds |= padded[1 + d_row:1 + d_row + height, 1 + d_col:1 + d_col + width]
+    seeds &= ~nodata
+
+    flat = filled.ravel()
+    closed_flat = closed.ravel()
+    heap = [(flat[index], index) for index in np.flatnonzero(seeds).tolist()]
+    heapq.heapify(heap)
+    closed_flat[np.flatnonzero(seeds)] = True
+    pit = deque()
+    while heap or pit:
+        if pit:
+            index = pit.popleft()
+        else:
+            index = heapq.heappop(heap)[1]
+        level = flat[index]
+        row, col = divmod(index, width)
+        for d_row, d_col in D8_OFFSETS:
+            r, c = row + d_row, col + d_col
+            if r < 0 or r >= height or c < 0 or c >= width:
+                continue
+            neighbour = r * width + c
+            if closed_flat[neighbour]:
+                continue
+            closed_flat[neighbour] = True
+            if flat[neighbour] <= level + epsilon:
+                flat[neighbour] = level + epsilon
+                pit.append(neighbour)
+            else:
+                heapq.heappush(heap, (flat[neighbour], neighbour))
+    return filled
+
+def flow_geometry(z, dy, dx):
+    """Неизменные на протяжении расчета характеристики рельефа.
+
+    Returns:
+        tuple: (веса переноса к соседям (8, строки, столбцы),
+                sin и cos уклона наибольшего спуска, длина пути из ячейки L в метрах)
+    """
+    height, width = z.shape
+    distances = d8_distances(dy, dx)[:, :, np.newaxis]
+    padded = np.pad(z, 1, constant_values=np.nan)
+    drops = np.empty((len(D8_OFFSETS), height, width))
+    for k, (d_row, d_col) in enumerate(D8_OFFSETS):
+        drops[k] = (z - padded[1 + d_row:1 + d_row + height, 1 + d_col:1 + d_col + width]) / distances[k]
+    drops = np.where(drops > 0, drops, 0)  # в т.ч. NaN - соседи без данных не принимают массу
+    weights = drops ** FLOW_EXPONENT
+    total = weights.sum(axis=0)
+    weights = np.divide(weights, total, out=np.zeros_like(weights), where=total > 0)
+    angle = np.arctan(drops.max(axis=0))
+    length = (weights * distances).sum(axis=0)
+    return weights, np.sin(angle), np.cos(angle), length
+
+def simulate(z, release, dy, dx, mu, xi, release_depth, max_time=600, max_steps=5000,
+             max_seconds=MAX_SECONDS):
+    """Расчет движения массы из зоны зарождения по залитому рельефу z.
+
+    Args:
+        z (numpy.ndarray): залитые высоты (fill_depressions), NaN - нет данных
+        release (numpy.ndarray): bool маска зоны зарождения
+        dy (float): размер ячейки по широте, м
+        dx (numpy.ndarray): размеры ячеек по долготе для каждой строки, м
+        mu (float): коэффициент сухого трения
+        xi (float): коэффициент турбулентного трения, м/с²
+        release_depth (float): начальная толщина снега в зоне зарождения, м
+        max_time (float): ограничение времени моделирования, с
+        max_steps (int): ограничение количества шагов
+        max_seconds (float): ограничение реального времени расчета, с
+
+    Returns:
+        dict: {'max_height', 'max_velocity': массивы максимумов за все время,
+               'height': итоговая толщина отложений, 'time': время, 'steps': шагов,
+               'timed_out': остановлен ли расчет по max_seconds}
+    """
+    deadline = monotonic() + max_seconds
+    height, width = z.shape
+    weights, sin, cos, length = flow_geometry(z, dy, dx)
+    # переносится объем, а не толщина: площади ячеек разных строк различаются.
+    # рамка из единиц - масса, ушедшая за край области, все равно отбрасывается
+    area = np.pad(np.broadcast_to(dy * dx[:, np.newaxis], z.shape), 1, constant_values=1)
+    can_flow = length > 0
+    h = np.where(release & ~np.isnan(z), float(release_depth), 0.0)
+    v = np.zeros_like(h)
+    max_height, max_velocity = h.copy(), np.zeros_like(h)
+    min_length = length[can_flow].min() if can_flow.any() else 1.0
+    time, steps, timed_out = 0.0, 0, False
+    while time < max_time and steps < max_steps:
+        if monotonic() > deadline:
+            timed_out = True
+            break
+        has_mass = h > MIN_HEIGHT
+        a = G * (sin - mu * cos) - G * v ** 2 / (xi * np.maximum(h, MIN_HEIGHT))
+        # масса движется, если она уже движется или склон достаточно крутой, чтобы тронуться
+        moving = has_mass & can_flow & ((v > STOP_VELOCITY) | (a > 0))
+        if not moving.any():
+            break
+        v_max = v[moving].max()
+        dt = MAX_DT if v_max <= 0 else min(MAX_DT, CFL * min_length / v_max)
+        v_new = np.where(moving, np.maximum(v + a * dt, 0), 0)
+        fraction = np.where(moving, np.minimum(v_new * dt / np.where(can_flow, length, 1), 1), 0)
+
+        out = h * fraction
+        out_volume = out * area[1:-1, 1:-1]
+        h_next = np.pad(h - out, 1)
+        momentum = np.pad((h - out) * v_new, 1)
+        for k, (d_row, d_col) in enumerate(D8_OFFSETS):
+            target = (slice(1 + d_row, 1 + d_row + height), slice(1 + d_col, 1 + d_col + width))
+            flux = out_volume * weights[k] / area[target]
+            h_next[target] += flux
+            momentum[target] += flux * v_new
+        h, momentum = h_next[1:-1, 1:-1], momentum[1:-1, 1:-1]
+        v = np.divide(momentum, h, out=np.zeros_like(h), where=h > MIN_HEIGHT)
+
+        np.maximum(max_height, h, out=max_height)
+        np.maximum(max_velocity, v, out=max_velocity)
+        time += dt
+        steps += 1
+    return {'max_height': max_height, 'max_velocity': max_velocity, 'height': h,
+            'time': time, 'steps': steps, 'timed_out': timed_out}
+
+def runout(terrain, rings, mu=0.2, xi=1500, release_depth=1.0, margin=3000, max_cells=MAX_CELLS,
+           max_seconds=MAX_SECONDS):
+    """Зона выноса и максимальные скорости для зоны зарождения rings.
+
+    Args:
+        terrain (TerrainDerivatives): растр высот (derivatives.get_derivatives)
+        rings (list): кольца полигона зоны зарождения, последовательности (lat, lng)
+        mu, xi, release_depth: параметры simulate
+        margin (float): запас вокруг зоны зарождения, м - область расчета
+        max_cells (int): ограничение размера области расчета
+        max_seconds (float): ограничение реального времени расчета, с
+
+    Returns:
+        dict: {'extent': GeoGrid uint8 (1 - ячейка в зоне выноса),
+               'max_velocity': GeoGrid float32 м/с, 'max_height': GeoGrid float32 м,
+               'volume': объем в зоне зарождения, м³, 'time', 'steps', 'timed_out',
+               'reached_boundary': дошел ли поток до края области расчета}
+
+    Raises:
+        ValueError: область слишком большая или зона зарождения не попадает на ячейки
+    """
+    extent = rings_extent(rings)
+    cell_lat, cell_lng = terrain.transform.cell_size
+    lat_margin = margin / cell_size_meters(0, 1, 1)[0]
+    lng_margin = margin / cell_size_meters(np.array([max(abs(extent[0]), abs(extent[2]))]), 1, 1)[1][0]
+    top, left = terrain.index(extent[2] + lat_margin, extent[1] - lng_margin)
+    bottom, right = terrain.index(extent[0] - lat_margin, extent[3] + lng_margin)
+    top, left = max(top, 0), max(left, 0)
+    bottom, right = min(bottom, terrain.shape[0] - 1), min(right, terrain.shape[1] - 1)
+    if bottom < top or right < left:
+        raise ValueError("release area is outside of the height map")
+    if (bottom - top + 1) * (right - left + 1) > max_cells:
+        raise ValueError("release area or margin is too large")
+
+    z = np.array(terrain.elevation[top:bottom + 1, left:right + 1], dtype=np.float64)
+    lats = terrain.transform.to_geo(np.arange(top, bottom + 1), left)[0]
+    lngs = terrain.transform.to_geo(top, np.arange(left, right + 1))[1]
+    release = polygon_mask(rings, lats, lngs) & ~np.isnan(z)
+    if not release.any():
+        raise ValueError("release area contains no height map cells")
+
+    dy, dx = cell_size_meters(lats, cell_lat, cell_lng)
+    result = simulate(fill_depressions(z), release, dy, dx, mu, xi, release_depth, max_seconds=max_seconds)
+    in_extent = (result['max_height'] >= EXTENT_HEIGHT) | release
+    border = np.zeros_like(in_extent)
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = True
+
+    origin, cell_size = terrain.coords(top, left), (cell_lat, cell_lng)
+    cell_area = dy * dx[:, np.newaxis]
+    return {'extent': GeoGrid(origin, cell_size, in_extent.astype(np.uint8), nodata=0),
+            'max_velocity': GeoGrid(origin, cell_size,
+                                    np.where(in_extent, result['max_velocity'], 0).astype(np.float32), nodata=0),
+            'max_height': GeoGrid(origin, cell_size,
+                                  np.where(in_extent, result['max_height'], 0).astype(np.float32), nodata=0),
+            'volume': float((release * cell_area).sum() * release_depth),
+            'time': result['time'], 'steps': result['steps'], 'timed_out': result['timed_out'],
+            'reached_boundary': bool((in_extent & border & ~release).any())}
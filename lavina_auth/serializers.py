@@ -3,9 +3,12 @@ from django.contrib.auth.models import Group
 from rest_framework.validators import UniqueValidator
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
-from .models import Place, PlaceType
+from .models import Place, PlaceType, Job
 from django.contrib.gis.geos import GEOSGeometry
-from lavina_auth.elevation_basic import ALLOWED_REGION
+from rest_framework_gis.fields import GeometryField
+from lavina_auth.elevation_basic import get_allowed_region
+from .backends import user_groups
+from lavina_server.settings import NEARBY_DEFAULT_RADIUS, NEARBY_MAX_RADIUS, NEARBY_DEFAULT_COUNT, NEARBY_MAX_COUNT
 
 class UserRegSerializer(serializers.ModelSerializer):
 
@@ -51,26 +54,114 @@ class UserSerializer(serializers.ModelSerializer):
         return obj.first_name + ' '+ obj.last_name
 
     def get_group(self, obj):
-        return str(obj.groups.all().first())
+        groups = user_groups(obj)
+        return groups[0] if groups else str(None)
 
     class Meta:
         model = User
         fields = ["id", "username", "fio", "group"]
 
+class ZoomGeometryField(GeometryField):
+    """Геометрия места. При чтении берется из поля context['geometry_field'],
+    например упрощенная geometry_low для мелких масштабов (см. models.geometry_field_for_zoom)
+    """
+
+    def get_attribute(self, instance):
+        geometry = getattr(instance, self.context.get('geometry_field', 'geometry'))
+        return geometry if geometry is not None else instance.geometry
+
 class PlaceSerializer(serializers.ModelSerializer):
     place_type = serializers.PrimaryKeyRelatedField(queryset=PlaceType.objects.all())
+    geometry = ZoomGeometryField()
     owner = serializers.PrimaryKeyRelatedField(default=None, read_only=True)
 
     def validate_geometry(self, value):
         extent = value.extent
-        if (extent[0] < ALLOWED_REGION[0] and \
-            extent[1] < ALLOWED_REGION[1]) or \
-           (extent[2] > ALLOWED_REGION[2] and \
-            extent[3] > ALLOWED_REGION[3]):
+        region = get_allowed_region()
+        if (extent[0] < region[0] and \
+            extent[1] < region[1]) or \
+           (extent[2] > region[2] and \
+            extent[3] > region[3]):
             raise serializers.ValidationError("extent of geometry should be inside allowed region")
         return value
 
     class Meta:
         model = Place
-        fields = '__all__'
-        read_only_fields = ["id", "heighest_point", "heighest_elevation"]
+        exclude = ["geometry_low", "geometry_mid", "dem_version", "geometry_hash"]
+        read_only_fields = ["id", "heighest_point", "heighest_elevation", "elevation_job"]
+
+
+class NearbyQuerySerializer(serializers.Serializer):
+    """Параметры /places/nearby: точка, радиус поиска в метрах, количество ближайших мест k"""
+    lat = serializers.FloatField(min_value=-90, max_value=90)
+    lng = serializers.FloatField(min_value=-180, max_value=180)
+    radius = serializers.FloatField(default=NEARBY_DEFAULT_RADIUS, min_value=0, max_value=NEARBY_MAX_RADIUS)
+    k = serializers.IntegerField(default=NEARBY_DEFAULT_COUNT, min_value=0, max_value=NEARBY_MAX_COUNT)
+    type_id = serializers.PrimaryKeyRelatedField(queryset=PlaceType.objects.all(), required=False)
+
+
+class NearbyPlaceSerializer(serializers.ModelSerializer):
+    """Место в ответе /places/nearby: без геометрии, с расстоянием до точки в метрах"""
+    distance = serializers.SerializerMethodField()
+
+    def get_distance(self, obj):
+        distance = getattr(obj, 'distance', None)
+        return round(distance.m, 1) if distance is not None else 0.0
+
+    class Meta:
+        model = Place
+        fields = ["id", "name", "place_type", "heighest_elevation", "heighest_point", "distance"]
+
+
+class NearbyPlaceGeometrySerializer(NearbyPlaceSerializer):
+    geometry = ZoomGeometryField()
+
+    class Meta(NearbyPlaceSerializer.Meta):
+        fields = NearbyPlaceSerializer.Meta.fields + ["geometry"]
+
+
+class JobSerializer(serializers.ModelSerializer):
+    # трассировка ошибки (Job.error) видна только в админке
+    class Meta:
+        model = Job
+        fields = ["id", "task", "status", "result", "attempts", "created", "started", "finished"]
+
+
+class TraceBatchSerializer(serializers.Serializer):
+    """Запрос пакетного расчета путей: либо список точек points, либо place_id"""
+    points = serializers.ListField(
+        child=serializers.ListField(child=serializers.FloatField(), min_length=2, max_length=2),
+        required=False, max_length=5000)
+    place_id = serializers.PrimaryKeyRelatedField(queryset=Place.objects.all(), required=False)
+    fraction = serializers.FloatField(default=0.02, min_value=0)
+    max_steps = serializers.IntegerField(default=1000, min_value=1, max_value=1000)
+
+    def validate(self, data):
+        if ('points' in data) == ('place_id' in data):
+            raise serializers.ValidationError("either points or place_id should be provided")
+        return data
+
+
+class ProfileSerializer(serializers.Serializer):
+    """Запрос высот: точки points, а если задан step - ломаная с шагом step метров"""
+    points = serializers.ListField(
+        child=serializers.ListField(child=serializers.FloatField(), min_length=2, max_length=2),
+        min_length=1, max_length=10000)
+    step = serializers.FloatField(required=False, min_value=1)
+
+
+class RunoutSerializer(serializers.Serializer):
+    """Запрос расчета выноса: зона зарождения - кольцо polygon или место place_id"""
+    polygon = serializers.ListField(
+        child=serializers.ListField(child=serializers.FloatField(), min_length=2, max_length=2),
+        required=False, min_length=4, max_length=10000)
+    place_id = serializers.PrimaryKeyRelatedField(queryset=Place.objects.all(), required=False)
+    mu = serializers.FloatField(default=0.2, min_value=0.01, max_value=1)
+    xi = serializers.FloatField(default=1500, min_value=100, max_value=10000)
+    release_depth = serializers.FloatField(default=1.0, min_value=0.1, max_value=10)
+    margin = serializers.FloatField(default=3000, min_value=0, max_value=10000)
+
+    def validate(self, data):
+        if ('polygon' in data) == ('place_id' in data):
+            raise serializers.ValidationError("either polygon or place_id should be provided")
+        return data
@@ -0,0 +1,97 @@
+import threading
+from django.db import transaction
+from django.contrib.auth.models import User, Group, Permission
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import Place, PlaceType
+from .places_cache import invalidate_places
+from .places_tiles import invalidate_tiles
+from .auth_cache import invalidate_user, invalidate_all
+
+# обработчики сигналов моделей, подключаются в LavinaAuthConfig.ready()
+
+# типы мест, ответы /places для которых нужно сбросить после коммита текущей транзакции
+_pending = threading.local()
+
+def invalidate_places_on_commit(*type_ids):
+    # сбрасываем после коммита, один раз за транзакцию: первый из отложенных обработчиков
+    # сбрасывает все накопленные типы, остальные ничего не делают.
+    # типы из откаченной транзакции сбросятся со следующим коммитом - это лишь лишний сброс
+    pending = getattr(_pending, 'type_ids', None)
+    if pending is None:
+        pending = _pending.type_ids = set()
+    pending.update(type_ids)
+    transaction.on_commit(flush_pending_places)
+
+def flush_pending_places():
+    type_ids, _pending.type_ids = getattr(_pending, 'type_ids', None), set()
+    if type_ids:
+        invalidate_places(*type_ids)
+
+def invalidate_tiles_on_commit(*extents):
+    transaction.on_commit(lambda: invalidate_tiles(*extents))
+
+@receiver(pre_save, sender=Place)
+def remember_place_type(sender, instance, update_fields=None, **kwargs):
+    # место могли перенести в другой тип - тогда нужно перестроить и старый список,
+    # а при изменении геометрии - сбросить и тайлы, которые пересекала старая геометрия
+    instance._old_place_type_id, instance._old_extent = None, None
+    if not instance.pk:
+        return
+    fields = ['place_type_id']
+    if update_fields is None or 'geometry' in update_fields:
+        fields.append('geometry')
+    old = Place.objects.filter(pk=instance.pk).values_list(*fields).first()
+    if old is not None:
+        instance._old_place_type_id = old[0]
+        instance._old_extent = old[1].extent if len(old) > 1 and old[1] is not None else None
+
+@receiver(post_save, sender=Place)
+def place_saved(sender, instance, **kwargs):
+    old_type_id = getattr(instance, '_old_place_type_id', None)
+    invalidate_places_on_commit(instance.place_type_id,
+                             *([old_type_id] if old_type_id is not None else []))
+    old_extent = getattr(instance, '_old_extent', None)
+    invalidate_tiles_on_commit(instance.geometry.extent,
+                               *([old_extent] if old_extent not in (None, instance.geometry.extent) else []))
+
+@receiver(post_delete, sender=Place)
+def place_deleted(sender, instance, **kwargs):
+    invalidate_places_on_commit(instance.place_type_id)
+    invalidate_tiles_on_commit(instance.geometry.extent)
+
+@receiver(post_save, sender=PlaceType)
+@receiver(post_delete, sender=PlaceType)
+def place_type_changed(sender, instance, **kwargs):
+    invalidate_places_on_commit(instance.pk)
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # в т.ч. is_active/is_superuser, например деактивация в manage.py expireuser
+    invalidate_user(instance.pk)
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_user(instance.pk)
+    elif pk_set is not None:
+        # group.user_set.add(...) - в pk_set id пользователей
+        invalidate_user(*pk_set)
+    else:
+        # group.user_set.clear() - затронутые пользователи уже неизвестны
+        invalidate_all()
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_all()
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def auth_objects_changed(sender, **kwargs):
+    invalidate_all()
@@ -0,0 +1,173 @@
+import io
+import os
+import shutil
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from math import floor, log, tan, cos, radians, pi
+import numpy as np
+from PIL import Image
+from .elevation_basic import get_catalog, VOID_DATA
+from .terrain import cell_size_meters, slope_degrees
+from .terrain_tiles import pixel_coords
+
+# слой уклонов для карты: пирамида PNG тайлов XYZ, где цветом выделены
+# классы уклона, опасные для зарождения лавин (manage.py buildslopetiles).
+# классы уклона считаются один раз для всей области и сохраняются в .npy,
+# тайлы рендерятся параллельно в пуле процессов - каждый процесс
+# отображает этот файл в память и только выбирает из него пиксели.
+# результат - каталог root/<версия>/z/x/y.png и ссылка root/current на последнюю версию,
+# которую можно отдавать статикой (nginx), тайлы без опасных склонов не пишутся
+
+# (нижняя граница класса в градусах, цвет RGBA), классы - от нижней границы до следующей
+SLOPE_CLASSES = ((27, (120, 200, 60, 140)),
+                 (30, (250, 220, 0, 160)),
+                 (35, (250, 140, 0, 170)),
+                 (40, (230, 30, 30, 180)),
+                 (45, (150, 40, 170, 180)),
+                 (60, (60, 60, 60, 140)))
+# класс ячеек без данных
+NO_CLASS = 255
+BLOCK_ROWS = 512
+CURRENT = "current"
+
+def palette():
+    """RGBA цвет для каждого кода класса (0 - уклон меньше первого класса)"""
+    colors = np.zeros((256, 4), dtype=np.uint8)
+    for code, (_, color) in enumerate(SLOPE_CLASSES, start=1):
+        colors[code] = color
+    return colors
+
+def tile_range(bounds, z):
+    """Диапазоны x и y тайлов уровня z, покрывающих bounds (включительно)"""
+    n = 2 ** z
+
+    def tile_y(lat):
+        return floor((1 - log(tan(radians(lat)) + 1 / cos(radians(lat))) / pi) / 2 * n)
+    return (floor((bounds[1] + 180) / 360 * n), min(floor((bounds[3] + 180) / 360 * n), n - 1)), \
+           (tile_y(bounds[2]), min(tile_y(bounds[0]), n - 1))
+
+def version(bounds, catalog):
+    """Версия слоя: меняется при смене тайлов HGT, области или классов"""
+    digest = hashlib.sha1(f"{catalog.version}:{catalog.per_degree}:{bounds}:{SLOPE_CLASSES}".encode())
+    return digest.hexdigest()[:16]
+
+def compute_classes(bounds, filename, catalog=None):
+    """Считает коды классов уклона для области bounds и сохраняет их в filename (.npy).
+
+    Returns:
+        tuple: (строка, столбец) верхней левой ячейки в глобальных индексах мозаики
+    """
+    catalog = catalog or get_catalog()
+    pd = catalog.per_degree
+    top, left = catalog.index(bounds[2], bounds[1])
+    bottom, right = catalog.index(bounds[0], bounds[3])
+    classes = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8,
+                                        shape=(bottom - top + 1, right - left + 1))
+    limits = [lower for lower, _ in SLOPE_CLASSES]
+    dy = cell_size_meters(0, 1 / pd, 1 / pd)[0]
+    for block_top in range(top, bottom + 1, BLOCK_ROWS):
+        block_bottom = min(block_top + BLOCK_ROWS - 1, bottom)
+        # блок с рамкой в одну ячейку для уклона
+        z = catalog.window(block_top - 1, left - 1, block_bottom + 1, right + 1)
+        z = np.where(z == VOID_DATA, np.nan, z.astype(np.float64))
+        lats = 90 - np.arange(block_top, block_bottom + 1) / pd
+        slope = slope_degrees(z, dy, cell_size_meters(lats, 1 / pd, 1 / pd)[1])
+        block = np.digitize(slope, limits).astype(np.uint8)
+        block[np.isnan(slope)] = NO_CLASS
+        classes[block_top - top:block_bottom - top + 1] = block
+    classes.flush()
+    return top, left
+
+
+# состояние процесса пула: классы (отображенные в память) и их положение в мозаике
+_worker = {}
+
+def init_worker(classes_file, origin, per_degree, root):
+    _worker.update(classes=np.load(classes_file, mmap_mode='r'), origin=origin,
+                   per_degree=per_degree, root=root, palette=palette())
+
+def render_tile(z, x, y):
+    """Рендерит тайл и пишет его в каталог версии. Возвращает True, если тайл записан"""
+    classes, (top, left), pd = _worker['classes'], _worker['origin'], _worker['per_degree']
+    lats, lngs = pixel_coords(z, x, y)
+    rows = np.rint((90 - lats) * pd).astype(np.int64) - top
+    cols = np.rint((lngs + 180) * pd).astype(np.int64) - left
+    rows, cols = np.broadcast_arrays(rows, cols)
+    inside = (rows >= 0) & (rows < classes.shape[0]) & (cols >= 0) & (cols < classes.shape[1])
+    codes = np.zeros(rows.shape, dtype=np.uint8)
+    codes[inside] = classes[rows[inside], cols[inside]]
+    rgba = _worker['palette'][codes]
+    if not rgba[..., 3].any():
+        return False
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, 'PNG')
+    path = os.path.join(_worker['root'], str(z), str(x), f"{y}.png")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(buffer.getvalue())
+    os.replace(path + ".tmp", path)
+    return True
+
+def render_tiles(tiles):
+    return sum(render_tile(*tile) for tile in tiles)
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def build(root, bounds, min_zoom, max_zoom, workers=None, keep=2, force=False):
+    """Строит пирамиду тайлов в root/<версия> и переключает на нее root/current.
+    Каталог версии собирается под временным именем и переименовывается целиком,
+    поэтому статический сервер никогда не видит недостроенную пирамиду.
+
+    Returns:
+        tuple: (версия, количество тайлов всего, записано) или (версия, 0, 0), если версия уже есть
+    """
+    catalog = get_catalog()
+    name = version(bounds, catalog)
+    target = os.path.join(root, name)
+    os.makedirs(root, exist_ok=True)
+    if os.path.isdir(target) and not force:
+        switch_current(root, name)
+        return name, 0, 0
+
+    build_dir = tempfile.mkdtemp(dir=root, prefix=f".build-{name}-")
+    try:
+        classes_file = os.path.join(build_dir, "classes.npy")
+        origin = compute_classes(bounds, classes_file, catalog)
+        tiles_dir = os.path.join(build_dir, name)
+        tiles = []
+        for z in range(min_zoom, max_zoom + 1):
+            (x_min, x_max), (y_min, y_max) = tile_range(bounds, z)
+            tiles.extend((z, x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(classes_file, origin, catalog.per_degree, tiles_dir)) as executor:
+            written = sum(executor.map(render_tiles, chunks(tiles, 64)))
+        os.makedirs(tiles_dir, exist_ok=True)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.rename(tiles_dir, target)
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    switch_current(root, name)
+    prune(root, keep)
+    return name, len(tiles), written
+
+def switch_current(root, name):
+    # симлинк подменяется атомарно через os.replace
+    tmp = os.path.join(root, CURRENT + ".tmp")
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(name, tmp)
+    os.replace(tmp, os.path.join(root, CURRENT))
+
+def prune(root, keep):
+    """Удаляет старые версии, кроме keep последних (по времени изменения) и текущей"""
+    current = os.readlink(os.path.join(root, CURRENT))
+    versions = sorted((entry for entry in os.scandir(root)
+                       if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.')),
+                      key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[keep:]:
+        if entry.name != current:
+            shutil.rmtree(entry.path, ignore_errors=True)
@@ -0,0 +1,80 @@
+import os
+import numpy as np
+from django.contrib.gis.gdal import GDALRaster
+from django.contrib.gis.geos import Polygon
+
+# синтетические данные для замеров производительности (manage.py benchmark):
+# карта высот в виде тайлов HGT и GeoTiff и набор полигонов мест.
+# рельеф - детерминированная функция координат (горы - гауссовы купола с хребтами),
+# поэтому соседние тайлы HGT совпадают на общем крае, а GeoTiff и HGT - в общих точках
+
+# область по умолчанию - окрестности Хибин, как у настоящих данных
+REGION = (67, 33, 69, 35)
+
+def elevation_at(lats, lngs, seed=0, peaks=40):
+    """Высоты синтетического рельефа в точках (lats, lngs) (numpy массивы одной формы), м"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform((REGION[0], REGION[1]), (REGION[2], REGION[3]), size=(peaks, 2))
+    heights = rng.uniform(300, 1200, size=peaks)
+    sizes = rng.uniform(0.03, 0.2, size=peaks)
+    z = 150 + 20 * np.sin(lats * 40) * np.cos(lngs * 25)
+    for (lat, lng), height, size in zip(centers, heights, sizes):
+        d2 = ((lats - lat) ** 2 + ((lngs - lng) * 0.4) ** 2) / size ** 2
+        # хребты: купол, изрезанный синусоидой по азимуту
+        ridges = 1 + 0.25 * np.sin(8 * np.arctan2(lats - lat, lngs - lng))
+        z = z + height * np.exp(-d2 * ridges)
+    return z
+
+def write_hgt(root, lat, lng, samples=1201, seed=0):
+    """Пишет тайл HGT с юго-западным углом (lat, lng), возвращает путь к файлу"""
+    os.makedirs(root, exist_ok=True)
+    steps = np.linspace(0, 1, samples)
+    lats, lngs = np.meshgrid(lat + 1 - steps, lng + steps, indexing='ij')
+    data = np.rint(elevation_at(lats, lngs, seed)).astype('>i2')
+    filename = os.path.join(root, f"{'N' if lat >= 0 else 'S'}{abs(lat):02d}"
+                                  f"{'E' if lng >= 0 else 'W'}{abs(lng):03d}.hgt")
+    data.tofile(filename)
+    return filename
+
+def write_hgt_mosaic(root, region=REGION, samples=1201, seed=0):
+    """Пишет тайлы HGT, покрывающие region (широта_мин, долгота_мин, широта_макс, долгота_макс)"""
+    return [write_hgt(root, lat, lng, samples, seed)
+            for lat in range(region[0], region[2]) for lng in range(region[1], region[3])]
+
+def write_geotiff(filename, region=REGION, per_degree=1200, seed=0):
+    """Пишет GeoTiff (EPSG:4326, int16) с тем же рельефом, что и HGT"""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    height = int(round((region[2] - region[0]) * per_degree))
+    width = int(round((region[3] - region[1]) * per_degree))
+    # центры ячеек совпадают с отсчетами HGT
+    lats = region[2] - np.arange(height) / per_degree
+    lngs = region[1] + np.arange(width) / per_degree
+    data = np.rint(elevation_at(*np.meshgrid(lats, lngs, indexing='ij'), seed)).astype(np.int16)
+    half = 0.5 / per_degree
+    GDALRaster({'driver': 'GTiff', 'name': filename, 'srid': 4326,
+                'width': width, 'height': height, 'datatype': 3,
+                'origin': (region[1] - half, region[2] + half),
+                'scale': (1 / per_degree, -1 / per_degree),
+                'bands': [{'data': data, 'nodata_value': -32768}]})
+    return filename
+
+def polygons(count, region=REGION, seed=0, min_size=0.002, max_size=0.02, vertices=12):
+    """Случайные звездчатые полигоны мест в порядке (lat, lng), srid 4326"""
+    rng = np.random.default_rng(seed)
+    margin = max_size * 3
+    centers = rng.uniform((region[0] + margin, region[1] + margin),
+                          (region[2] - margin, region[3] - margin), size=(count, 2))
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    result = []
+    for lat, lng in centers:
+        radii = rng.uniform(min_size, max_size) * rng.uniform(0.6, 1, size=vertices)
+        ring = np.stack((lat + radii * np.sin(angles), lng + 2.5 * radii * np.cos(angles)), axis=-1)
+        ring = np.vstack((ring, ring[:1]))
+        result.append(Polygon(ring.tolist(), srid=4326))
+    return result
+
+def points(count, region=REGION, seed=0, margin=0.05):
+    """Случайные точки (lat, lng) внутри region"""
+    rng = np.random.default_rng(seed)
+    return rng.uniform((region[0] + margin, region[1] + margin),
+                       (region[2] - margin, region[3] - margin), size=(count, 2)).tolist()
@@ -0,0 +1,34 @@
+from .jobs import task
+from .models import Place
+from .elevation import FILE
+from .derivatives import get_derivatives, DerivativesUnavailable
+from .runout import runout
+
+# обработчики фоновых задач (см. jobs.py)
+
+@task('place_elevation')
+def place_elevation(place_id):
+    """Считает наивысшую точку места. Сохранение вызывает post_save,
+    поэтому кеш /places перестраивается уже с высотами
+    """
+    place = Place.objects.filter(pk=place_id).first()
+    if place is None:
+        # место удалили раньше, чем до него дошла очередь
+        return None
+    place.refresh_elevation()
+    place.save(update_fields=['heighest_elevation', 'heighest_point', 'dem_version', 'geometry_hash'])
+    return {'heighest_elevation': place.heighest_elevation,
+            'heighest_point': list(place.heighest_point.coords) if place.heighest_point else None}
+
+@task('runout')
+def runout_job(rings, mu, xi, release_depth, margin):
+    """Расчет зоны выноса (см. runout.py, RunoutAPI). Ошибки в параметрах не исправятся
+    повторной попыткой, поэтому возвращаются в результате, а не как ошибка задачи
+    """
+    try:
+        result = runout(get_derivatives(FILE), rings, mu, xi, release_depth, margin)
+    except (ValueError, DerivativesUnavailable) as e:
+        return {'detail': str(e)}
+    for name in ('extent', 'max_velocity', 'max_height'):
+        result[name] = result[name].to_json()
+    return result
@@ -0,0 +1,93 @@
+import numpy as np
+
+# производные характеристики рельефа (уклон и т.п.), вычисляемые над массивами высот
+# размер ячейки в метрах считается отдельно для каждой строки:
+# по широте шаг постоянный, а по долготе уменьшается как cos(широты)
+
+# средний радиус Земли, м
+EARTH_RADIUS = 6371008.8
+
+def cell_size_meters(lats, dlat, dlng):
+    """Возвращает размеры ячейки сетки в метрах.
+
+    Args:
+        lats (numpy.ndarray): широты строк (1D)
+        dlat (float): шаг сетки по широте в градусах
+        dlng (float): шаг сетки по долготе в градусах
+
+    Returns:
+        tuple: (размер по широте (float), размеры по долготе для каждой строки (1D))
+    """
+    dy = EARTH_RADIUS * np.radians(dlat)
+    dx = EARTH_RADIUS * np.radians(dlng) * np.cos(np.radians(lats))
+    return dy, dx
+
+def horn_gradient(z, dy, dx):
+    """Градиент высоты методом Хорна (по 8 соседям).
+
+    Args:
+        z (numpy.ndarray): высоты (h + 2, w + 2) - область с рамкой в одну ячейку,
+                           NaN там, где нет данных
+        dy (float): размер ячейки по широте, м
+        dx (numpy.ndarray): размеры ячеек по долготе для h внутренних строк, м
+
+    Returns:
+        tuple: (dz/dx на восток, dz/dy на север) - массивы (h, w),
+               NaN там, где у ячейки нет данных хотя бы в одном соседе
+    """
+    a, b, c = z[:-2, :-2], z[:-2, 1:-1], z[:-2, 2:]
+    d, f = z[1:-1, :-2], z[1:-1, 2:]
+    g, h, i = z[2:, :-2], z[2:, 1:-1], z[2:, 2:]
+    dz_dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * np.asarray(dx)[:, np.newaxis])
+    # строки идут с севера на юг, поэтому "север минус юг"
+    dz_dy = ((a + 2 * b + c) - (g + 2 * h + i)) / (8 * dy)
+    return dz_dx, dz_dy
+
+def slope_degrees(z, dy, dx):
+    """Уклон в градусах для внутренних ячеек области z (см. horn_gradient)"""
+    dz_dx, dz_dy = horn_gradient(z, dy, dx)
+    return np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+def aspect_degrees(z, dy, dx):
+    """Экспозиция склона (азимут направления вниз по склону) в градусах от севера по часовой,
+    для внутренних ячеек области z (см. horn_gradient)
+    """
+    dz_dx, dz_dy = horn_gradient(z, dy, dx)
+    return (np.degrees(np.arctan2(-dz_dx, -dz_dy)) + 360) % 360
+
+# направления D8: смещения (строка, столбец) к соседям, код направления - индекс в кортеже
+D8_OFFSETS = ((-1, -1), (-1, 0), (-1, 1),
+              (0, -1),           (0, 1),
+              (1, -1),  (1, 0),  (1, 1))
+# код для ячеек, у которых нет соседей с данными
+D8_NONE = 255
+
+def d8_distances(dy, dx):
+    """Расстояния в метрах до соседей D8 для строк с размерами ячеек dx: массив (8, len(dx))"""
+    dx = np.asarray(dx, dtype=np.float64)
+    return np.stack([np.hypot(d_row * dy, d_col * dx) for d_row, d_col in D8_OFFSETS])
+
+def d8_direction(z, dy, dx):
+    """Направление наибольшего спуска (D8) для внутренних ячеек области z.
+    Выбирается сосед с наибольшим (высота - высота_соседа) / расстояние,
+    в том числе если все соседи выше (в яме выбирается самый пологий подъем).
+
+    Args:
+        z (numpy.ndarray): высоты (h + 2, w + 2) с рамкой в одну ячейку, NaN - нет данных
+        dy (float): размер ячейки по широте, м
+        dx (numpy.ndarray): размеры ячеек по долготе для h внутренних строк, м
+
+    Returns:
+        numpy.ndarray: uint8 (h, w) - индекс в D8_OFFSETS или D8_NONE
+    """
+    h, w = z.shape[0] - 2, z.shape[1] - 2
+    center = z[1:-1, 1:-1]
+    distances = d8_distances(dy, dx)
+    drops = np.empty((len(D8_OFFSETS), h, w))
+    for k, (d_row, d_col) in enumerate(D8_OFFSETS):
+        neighbour = z[1 + d_row:1 + d_row + h, 1 + d_col:1 + d_col + w]
+        drops[k] = (center - neighbour) / distances[k][:, np.newaxis]
+    drops[np.isnan(drops)] = -np.inf
+    direction = np.argmax(drops, axis=0).astype(np.uint8)
+    direction[np.isneginf(drops.max(axis=0))] = D8_NONE
+    return direction
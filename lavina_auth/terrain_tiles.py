@@ -0,0 +1,155 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from math import pi, atan, sinh, degrees
+import numpy as np
+from PIL import Image
+from lavina_server.settings import TERRAIN_TILE_CACHE_DIR, TERRAIN_TILE_CACHE_MAX_BYTES
+from .elevation_basic import get_catalog, VOID_DATA
+
+# тайлы высот в формате Terrain-RGB для leaflet (схема XYZ, проекция web mercator)
+# высота кодируется в цвете пикселя:
+#   высота = -10000 + (R * 256 * 256 + G * 256 + B) * 0.1
+# https://docs.mapbox.com/data/tilesets/reference/mapbox-terrain-rgb-v1/
+# пиксели без данных - прозрачные (A = 0)
+#
+# готовые тайлы хранятся на диске: TERRAIN_TILE_CACHE_DIR/<версия_DEM>/z/x/y.png
+# при смене набора тайлов HGT меняется версия, и старый кеш удаляется при очистке
+
+TILE_SIZE = 256
+
+def tile_bounds(z, x, y):
+    """Возвращает границы тайла XYZ: (широта_мин, долгота_мин, широта_макс, долгота_макс)"""
+    n = 2 ** z
+    return (degrees(atan(sinh(pi * (1 - 2 * (y + 1) / n)))), x / n * 360 - 180,
+            degrees(atan(sinh(pi * (1 - 2 * y / n)))), (x + 1) / n * 360 - 180)
+
+def pixel_coords(z, x, y, size=TILE_SIZE):
+    """Возвращает координаты центров пикселей тайла: (широты (size, 1), долготы (1, size))"""
+    n = 2 ** z
+    offsets = (np.arange(size) + 0.5) / size
+    lngs = (x + offsets) / n * 360 - 180
+    lats = np.degrees(np.arctan(np.sinh(pi * (1 - 2 * (y + offsets) / n))))
+    return lats[:, np.newaxis], lngs[np.newaxis, :]
+
+def intersects_dem(z, x, y):
+    """Пересекается ли тайл с областью, покрытой тайлами HGT"""
+    dem_bounds = get_catalog().bounds
+    if dem_bounds is None:
+        return False
+    bounds = tile_bounds(z, x, y)
+    return bounds[0] < dem_bounds[2] and bounds[2] > dem_bounds[0] and \
+           bounds[1] < dem_bounds[3] and bounds[3] > dem_bounds[1]
+
+def encode_terrain_rgb(elevation):
+    """Кодирует массив высот в RGBA массив Terrain-RGB"""
+    value = np.clip(np.rint((elevation.astype(np.float64) + 10000) * 10), 0, 256 ** 3 - 1).astype(np.uint32)
+    rgba = np.empty(elevation.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = value >> 16
+    rgba[..., 1] = (value >> 8) & 0xff
+    rgba[..., 2] = value & 0xff
+    rgba[..., 3] = np.where(elevation == VOID_DATA, 0, 255)
+    return rgba
+
+def render_tile(z, x, y):
+    """Строит PNG тайл Terrain-RGB, высота берется в ближайшей ячейке мозаики
+
+    Returns:
+        bytes: содержимое PNG
+    """
+    catalog = get_catalog()
+    lats, lngs = pixel_coords(z, x, y)
+    rows = np.rint((90 - lats) * catalog.per_degree).astype(np.int64)
+    cols = np.rint((lngs + 180) * catalog.per_degree).astype(np.int64)
+    elevation = catalog.sample(*np.broadcast_arrays(rows, cols))
+    buffer = io.BytesIO()
+    Image.fromarray(encode_terrain_rgb(elevation), 'RGBA').save(buffer, 'PNG', optimize=False)
+    return buffer.getvalue()
+
+
+class TileCache:
+    """Кеш тайлов на диске с ограничением общего размера.
+    Файлы пишутся атомарно (временный файл + os.replace), поэтому
+    несколько воркеров могут писать в кеш одновременно.
+    При превышении max_bytes удаляются кеши старых версий DEM,
+    а затем самые давно использованные тайлы.
+    Размер кеша проверяется не при каждой записи, а после записи
+    примерно 1/20 от max_bytes.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def path(self, version, z, x, y):
+        return os.path.join(self.root, version, str(z), str(x), f"{y}.png")
+
+    def get(self, version, z, x, y):
+        path = self.path(version, z, x, y)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # время доступа обновляем сами, т.к. ФС часто смонтированы с noatime
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, version, z, x, y, data):
+        path = self.path(version, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._written += len(data)
+            if self._written < self.max_bytes // 20:
+                return
+            self._written = 0
+        self.prune(version)
+
+    def prune(self, version):
+        """Удаляет кеши других версий DEM и самые старые тайлы сверх max_bytes"""
+        if not os.path.isdir(self.root):
+            return
+        for name in os.listdir(self.root):
+            if name != version:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+        files = []
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, version)):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+tile_cache = TileCache(TERRAIN_TILE_CACHE_DIR, TERRAIN_TILE_CACHE_MAX_BYTES)
+
+def tile_etag(z, x, y):
+    """Сильный ETag тайла: содержимое определяется версией DEM и координатами тайла"""
+    return f'"{get_catalog().version}-{z}-{x}-{y}"'
+
+def get_terrain_tile(z, x, y):
+    """Возвращает PNG тайл из кеша, при отсутствии - строит и сохраняет его"""
+    version = get_catalog().version
+    data = tile_cache.get(version, z, x, y)
+    if data is None:
+        data = render_tile(z, x, y)
+        tile_cache.put(version, z, x, y, data)
+    return data
@@ -1,3 +1,439 @@
-from django.test import TestCase
+import os
+import json
+import tempfile
+from unittest import mock
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Polygon
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_started, request_finished
+from django.db import close_old_connections
+from django.test import TestCase, SimpleTestCase, override_settings
+from . import places_cache, signals, elevation, derivatives
+from .models import Place, PlaceType
+from .derivatives import TerrainDerivatives, LAYER_DTYPES
+from .elevation import trace_path, trace_paths, start_points_in_polygon
+from .elevation_basic import TileCatalog, VOID_DATA, to_elevation
+from .runout import fill_depressions, simulate, runout, EXTENT_HEIGHT
+from .terrain import D8_OFFSETS, D8_NONE
+from .zonal import polygon_mask, zonal_stats
 
-# Create your tests here.
+# кеши в памяти на время тестов, чтобы не трогать файловые кеши сервера
+TEST_CACHES = {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f"test-{alias}"}
+               for alias in ('default', 'traces', 'tiles', 'auth')}
+
+
+def asgi_get(path, query_string=''):
+    """GET запрос через ASGIHandler, как его выполняет ASGI сервер: (статус, заголовки, тело).
+    Как и тестовый клиент Django, не закрывает соединение с БД на время запроса,
+    чтобы представление видело данные из транзакции теста
+    """
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+             'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+             'query_string': query_string.encode(), 'headers': [(b'host', b'testserver')],
+             'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        async_to_sync(ASGIHandler())(scope, receive, send)
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
+    start = messages[0]
+    body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], dict(start['headers']), body
+
+
+class ExportPlacesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username='owner')
+        cls.place_type = PlaceType.objects.create(type='zone')
+        places = []
+        for i in range(3):
+            geometry = Polygon.from_bbox((67.6 + i * 0.01, 33.6, 67.605 + i * 0.01, 33.61))
+            geometry.srid = 4326
+            places.append(Place(name=f"zone {i}", owner=owner, place_type=cls.place_type, geometry=geometry))
+        # bulk_create - без расчета высот и фоновых задач Place.save
+        Place.objects.bulk_create(places)
+
+    def test_export(self):
+        status, headers, body = asgi_get('/places/export', f"type_id={self.place_type.pk}")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'Content-Type'], b'application/geo+json')
+        self.assertEqual(int(headers[b'Content-Length']), len(body))
+        collection = json.loads(body)
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        self.assertEqual(sorted(feature['properties']['name'] for feature in collection['features']),
+                         ["zone 0", "zone 1", "zone 2"])
+
+    def test_export_bbox(self):
+        status, _, body = asgi_get('/places/export',
+                                   f"type_id={self.place_type.pk}&bbox=67.609,33.59,67.616,33.62")
+        self.assertEqual(status, 200)
+        self.assertEqual([feature['properties']['name'] for feature in json.loads(body)['features']],
+                         ["zone 1"])
+
+    def test_export_without_type(self):
+        status, _, _ = asgi_get('/places/export')
+        self.assertEqual(status, 400)
+
+    def test_export_wsgi(self):
+        # под WSGI выгрузка отправляется по мере чтения из БД
+        response = self.client.get('/places/export', {'type_id': self.place_type.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        collection = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(sorted(feature['properties']['name'] for feature in collection['features']),
+                         ["zone 0", "zone 1", "zone 2"])
+
+
+def hgt_value(rows, cols):
+    """Тестовая высота в ячейке с глобальными индексами (строка, столбец) при 1200 отсчетах на градус:
+    по ней видно, из какой ячейки взято значение, и соседние тайлы совпадают на общем крае
+    """
+    return (rows % 300) * 100 + cols % 100
+
+def write_test_hgt(root, lat, lng):
+    """Пишет тайл SRTM3 (1201 x 1201) с юго-западным углом (lat, lng) со значениями hgt_value"""
+    rows = (89 - lat) * 1200 + np.arange(1201)
+    cols = (lng + 180) * 1200 + np.arange(1201)
+    data = hgt_value(rows[:, np.newaxis], cols[np.newaxis, :]).astype('>i2')
+    filename = os.path.join(root, f"N{lat:02d}E{lng:03d}.hgt")
+    data.tofile(filename)
+    return filename, data
+
+
+class HgtTestCase(SimpleTestCase):
+    # тайлы N67E033, N67E034, N68E033; тайла N68E034 нет
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        for lat, lng in ((67, 33), (67, 34), (68, 33)):
+            filename, data = write_test_hgt(cls.directory.name, lat, lng)
+            if (lat, lng) == (67, 33):
+                # отсутствующий отсчет в середине тайла
+                data[600, 600] = VOID_DATA
+                data.tofile(filename)
+        cls.catalog = TileCatalog(cls.directory.name, per_degree=1200)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+
+
+class TileCatalogTest(HgtTestCase):
+
+    def expected(self, top, left, bottom, right):
+        rows, cols = np.mgrid[top:bottom + 1, left:right + 1]
+        return hgt_value(rows, cols)
+
+    def test_index(self):
+        # верхний левый отсчет N67E033 - (68, 33), строка 600 и столбец 300 - (67.5, 33.25)
+        self.assertEqual(self.catalog.index(68, 33), (22 * 1200, 213 * 1200))
+        self.assertEqual(self.catalog.index(67.5, 33.25), (22 * 1200 + 600, 213 * 1200 + 300))
+        self.assertEqual(self.catalog.coords(22 * 1200 + 600, 213 * 1200 + 300), (67.5, 33.25))
+        row, col = self.catalog.index(67.5, 33.25)
+        self.assertEqual(int(self.catalog.window(row, col, row, col)[0, 0]), hgt_value(row, col))
+
+    def test_window_in_one_tile(self):
+        top, left = 22 * 1200 + 10, 213 * 1200 + 10
+        window = self.catalog.window(top, left, top + 10, left + 20)
+        # внутри одного тайла - view на отображенный файл, без копирования
+        self.assertIsNotNone(window.base)
+        np.testing.assert_array_equal(window, self.expected(top, left, top + 10, left + 20))
+
+    def test_window_across_tiles(self):
+        top, left, bottom, right = 22 * 1200 - 5, 214 * 1200 - 5, 22 * 1200 + 5, 214 * 1200 + 5
+        window = self.catalog.window(top, left, bottom, right)
+        expected = self.expected(top, left, bottom, right)
+        # ячейки только из отсутствующего тайла N68E034 (общие края есть у соседей)
+        expected[:5, 6:] = VOID_DATA
+        np.testing.assert_array_equal(window, expected)
+
+    def test_sample(self):
+        top, left, bottom, right = 22 * 1200 - 5, 214 * 1200 - 5, 22 * 1200 + 5, 214 * 1200 + 5
+        rows, cols = np.mgrid[top:bottom + 1, left:right + 1]
+        np.testing.assert_array_equal(self.catalog.sample(rows, cols),
+                                      self.catalog.window(top, left, bottom, right))
+
+    def test_void(self):
+        row, col = 22 * 1200 + 600, 213 * 1200 + 600
+        window = self.catalog.window(row - 1, col - 1, row + 1, col + 1)
+        self.assertEqual(window[1, 1], VOID_DATA)
+        self.assertEqual(window[0, 0], hgt_value(row - 1, col - 1))
+        self.assertEqual(self.catalog.sample([row], [col])[0], VOID_DATA)
+        self.assertIsNone(to_elevation(window[1, 1]))
+
+    def test_lower_resolution(self):
+        # 600 отсчетов на градус - каждый второй отсчет тайла
+        catalog = TileCatalog(self.directory.name, per_degree=600)
+        top, left = 22 * 600 + 3, 214 * 600 - 4
+        window = catalog.window(top, left, top + 4, left + 8)
+        expected = self.expected(2 * top, 2 * left, 2 * top + 8, 2 * left + 16)[::2, ::2]
+        np.testing.assert_array_equal(window, expected)
+
+
+# сдвиг вершин полигонов на четверть ячейки, чтобы ребра не проходили через отсчеты
+SHIFT = 0.25 / 1200
+
+def shifted(ring):
+    return [(lat + SHIFT, lng + SHIFT) for lat, lng in ring]
+
+
+class ZonalStatsTest(HgtTestCase):
+    # четырехугольник через границу тайлов по долготе 34 и дыра в нем
+    OUTER = shifted([(67.9, 33.98), (67.95, 33.99), (67.94, 34.02), (67.91, 34.01), (67.9, 33.98)])
+    HOLE = shifted([(67.92, 33.995), (67.93, 33.995), (67.93, 34.005), (67.92, 34.005), (67.92, 33.995)])
+
+    def test_polygon_mask_hole(self):
+        outer = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+        hole = [(3, 3), (7, 3), (7, 7), (3, 7), (3, 3)]
+        centers = np.arange(10) + 0.5
+        mask = polygon_mask([outer, hole], centers, centers)
+        expected = np.ones((10, 10), dtype=bool)
+        expected[3:7, 3:7] = False
+        np.testing.assert_array_equal(mask, expected)
+        # направление обхода дыры не важно (правило чет-нечет)
+        np.testing.assert_array_equal(polygon_mask([outer, hole[::-1]], centers, centers), expected)
+
+    def brute_force(self, rings):
+        # то же без разбиения на блоки: отсчеты внутри полигона
+        pd = self.catalog.per_degree
+        lats = np.concatenate([np.asarray(ring)[:, 0] for ring in rings])
+        lngs = np.concatenate([np.asarray(ring)[:, 1] for ring in rings])
+        top, left = int(np.ceil((90 - lats.max()) * pd)), int(np.ceil((lngs.min() + 180) * pd))
+        bottom, right = int(np.floor((90 - lats.min()) * pd)), int(np.floor((lngs.max() + 180) * pd))
+        mask = polygon_mask(rings, 90 - np.arange(top, bottom + 1) / pd,
+                            np.arange(left, right + 1) / pd - 180)
+        values = self.catalog.window(top, left, bottom, right)[mask]
+        return values[values != VOID_DATA]
+
+    def test_blocks(self):
+        stats = zonal_stats([self.OUTER], self.catalog)
+        # блоки 16 x 16 - полигон пересекает много границ блоков
+        self.assertEqual(zonal_stats([self.OUTER], self.catalog, block_size=16), stats)
+        values = self.brute_force([self.OUTER])
+        self.assertEqual(stats['count'], values.size)
+        self.assertEqual((stats['min'], stats['max']), (values.min(), values.max()))
+        self.assertAlmostEqual(stats['mean'], values.mean())
+        row, col = self.catalog.index(*stats['heighest']['coords'])
+        self.assertEqual(hgt_value(row, col), stats['max'])
+
+    def test_hole(self):
+        with_hole = zonal_stats([self.OUTER, self.HOLE], self.catalog, block_size=16)
+        hole = zonal_stats([self.HOLE], self.catalog)
+        self.assertGreater(hole['count'], 0)
+        self.assertEqual(with_hole['count'], zonal_stats([self.OUTER], self.catalog)['count'] - hole['count'])
+        self.assertEqual(with_hole['count'], self.brute_force([self.OUTER, self.HOLE]).size)
+
+    def test_slope_histogram(self):
+        # все соседи отсчетов есть, поэтому уклон посчитан для каждого отсчета
+        stats = zonal_stats([self.OUTER, self.HOLE], self.catalog, block_size=16)
+        self.assertEqual(len(stats['slope_histogram']['counts']), len(stats['slope_histogram']['bins']) - 1)
+        self.assertEqual(sum(stats['slope_histogram']['counts']), stats['count'])
+
+    def test_without_data(self):
+        # полигон целиком в отсутствующем тайле N68E034
+        ring = shifted([(68.5, 34.5), (68.6, 34.5), (68.6, 34.6), (68.5, 34.5)])
+        stats = zonal_stats([ring], self.catalog)
+        self.assertEqual(stats['count'], 0)
+        self.assertIsNone(stats['max'])
+
+
+def trace_status(result):
+    """Причина остановки trace_path в тех же обозначениях, что у trace_paths"""
+    if len(result) == 2:
+        return "stopped"
+    return result[2] if isinstance(result[2], str) else "friction"
+
+
+class TracePathsTest(SimpleTestCase):
+    CELL = 1 / 1200
+    GEOTRANSFORM = [33.0, CELL, 0, 67.8, 0, -CELL]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # склон на юг с неровностями, ямой и областью без данных,
+        # в которой есть одна ячейка с данными без соседей
+        rng = np.random.default_rng(0)
+        rows, cols = np.mgrid[0:40, 0:40]
+        z = 2000 - 25.0 * rows + 15 * np.sin(cols / 3) + rng.normal(0, 3, size=rows.shape)
+        z[20, 10] -= 80
+        z[5:10, 28:35] = np.nan
+        z[7, 31] = 1900
+        elevation_array = z.astype(np.float32)
+        out = {layer: np.empty(z.shape, dtype=LAYER_DTYPES[layer]) for layer in ('slope', 'aspect', 'd8')}
+        derivatives.compute(cls.GEOTRANSFORM, elevation_array, out)
+        cls.terrain = TerrainDerivatives(cls.GEOTRANSFORM, elevation_array, out['slope'], out['aspect'], out['d8'])
+        # get_derivatives проверяет версию исходного файла, поэтому нужен настоящий файл
+        cls.source = tempfile.NamedTemporaryFile(suffix=".tif")
+        cls.patches = [mock.patch.object(elevation, 'FILE', cls.source.name),
+                       mock.patch.dict(derivatives._derivatives, {
+                           cls.source.name: (derivatives.source_signature(cls.source.name), cls.terrain)})]
+        for patch in cls.patches:
+            patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patch in cls.patches:
+            patch.stop()
+        cls.source.close()
+        super().tearDownClass()
+
+    def cell_centers(self):
+        rows, cols = np.mgrid[0:40, 0:40]
+        lats, lngs = self.terrain.coords(rows.ravel(), cols.ravel())
+        return list(zip(lats.tolist(), lngs.tolist()))
+
+    def test_same_as_trace_path(self):
+        points = self.cell_centers()
+        paths, footprint = trace_paths(points, 0.2)
+        statuses = set()
+        for point, batch in zip(points, paths):
+            single = trace_path(point, 1, 0.2)
+            self.assertEqual(batch['path'], single[0], point)
+            self.assertEqual(batch['status'], trace_status(single), point)
+            statuses.add(batch['status'])
+        self.assertLessEqual({"stuck", "friction", "stopped"}, statuses)
+        self.assertEqual(footprint.data.sum(), sum(len(set(path['path'])) for path in paths))
+
+    def test_edges(self):
+        # пути не выходят за растр, часть из них заканчивается на краю
+        paths, _ = trace_paths(self.cell_centers(), 0.05)
+        rows, cols = self.terrain.index(*np.array([point for path in paths for point in path['path']]).T)
+        self.assertTrue(((rows >= 0) & (rows < 40) & (cols >= 0) & (cols < 40)).all())
+        last_rows = [self.terrain.index(*path['path'][-1])[0] for path in paths]
+        self.assertIn(39, last_rows)
+
+    def test_no_direction(self):
+        # ячейка без соседей с данными: D8_NONE, путь из одной ячейки
+        self.assertEqual(self.terrain.d8[7, 31], D8_NONE)
+        point = self.terrain.coords(7, 31)
+        paths, _ = trace_paths([point], 0.2)
+        self.assertEqual(paths[0], {'path': [point], 'status': "stuck"})
+        self.assertEqual(trace_status(trace_path(point, 1, 0.2)), "stuck")
+
+    def test_outside(self):
+        outside = self.terrain.coords(-1, 5)
+        with self.assertRaises(ValueError):
+            trace_paths([self.terrain.coords(3, 5), outside], 0.2)
+        with self.assertRaises(ValueError):
+            trace_path(outside, 1, 0.2)
+        with self.assertRaises(ValueError):
+            start_points_in_polygon([[(68, 34), (68.1, 34), (68.1, 34.1), (68, 34)]])
+
+    def test_start_points_in_polygon(self):
+        # прямоугольник по краям ячеек (2..5, 3..9) - внутри ровно их центры
+        top, left = self.terrain.coords(2, 3)
+        bottom, right = self.terrain.coords(5, 9)
+        half = self.CELL / 2
+        ring = [(top + half, left - half), (top + half, right + half), (bottom - half, right + half),
+                (bottom - half, left - half), (top + half, left - half)]
+        points = start_points_in_polygon([ring])
+        rows, cols = np.mgrid[2:6, 3:10]
+        self.assertEqual(points, list(zip(*(array.tolist() for array in
+                                              self.terrain.coords(rows.ravel(), cols.ravel())))))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PlacesCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username='owner')
+        cls.place_type = PlaceType.objects.create(type='zone')
+        geometry = Polygon.from_bbox((67.6, 33.6, 67.605, 33.61))
+        geometry.srid = 4326
+        Place.objects.bulk_create([Place(name="zone", owner=owner, place_type=cls.place_type,
+                                         geometry=geometry)])
+
+    def test_cached(self):
+        first = places_cache.get_places(self.place_type.pk)
+        with mock.patch.object(places_cache, 'render_places') as render:
+            self.assertEqual(places_cache.get_places(self.place_type.pk), first)
+        render.assert_not_called()
+
+    def test_render_before_commit_is_not_served(self):
+        # изменение закоммитилось и сбросило кеш, пока строился ответ по старым данным
+        render_places = places_cache.render_places
+
+        def render_and_invalidate(*args):
+            entry = render_places(*args)
+            places_cache.invalidate_places(self.place_type.pk)
+            return entry
+
+        with mock.patch.object(places_cache, 'render_places', render_and_invalidate):
+            places_cache.get_places(self.place_type.pk)
+        with mock.patch.object(places_cache, 'render_places', wraps=render_places) as render:
+            places_cache.get_places(self.place_type.pk)
+        render.assert_called_once()
+
+    def test_one_invalidation_per_commit(self):
+        # типы, накопленные в транзакциях других тестов (в TestCase они не коммитятся)
+        signals._pending.type_ids = set()
+        with mock.patch.object(signals, 'invalidate_places') as invalidate, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.place_type.save()
+            self.place_type.save()
+        invalidate.assert_called_once_with(self.place_type.pk)
+
+
+class RunoutTest(SimpleTestCase):
+
+    def test_fill_depressions(self):
+        # склон к южному краю с ямой глубиной 10 м посередине
+        z = np.add.outer(np.arange(9, 0, -1) * 5.0, np.zeros(7))
+        z[4, 3] -= 10
+        filled = fill_depressions(z)
+        # яма заливается до уровня перелива - самого низкого соседа
+        self.assertGreater(filled[4, 3], z[5, 3])
+        # из каждой внутренней ячейки есть сток к соседу ниже
+        for row in range(1, z.shape[0] - 1):
+            for col in range(1, z.shape[1] - 1):
+                self.assertTrue(any(filled[row + d_row, col + d_col] < filled[row, col]
+                                    for d_row, d_col in D8_OFFSETS), (row, col))
+        # вне ямы рельеф не меняется
+        changed = filled != z
+        self.assertEqual(list(zip(*np.nonzero(changed))), [(4, 3)])
+
+    def test_mass_conservation(self):
+        # чаша: поток не доходит до края, объем сохраняется при разных площадях ячеек в строках
+        rows, cols = np.mgrid[0:40, 0:40]
+        z = ((rows - 20.0) ** 2 + (cols - 20.0) ** 2) * 0.5
+        release = (rows >= 5) & (rows < 10) & (cols >= 15) & (cols < 25)
+        dy, dx = 30.0, np.linspace(20.0, 30.0, 40)
+        result = simulate(z, release, dy, dx, 0.2, 1500, 1.0, max_steps=300)
+        area = dy * dx[:, np.newaxis]
+        self.assertGreater(result['steps'], 0)
+        self.assertAlmostEqual((result['height'] * area).sum() / (release * area).sum(), 1.0, places=9)
+        self.assertFalse(result['max_height'][[0, -1], :].any() or result['max_height'][:, [0, -1]].any())
+
+    def test_reached_boundary(self):
+        # крутой склон на юг: поток уходит за нижний край растра
+        cell = 1 / 3600
+        elevation = np.add.outer(np.arange(60, 0, -1) * 17.0, np.zeros(40)).astype(np.float32)
+        zeros = np.zeros_like(elevation)
+        terrain = TerrainDerivatives([33.0, cell, 0, 67.7, 0, -cell], elevation, zeros, zeros,
+                                     zeros.astype(np.uint8))
+        top, left, bottom, right = 67.7 - 5 * cell, 33.0 + 15 * cell, 67.7 - 10 * cell, 33.0 + 25 * cell
+        ring = [(top, left), (top, right), (bottom, right), (bottom, left), (top, left)]
+        result = runout(terrain, [ring])
+        self.assertTrue(result['reached_boundary'])
+        self.assertFalse(result['timed_out'])
+        self.assertGreaterEqual(result['max_height'].data[-1].max(), EXTENT_HEIGHT)
@@ -8,10 +8,20 @@ urlpatterns = [
     path('login', views.LoginView.as_view()),
     path('logout', views.LogoutView.as_view()),
     path('crsf', views.get_crsf),
+    path('metrics', views.metrics_view),
     path('whoami', views.WhoamiView.as_view()),
     path('places', views.ListCreatePlacesView.as_view()),
     path('allowed_region', views.get_allowed_region),
+    path('places/export', views.ExportPlacesView.as_view()),
+    path('places/nearby', views.NearbyPlacesView.as_view()),
+    path('places/tiles/<int:z>/<int:x>/<int:y>.pbf', views.places_tile),
     path('places/<pk>', views.UpdatePlacesView.as_view()),
-    path('elevation_around/<lat>/<lng>', views.ElevationAPI.as_view()),
-    path('exp_elevation/<lat>/<lng>/<fraction>', views.ExperimentalElevationAPI.as_view())
+    path('jobs/<pk>', views.JobView.as_view()),
+    path('elevation_around/<lat>/<lng>', views.elevation_api),
+    path('relief', views.ReliefAPI.as_view()),
+    path('elevation_profile', views.ProfileAPI.as_view()),
+    path('terrain/<int:z>/<int:x>/<int:y>.png', views.terrain_tile),
+    path('runout', views.RunoutAPI.as_view()),
+    path('exp_elevation/batch', views.ExperimentalBatchElevationAPI.as_view()),
+    path('exp_elevation/<lat>/<lng>/<fraction>', views.experimental_elevation_api)
 ] 
\ No newline at end of file
@@ -1,23 +1,102 @@
-from django.http import JsonResponse
+import os
+import hmac
+import tempfile
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, HttpResponse, Http404, FileResponse, HttpResponseNotAllowed, \
+    StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.views.decorators.http import condition
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from rest_framework import permissions
 from rest_framework import generics
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.middleware.csrf import get_token
 from django.contrib.auth import authenticate, login, logout
-from .models import Place
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+from django.contrib.gis.geos import Polygon
+from .models import Place, Job, geometry_field_for_zoom
 from .permissions import AdminOrOwnerOrReadOnly
 
-from .elevation_basic import get_elevation_around, ALLOWED_REGION
-from .elevation import get_allowed_region as get_reg, trace_path
+from .elevation_basic import get_elevation_around, get_relief, get_catalog
+from .elevation import FILE, relief_shape, get_relief as get_tif_relief
+from .elevation import get_allowed_region as get_reg, cached_trace_path, trace_paths, start_points_in_polygon
 
-from .serializers import UserRegSerializer, PlaceSerializer, UserSerializer
+from .terrain_tiles import get_terrain_tile, tile_etag, intersects_dem
+from .places_cache import get_places, GEOMETRY_FIELDS
+from .places_export import stream_features, write_features
+from .places_tiles import get_tile as get_places_tile
+from .dem_pool import run_in_dem_pool
+from .profile import profile, sample_count
+from .nearby import containing, nearest
+from .derivatives import DerivativesUnavailable
+from . import metrics
+
+from .serializers import UserRegSerializer, PlaceSerializer, UserSerializer, TraceBatchSerializer, JobSerializer, \
+    ProfileSerializer, RunoutSerializer, NearbyQuerySerializer, NearbyPlaceSerializer, NearbyPlaceGeometrySerializer
+from lavina_server.settings import TERRAIN_TILE_MAX_ZOOM, TERRAIN_TILE_MAX_AGE, METRICS_ALLOWED_IPS, METRICS_TOKEN, \
+    PLACES_TILE_MAX_ZOOM
 
 def get_crsf(request):
     return JsonResponse({'X-CSRFToken': get_token(request)})
 
-def get_allowed_region(request):
-    return JsonResponse({'allowed_region': get_reg()})
+# async представления для быстрых запросов к карте высот (под ASGI сервером):
+# чтение DEM выполняется в пуле dem_pool, а проверка сессии (запрос к БД) - через sync_to_async.
+# используется только SessionAuthentication, поэтому request.user от AuthenticationMiddleware
+# тот же, что получили бы представления DRF
+
+def dem_response(data):
+    # JSONEncoder DRF умеет сериализовать numpy значения, как Response в прежних представлениях
+    return JsonResponse(data, encoder=JSONEncoder, safe=False, json_dumps_params={'ensure_ascii': False})
+
+async def check_get_authenticated(request):
+    # то же, что permissions.IsAuthenticated в APIView с одним методом get
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+    return None
+
+async def get_allowed_region(request):
+    return JsonResponse({'allowed_region': await run_in_dem_pool(get_reg)})
+
+def metrics_token_valid(request):
+    if not METRICS_TOKEN:
+        return False
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+def metrics_view(request):
+    # метрики Prometheus: для персонала, сборщика с токеном METRICS_TOKEN
+    # или явно разрешенных адресов METRICS_ALLOWED_IPS (по умолчанию - никаких)
+    if not (request.user.is_staff or metrics_token_valid(request)
+            or request.META.get('REMOTE_ADDR') in METRICS_ALLOWED_IPS):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@condition(etag_func=lambda request, z, x, y: tile_etag(z, x, y))
+def terrain_tile(request, z, x, y):
+    if z > TERRAIN_TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z or not intersects_dem(z, x, y):
+        raise Http404("No terrain tile here")
+    response = HttpResponse(get_terrain_tile(z, x, y), content_type='image/png')
+    response['Cache-Control'] = f'public, max-age={TERRAIN_TILE_MAX_AGE}'
+    return response
+
+def places_tile(request, z, x, y):
+    # векторный тайл мест; клиент перепроверяет тайл по ETag, т.к. места могут измениться
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    if z > PLACES_TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404("No places tile here")
+    entry = get_places_tile(z, x, y)
+    response = get_conditional_response(request, etag=entry['etag'])
+    if response is None:
+        response = HttpResponse(entry['content'], content_type='application/vnd.mapbox-vector-tile')
+    response['ETag'] = entry['etag']
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 class LoginView(APIView):
     permission_classes = [permissions.AllowAny]
@@ -54,35 +133,295 @@ class RegisterView(generics.CreateAPIView):
     permission_classes = [permissions.AllowAny]
     serializer_class = UserRegSerializer
 
+def parse_geometry_field(query_params):
+    # zoom - масштаб карты leaflet, для мелких масштабов отдаем упрощенные полигоны
+    zoom = query_params.get('zoom')
+    if zoom is None:
+        return 'geometry'
+    try:
+        return geometry_field_for_zoom(int(zoom))
+    except ValueError:
+        raise ValidationError({'zoom': 'zoom should be an integer.'})
+
+def parse_bbox(query_params):
+    # bbox - видимая область карты: широта_мин,долгота_мин,широта_макс,долгота_макс
+    # NOTE: геометрии мест хранятся в порядке leaflet (x = широта), как и bbox
+    bbox = query_params.get('bbox')
+    if bbox is None:
+        return None
+    try:
+        bbox = tuple(float(val) for val in bbox.split(','))
+    except ValueError:
+        bbox = ()
+    if len(bbox) != 4:
+        raise ValidationError({'bbox': 'bbox should be lat_min,lng_min,lat_max,lng_max.'})
+    polygon = Polygon.from_bbox(bbox)
+    polygon.srid = 4326
+    return polygon
+
 class ListCreatePlacesView(generics.ListCreateAPIView):
     serializer_class = PlaceSerializer
     permission_classes = [permissions.DjangoModelPermissionsOrAnonReadOnly]
 
+    def get_geometry_field(self):
+        return parse_geometry_field(self.request.query_params)
+
+    def get_bbox(self):
+        return parse_bbox(self.request.query_params)
+
     def get_queryset(self):
         place_type_id = self.request.query_params.get('type_id')
-        return Place.objects.filter(place_type=place_type_id)
-    
+        queryset = Place.objects.filter(place_type=place_type_id)
+        bbox = self.get_bbox()
+        if bbox is not None:
+            # intersects использует пространственный индекс по geometry
+            queryset = queryset.filter(geometry__intersects=bbox)
+        geometry_field = self.get_geometry_field()
+        return queryset.defer(*(field for field in GEOMETRY_FIELDS if field != geometry_field))
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request.method == 'GET':
+            context['geometry_field'] = self.get_geometry_field()
+        return context
+
+    def list(self, request, *args, **kwargs):
+        # JSON ответ без bbox одинаков для всех посетителей до следующего изменения мест,
+        # поэтому отдаем отрендеренный один раз (см. places_cache.py)
+        place_type_id = request.query_params.get('type_id')
+        if request.accepted_renderer.format != 'json' or not str(place_type_id).isdigit() \
+           or 'bbox' in request.query_params:
+            return super().list(request, *args, **kwargs)
+        entry = get_places(int(place_type_id), self.get_geometry_field())
+        response = get_conditional_response(request, etag=entry['etag'],
+                                            last_modified=entry['last_modified'])
+        if response is None:
+            response = HttpResponse(entry['content'], content_type='application/json')
+        response['ETag'] = entry['etag']
+        response['Last-Modified'] = http_date(entry['last_modified'])
+        return response
+
     def perform_create(self, serializer):
         return serializer.save(owner=self.request.user)
 
+# размер выгрузки под ASGI, до которого она собирается в памяти, дальше - во временном файле
+EXPORT_SPOOL_SIZE = 8 * 1024 * 1024
+
+class ExportPlacesView(APIView):
+    """Места типа type_id в виде GeoJSON FeatureCollection, который строится в PostGIS.
+    Поддерживает те же bbox и zoom, что и /places.
+    Под WSGI строки отправляются по мере чтения из БД, под ASGI - читаются внутри
+    представления в файл, который затем отправляется частями (см. places_export.py)
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        place_type_id = request.query_params.get('type_id')
+        if not str(place_type_id).isdigit():
+            return Response({'detail': 'type_id should be provided.'}, status=400)
+        bbox, geometry_field = parse_bbox(request.query_params), parse_geometry_field(request.query_params)
+        if not isinstance(request._request, ASGIRequest):
+            return StreamingHttpResponse(stream_features(int(place_type_id), bbox, geometry_field),
+                                         content_type='application/geo+json')
+        file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        try:
+            size = write_features(file, int(place_type_id), bbox, geometry_field)
+        except BaseException:
+            file.close()
+            raise
+        file.seek(0)
+        response = FileResponse(file, content_type='application/geo+json')
+        response['Content-Length'] = size
+        return response
+
+class NearbyPlacesView(APIView):
+    """Места, внутри которых находится точка lat,lng (inside), и k ближайших к ней
+    мест в радиусе radius метров (nearest, по возрастанию расстояния).
+    Геометрия мест отдается, только если задан zoom (как в /places)
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        query = NearbyQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        params = query.validated_data
+        lat, lng = params['lat'], params['lng']
+
+        queryset = Place.objects.all()
+        if 'type_id' in params:
+            queryset = queryset.filter(place_type=params['type_id'])
+        if 'zoom' in request.query_params:
+            geometry_field = parse_geometry_field(request.query_params)
+            serializer_class = NearbyPlaceGeometrySerializer
+            queryset = queryset.defer(*(field for field in GEOMETRY_FIELDS if field != geometry_field))
+        else:
+            geometry_field = None
+            serializer_class = NearbyPlaceSerializer
+            queryset = queryset.defer(*GEOMETRY_FIELDS)
+
+        inside = list(containing(queryset, lat, lng).order_by('pk'))
+        near = nearest(queryset.exclude(pk__in=[place.pk for place in inside]),
+                       lat, lng, params['k'], params['radius']) if params['k'] else []
+        context = {'request': request, 'geometry_field': geometry_field}
+        return Response({'inside': serializer_class(inside, many=True, context=context).data,
+                         'nearest': serializer_class(near, many=True, context=context).data})
+
 class UpdatePlacesView(generics.UpdateAPIView):
     permission_classes = [AdminOrOwnerOrReadOnly]
     serializer_class = PlaceSerializer
     queryset = Place.objects.all()
 
-class ElevationAPI(APIView):
+class JobView(generics.RetrieveAPIView):
+    # статус фоновой задачи, например Place.elevation_job: только своей или для персонала
     permission_classes = [permissions.IsAuthenticated]
+    serializer_class = JobSerializer
 
-    def get(self, request, *args, **kwargs):
-        lat = float(kwargs.get('lat', '67'))
-        lng = float(kwargs.get('lng', '33'))
-        return Response(get_elevation_around(lat, lng))
+    def get_queryset(self):
+        if self.request.user.is_staff:
+            return Job.objects.all()
+        return Job.objects.filter(owner=self.request.user)
 
-class ExperimentalElevationAPI(APIView):
+async def elevation_api(request, lat='67', lng='33'):
+    error = await check_get_authenticated(request)
+    if error is not None:
+        return error
+    return dem_response(await run_in_dem_pool(get_elevation_around, float(lat), float(lng)))
+
+# ограничение размера ответа relief (количество ячеек)
+MAX_RELIEF_CELLS = 4_000_000
+
+class ReliefAPI(APIView):
+    """Высоты в прямоугольнике в компактном виде (см. grid.GeoGrid).
+    Параметры запроса:
+        bounds: широта_мин,долгота_мин,широта_макс,долгота_макс
+        encoding: base64 (по умолчанию) | array | raw
+        size: строк,столбцов - нужный размер для мелких масштабов. высоты тогда берутся
+              из самого грубого обзора GeoTiff (manage.py buildheightmap), где ячеек не меньше
+    При encoding=raw или Accept: application/octet-stream возвращаются
+    сырые little-endian значения, а описание сетки - в заголовках X-Grid-*
+    """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request, *args, **kwargs):
-        lat = float(kwargs.get('lat', '67'))
-        lng = float(kwargs.get('lng', '33'))
-        fraction = float(kwargs.get('fraction', '0.02'))
-        return Response(trace_path((lat, lng), 0, fraction))
+        try:
+            bounds = tuple(float(val) for val in request.query_params.get('bounds', '').split(','))
+        except ValueError:
+            bounds = ()
+        if len(bounds) != 4 or bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+            return Response({'detail': 'bounds should be lat_min,lng_min,lat_max,lng_max.'}, status=400)
+        size = request.query_params.get('size')
+        if size is not None:
+            try:
+                size = tuple(int(val) for val in size.split(','))
+            except ValueError:
+                size = ()
+            if len(size) != 2 or min(size) < 1:
+                return Response({'detail': 'size should be rows,cols.'}, status=400)
+        if size is not None and os.path.exists(FILE):
+            shape = relief_shape(bounds, size)
+        else:
+            per_degree = get_catalog().per_degree
+            shape = ((bounds[2] - bounds[0]) * per_degree + 1, (bounds[3] - bounds[1]) * per_degree + 1)
+        if shape[0] * shape[1] > MAX_RELIEF_CELLS:
+            return Response({'detail': 'Requested area is too large.'}, status=400)
+        grid = get_tif_relief(bounds, size) if size is not None and os.path.exists(FILE) else get_relief(bounds)
+
+        encoding = request.query_params.get('encoding', 'base64')
+        if encoding == 'raw' or 'application/octet-stream' in request.META.get('HTTP_ACCEPT', ''):
+            response = HttpResponse(grid.to_bytes(), content_type='application/octet-stream')
+            header = grid.header()
+            response['X-Grid-Origin'] = ','.join(str(val) for val in header['origin'])
+            response['X-Grid-Cell-Size'] = ','.join(str(val) for val in header['cell_size'])
+            response['X-Grid-Shape'] = ','.join(str(val) for val in header['shape'])
+            response['X-Grid-Dtype'] = header['dtype']
+            response['X-Grid-Nodata'] = str(header['nodata'])
+            return response
+        if encoding not in ('base64', 'array'):
+            return Response({'detail': 'encoding should be base64, array or raw.'}, status=400)
+        return Response(grid.to_json(encoding))
+
+# ограничение количества точек в ответе profile
+MAX_PROFILE_SAMPLES = 20000
+
+class ProfileAPI(APIView):
+    """Высоты в точках (интерполированные) и профиль высот вдоль ломаной за один запрос.
+    Тело запроса: {"points": [[lat, lng], ...], "step": шаг_в_метрах}
+    без step возвращаются высоты в самих точках, со step - точки вдоль ломаной
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = ProfileSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        points, step = serializer.validated_data['points'], serializer.validated_data.get('step')
+        if sample_count(points, step) > MAX_PROFILE_SAMPLES:
+            return Response({'detail': f'Too many samples, increase step (at most {MAX_PROFILE_SAMPLES}).'},
+                            status=400)
+        return Response(profile(points, step))
+
+async def experimental_elevation_api(request, lat='67', lng='33', fraction='0.02'):
+    error = await check_get_authenticated(request)
+    if error is not None:
+        return error
+    try:
+        result = await run_in_dem_pool(cached_trace_path, (float(lat), float(lng)), 0, float(fraction))
+    except ValueError as e:
+        return JsonResponse({'detail': str(e)}, status=400)
+    except DerivativesUnavailable as e:
+        return JsonResponse({'detail': str(e)}, status=503)
+    return dem_response(result)
+
+# ограничение количества начальных точек в пакетном расчете
+MAX_TRACE_START_POINTS = 5000
+# ограничение суммарного количества точек всех путей в ответе
+MAX_TRACE_PATH_POINTS = 200_000
+
+class ExperimentalBatchElevationAPI(APIView):
+    """Пакетный расчет путей схода: от каждой точки points
+    или от каждой ячейки внутри места place_id.
+    Возвращает пути и след (сколько путей прошло через ячейку, grid.GeoGrid в JSON)
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = TraceBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            if 'place_id' in data:
+                points = start_points_in_polygon([ring.coords for ring in data['place_id'].geometry])
+            else:
+                points = data['points']
+            if len(points) > MAX_TRACE_START_POINTS:
+                return Response({'detail': 'Too many start points.'}, status=400)
+            paths, footprint = trace_paths(points, data['fraction'], data['max_steps'])
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=400)
+        except DerivativesUnavailable as e:
+            return Response({'detail': str(e)}, status=503)
+        if sum(len(path['path']) for path in paths) > MAX_TRACE_PATH_POINTS:
+            return Response({'detail': f'Paths are too long, decrease max_steps or the number of start points '
+                                       f'(at most {MAX_TRACE_PATH_POINTS} points in all paths).'}, status=400)
+        return Response({'paths': paths,
+                         'footprint': footprint.to_json('array') if footprint is not None else None})
+
+class RunoutAPI(APIView):
+    """Зона выноса лавины из зоны зарождения (модель Воеллми на сетке, см. runout.py).
+    Расчет ставится в очередь (tasks.runout_job), ответ - 202 с номером задачи. Результат задачи
+    (GET /jobs/<job>) - маска зоны выноса и растры максимальной скорости и толщины (grid.GeoGrid в JSON)
+    или {'detail': ошибка}
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = RunoutSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        if 'place_id' in data:
+            rings = [ring.coords for ring in data['place_id'].geometry]
+        else:
+            rings = [data['polygon']]
+        job = Job.enqueue('runout', owner=request.user, rings=[[list(point) for point in ring] for ring in rings],
+                          mu=data['mu'], xi=data['xi'], release_depth=data['release_depth'],
+                          margin=data['margin'])
+        return Response({'job': job.pk}, status=202)
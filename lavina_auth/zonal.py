@@ -0,0 +1,113 @@
+import numpy as np
+from .elevation_basic import get_catalog, VOID_DATA
+from .terrain import cell_size_meters, slope_degrees
+
+# зональная статистика по полигону (лавиноопасному участку):
+# учитываются только отсчеты DEM внутри полигона, а не весь ограничивающий прямоугольник.
+# мозаика обрабатывается блоками, поэтому память не зависит от размера полигона
+#
+# NOTE: полигоны в базе хранятся в порядке координат leaflet, то есть x = широта, y = долгота,
+# поэтому кольца полигона - это последовательности (lat, lng)
+
+# размер блока (строк и столбцов) при обработке
+BLOCK_SIZE = 512
+# границы классов уклона в градусах, 30-45 - типичные уклоны зарождения лавин
+SLOPE_BINS = (0, 15, 30, 35, 40, 45, 60, 90)
+
+def polygon_mask(rings, lats, lngs):
+    """Растеризует полигон: для каждой точки сетки определяет, лежит ли она внутри.
+    Используется правило чет-нечет (работает и для полигонов с дырами):
+    для каждой строки вычисляются долготы пересечений всех ребер с этой широтой,
+    а точка внутри, если левее нее нечетное количество пересечений.
+
+    Args:
+        rings (list): замкнутые кольца полигона, последовательности (lat, lng)
+        lats (numpy.ndarray): широты строк сетки (1D)
+        lngs (numpy.ndarray): долготы столбцов сетки (1D), по возрастанию
+
+    Returns:
+        numpy.ndarray: bool массив (len(lats), len(lngs))
+    """
+    edges = np.concatenate([np.column_stack((ring[:-1], ring[1:]))
+                            for ring in (np.asarray(ring, dtype=np.float64) for ring in rings)])
+    lat1, lng1, lat2, lng2 = edges.T
+    lats = np.asarray(lats, dtype=np.float64)[:, np.newaxis]
+    crosses = (lat1 > lats) != (lat2 > lats)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = lng1 + (lats - lat1) * (lng2 - lng1) / (lat2 - lat1)
+    x = np.sort(np.where(crosses, x, np.inf), axis=1)
+    mask = np.empty((lats.shape[0], len(lngs)), dtype=bool)
+    for row in range(lats.shape[0]):
+        mask[row] = np.searchsorted(x[row], lngs, side='left') % 2 == 1
+    return mask
+
+def rings_extent(rings):
+    """(широта_мин, долгота_мин, широта_макс, долгота_макс) колец полигона"""
+    points = np.concatenate([np.asarray(ring, dtype=np.float64) for ring in rings])
+    return (*points.min(axis=0), *points.max(axis=0))
+
+def zonal_stats(rings, catalog=None, block_size=BLOCK_SIZE, slope_bins=SLOPE_BINS):
+    """Статистика высот и уклонов по отсчетам DEM внутри полигона за один проход.
+
+    Args:
+        rings (list): кольца полигона (внешнее и дыры), последовательности (lat, lng)
+        catalog (TileCatalog): мозаика, по умолчанию get_catalog()
+        block_size (int): размер обрабатываемого блока
+        slope_bins (tuple): границы классов уклона для гистограммы
+
+    Returns:
+        dict: {'count': кол-во отсчетов, 'min', 'max', 'mean': высоты,
+               'heighest': {'elevation': ..., 'coords': (lat, lng)},
+               'slope_histogram': {'bins': границы, 'counts': кол-ва}}
+              min/max/mean/heighest - None, если внутри полигона нет отсчетов
+    """
+    catalog = catalog or get_catalog()
+    pd = catalog.per_degree
+    extent = rings_extent(rings)
+    # отсчеты строго внутри: сдвигаем границы к ближайшим отсчетам внутрь прямоугольника
+    top, left = int(np.ceil((90 - extent[2]) * pd)), int(np.ceil((extent[1] + 180) * pd))
+    bottom, right = int(np.floor((90 - extent[0]) * pd)), int(np.floor((extent[3] + 180) * pd))
+    dy = cell_size_meters(0, 1 / pd, 1 / pd)[0]
+
+    count, total = 0, 0.0
+    lowest, heighest = None, None
+    slope_counts = np.zeros(len(slope_bins) - 1, dtype=np.int64)
+    for block_top in range(top, bottom + 1, block_size):
+        block_bottom = min(block_top + block_size - 1, bottom)
+        lats = 90 - np.arange(block_top, block_bottom + 1) / pd
+        dx = cell_size_meters(lats, 1 / pd, 1 / pd)[1]
+        for block_left in range(left, right + 1, block_size):
+            block_right = min(block_left + block_size - 1, right)
+            lngs = np.arange(block_left, block_right + 1) / pd - 180
+            mask = polygon_mask(rings, lats, lngs)
+            if not mask.any():
+                continue
+            # блок читается с рамкой в одну ячейку - она нужна для уклона
+            z = catalog.window(block_top - 1, block_left - 1, block_bottom + 1, block_right + 1)
+            z = np.where(z == VOID_DATA, np.nan, z.astype(np.float64))
+            values = z[1:-1, 1:-1]
+            mask &= ~np.isnan(values)
+            if not mask.any():
+                continue
+
+            inside = values[mask]
+            count += inside.size
+            total += inside.sum()
+            masked = np.where(mask, values, -np.inf)
+            i, j = np.unravel_index(np.argmax(masked), masked.shape)
+            if heighest is None or masked[i, j] > heighest[0]:
+                heighest = (masked[i, j], block_top + i, block_left + j)
+            block_min = inside.min()
+            if lowest is None or block_min < lowest:
+                lowest = block_min
+
+            slope = slope_degrees(z, dy, dx)[mask]
+            slope_counts += np.histogram(slope[~np.isnan(slope)], bins=slope_bins)[0]
+
+    result = {'count': count, 'min': None, 'max': None, 'mean': None, 'heighest': None,
+              'slope_histogram': {'bins': list(slope_bins), 'counts': slope_counts.tolist()}}
+    if count:
+        result.update({'min': int(lowest), 'max': int(heighest[0]), 'mean': float(total / count),
+                       'heighest': {'elevation': int(heighest[0]),
+                                    'coords': catalog.coords(int(heighest[1]), int(heighest[2]))}})
+    return result
@@ -54,6 +54,7 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    'lavina_auth.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -104,6 +105,54 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+# file based cache is shared by all workers of a single node,
+# locmem is enough for the development server
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/django/'),
+    },
+    # memoized avalanche traces (exp_elevation), shared by all workers of a node.
+    # kept apart from 'default' so that culling old traces never evicts /places responses;
+    # keys include the height map checksum, so traces of a replaced map are culled eventually
+    'traces': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/traces/'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    # vector tiles of places (/places/tiles), kept apart from 'default' for the same reason.
+    # every tile is a body plus a generation key, a map session alone touches hundreds of tiles
+    'tiles': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/tiles/'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # cached permissions and groups of users (lavina_auth/auth_cache.py), one entry per user
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache/auth/'),
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+
+# cache alias for rendered /places responses
+PLACES_CACHE = 'default'
+# cache alias for trace_path results
+TRACE_CACHE = 'traces'
+# cache alias for vector tiles of places
+PLACES_TILE_CACHE = 'tiles'
+# cache alias and timeout (seconds) for user permissions and groups
+AUTH_CACHE = 'auth'
+AUTH_CACHE_TIMEOUT = 60 * 60
+
+AUTHENTICATION_BACKENDS = ['lavina_auth.backends.CachedModelBackend']
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -143,6 +192,64 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static/')
 
 DATA_ROOT = os.path.join(BASE_DIR, 'data/')
 
+# Elevation model (SRTM *.hgt tiles in DATA_ROOT)
+# max number of memory-mapped tiles kept open by one worker process
+DEM_TILE_CACHE_SIZE = 4
+# mosaic resolution in samples per degree (1200 - SRTM3, 3600 - SRTM1),
+# None means the coarsest resolution among the tiles
+DEM_SAMPLES_PER_DEGREE = None
+# (lat_min, lng_min, lat_max, lng_max) where places may be added,
+# None means the extent of all tiles (found on first use)
+DEM_ALLOWED_REGION = (67.546, 33.28, 68, 34)
+# seconds between content checksum checks of an open GeoTIFF height map
+# (size and mtime are checked on every access)
+DEM_CHECKSUM_INTERVAL = 300
+# threads per process for blocking height map reads from async views
+DEM_THREAD_POOL_SIZE = 4
+
+# slope/aspect/D8 rasters for the GeoTIFF height map (manage.py buildterrain)
+TERRAIN_DERIVATIVES_ROOT = os.path.join(DATA_ROOT, 'terrain/')
+
+# Terrain-RGB tiles (/terrain/<z>/<x>/<y>.png)
+TERRAIN_TILE_CACHE_DIR = os.path.join(BASE_DIR, 'cache/terrain/')
+TERRAIN_TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+TERRAIN_TILE_MAX_ZOOM = 15
+# seconds, Cache-Control max-age for browsers and the reverse proxy
+TERRAIN_TILE_MAX_AGE = 7 * 24 * 60 * 60
+
+# avalanche slope overlay tiles (manage.py buildslopetiles), served statically
+# from SLOPE_TILES_ROOT/current/<z>/<x>/<y>.png
+SLOPE_TILES_ROOT = os.path.join(BASE_DIR, 'tiles/slope/')
+SLOPE_TILES_MIN_ZOOM = 8
+SLOPE_TILES_MAX_ZOOM = 15
+
+# vector tiles of places (/places/tiles/<z>/<x>/<y>.pbf), cached in PLACES_TILE_CACHE
+PLACES_TILE_MAX_ZOOM = 16
+# a change touching more cached tiles than this drops all of them at once
+PLACES_TILE_INVALIDATE_LIMIT = 5000
+
+# /places/nearby: radius in meters and number of nearest places
+NEARBY_DEFAULT_RADIUS = 5000
+NEARBY_MAX_RADIUS = 50000
+NEARBY_DEFAULT_COUNT = 5
+NEARBY_MAX_COUNT = 50
+
+# Background jobs (manage.py runjobs)
+# compute place elevation in a job instead of inside the request saving the place
+PLACE_ELEVATION_ASYNC = True
+# failed jobs are retried until they have been attempted this many times
+JOB_MAX_ATTEMPTS = 3
+# seconds a worker sleeps when the queue is empty
+JOB_POLL_INTERVAL = 2
+# seconds after which a running job is considered abandoned and requeued
+JOB_TIMEOUT = 600
+
+# /metrics is available to staff users and to requests with "Authorization: Bearer <METRICS_TOKEN>"
+# (None disables the token). addresses in METRICS_ALLOWED_IPS are let in without credentials:
+# opt-in only, behind a reverse proxy on the same host every request comes from 127.0.0.1
+METRICS_TOKEN = None
+METRICS_ALLOWED_IPS = []
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 